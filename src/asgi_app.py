@@ -0,0 +1,248 @@
+import os, time, asyncio, logging
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from a2wsgi import WSGIMiddleware
+from upstream.upstream_client import async_openai_client
+from system.instrumentation import request_metrics, current_route, stage
+from system.cluster import cluster, PEER_HEADER
+
+logger = logging.getLogger(__name__)
+
+READ_BLOCK = 256 * 1024
+
+"""
+The ASGI server mode.
+
+The flask app keeps all routes and the Swagger UI; every request is matched against its URL map.
+The chat completions, the transcriptions and the file downloads are handled by the asynchronous
+handlers below, which wait for the upstream API and stream files and events without holding a
+thread, so thousands of slow or idle connections can be open at the same time. Blocking work,
+i.e. local models, transcriptions and hashing, runs in the thread pool of the event loop. All
+other requests are passed to the flask app, which runs in its own thread pool.
+
+The handlers answer exactly like the flask resources they replace, with the same CORS headers.
+A handler is only used if the service of its resource is enabled, and it imports the modules of
+the service itself. Their requests are recorded in the request metrics as well; unlike with
+flask, the latency includes sending the body.
+
+call i.e.:
+python3 src/main.py --server asgi --threads 16
+"""
+
+class AsgiApp:
+
+    def __init__(self, flask_app, threads=8):
+        self.flask_app = flask_app
+        self.threads = threads
+        self.wsgi = WSGIMiddleware(flask_app, workers=threads)
+        # the flask resources which are replaced by asynchronous handlers, with their methods
+        self.handlers = {
+            'text.text_service.ChatCompletion': (('POST',), self.chat_completions),
+            'audio.audio_service.VoiceTranscription': (('POST',), self.transcriptions),
+            'share.share_service.FileResource': (('GET', 'HEAD'), self.file)
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        rule, view_args, handler = self.match(scope)
+        if handler == self.file:
+            # the file is looked up in the thread pool, directory listings and errors are made by flask
+            abs_path = await asyncio.to_thread(self.file_path, view_args['req_path'])
+            handler, view_args = (handler, {'abs_path': abs_path}) if abs_path else (None, None)
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        request = Request(scope, receive)
+        route = rule.rule
+        token = current_route.set(route)
+        start = time.perf_counter()
+        status = 500
+        request_metrics.start_request(route)
+        try:
+            response = await handler(request, **view_args)
+            status = response.status_code
+            cors_headers(request, response)
+            await response(scope, receive, send)
+        finally:
+            current_route.reset(token)
+            request_metrics.finish_request(route, scope['method'], status, time.perf_counter() - start)
+
+    def match(self, scope):
+        adapter = self.flask_app.url_map.bind('localhost', script_name=scope.get('root_path') or None)
+        try:
+            rule, view_args = adapter.match(scope['path'], method=scope['method'], return_rule=True)
+        except (HTTPException, RequestRedirect):
+            return None, None, None
+        view_class = getattr(self.flask_app.view_functions.get(rule.endpoint), 'view_class', None)
+        resource = f'{view_class.__module__}.{view_class.__name__}' if view_class else None
+        methods, handler = self.handlers.get(resource, ((), None))
+        if scope['method'] not in methods:
+            return None, None, None
+        return rule, view_args, handler
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # blocking work of the handlers runs in this pool
+                asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(self.threads, thread_name_prefix='asgi'))
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_openai_client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # the asynchronous version of ChatCompletion.post, the request is decided by text_service.plan_chat
+    async def chat_completions(self, request):
+        from text.text_service import plan_chat, chat_error, CHAT_ERRORS
+        from text.chat_cache import completion_events
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return error_response('Invalid JSON input', 400)
+        # the plan may load a local model
+        plan = await asyncio.to_thread(plan_chat, data, self.flask_app.config['OPENAI_API_KEY'], request.headers)
+        if plan.error is not None:
+            return json_response(*plan.error)
+        if plan.forwarded is not None:
+            return peer_response(plan.forwarded)
+        if plan.completion is not None:
+            return sse_response(completion_events(plan.completion)) if plan.stream else JSONResponse(plan.completion)
+
+        try:
+            if plan.stream:
+                return sse_response(timed_events(await plan.backend.astream(plan.chat), current_route.get()))
+            with stage('completion'):
+                completion = await plan.backend.acomplete(plan.chat)
+            await asyncio.to_thread(plan.done, completion)
+            return JSONResponse(completion)
+        except CHAT_ERRORS as e:
+            return json_response(*chat_error(e))
+
+    # the asynchronous version of VoiceTranscription.post, the request is decided by audio_service.plan_transcription
+    async def transcriptions(self, request):
+        from audio.audio_service import plan_transcription, transcribe_offline, upstream_result, transcription_error, TRANSCRIPTION_ERRORS
+
+        form = await request.form()
+        audio_file = form.get('file')
+        if audio_file is None or isinstance(audio_file, str):
+            return JSONResponse({'error': 'No file provided'})
+        with stage('read_upload'):
+            audio_data = await audio_file.read()
+
+        plan = await asyncio.to_thread(plan_transcription, request.headers.get('Authorization'), self.flask_app.config['OPENAI_API_KEY'],
+                                       form.get('model'), form.get('vad'), audio_file.filename, audio_data, request.headers)
+        if plan.result is not None:
+            return JSONResponse(plan.result)
+        if plan.forwarded is not None:
+            return peer_response(plan.forwarded)
+
+        try:
+            if plan.upstream is not None:
+                headers, payload = plan.upstream
+                with stage('upstream'):
+                    result = upstream_result(await async_openai_client.post("/v1/audio/transcriptions", headers=headers, content=payload))
+            else:
+                result = await asyncio.to_thread(transcribe_offline, plan)
+        except TRANSCRIPTION_ERRORS as e:
+            return json_response(*transcription_error(e))
+        await asyncio.to_thread(plan.done, result)
+        return JSONResponse(result)
+
+    # the asynchronous version of FileResource.get for files; directory listings are made by flask
+    def file_path(self, req_path):
+        from share.share_service import secure_path, is_safe_path
+        data_path = self.flask_app.config['DATA_PATH']
+        abs_path = os.path.join(data_path, secure_path(req_path))
+        return abs_path if is_safe_path(data_path, abs_path) and os.path.isfile(abs_path) else None
+
+    async def file(self, request, abs_path):
+        from share.file_serving import plan_file_response
+        # the first download of a file hashes it for the ETag
+        plan = await asyncio.to_thread(plan_file_response, abs_path, request.headers)
+        if not plan.has_body:
+            return Response(status_code=plan.status, headers=plan.headers)
+        if request.method == 'HEAD':
+            return Response(status_code=plan.status, headers=plan.headers, media_type=plan.content_type or plan.mimetype)
+        return StreamingResponse(read_segments(plan), status_code=plan.status, headers=plan.headers,
+                                 media_type=plan.content_type or plan.mimetype)
+
+async def read_segments(plan):
+    # the file is read in the thread pool, block by block, while the event loop sends the previous block
+    f = await asyncio.to_thread(open, plan.path, 'rb')
+    try:
+        for segment in plan.segments():
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            start, end = segment
+            await asyncio.to_thread(f.seek, start)
+            remaining = end - start
+            while remaining > 0:
+                block = await asyncio.to_thread(f.read, min(READ_BLOCK, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+    finally:
+        await asyncio.to_thread(f.close)
+
+def sse_response(events):
+    """
+    :param events: An iterator or async iterator of event data strings
+    :return: A streamed text/event-stream response, like text_service.sse_response
+    """
+    if hasattr(events, '__aiter__'):
+        async def generate():
+            async for event in events:
+                yield f'data: {event}\n\n'
+    else:
+        def generate():
+            for event in events:
+                yield f'data: {event}\n\n'
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+async def timed_events(events, route):
+    start = time.perf_counter()
+    first = True
+    async for event in events:
+        if first:
+            request_metrics.observe_stage(route, 'stream_first_event', time.perf_counter() - start)
+            first = False
+        yield event
+    request_metrics.observe_stage(route, 'stream', time.perf_counter() - start)
+
+def peer_response(forwarded):
+    # the body is read from the peer in the thread pool while it is sent
+    return StreamingResponse(cluster.chunks(forwarded), status_code=forwarded.status_code,
+                             headers={PEER_HEADER: forwarded.peer.url}, media_type=forwarded.headers.get('Content-Type'))
+
+def cors_headers(request, response):
+    # the same headers as flask_cors with the defaults of CORS(app) in main.py, which adds them to all flask responses;
+    # preflight requests are answered by flask
+    origin = request.headers.get('Origin')
+    response.headers['Access-Control-Allow-Origin'] = origin or '*'
+    if origin:
+        response.headers.add_vary_header('Origin')
+
+def error_response(message, status_code):
+    return json_response({'error': message}, status_code)
+
+def json_response(body, status_code=200, headers=None):
+    return JSONResponse(body, status_code=status_code, headers=headers or None)
+
+def create_asgi_app(flask_app, threads=8):
+    """
+    :param flask_app: The configured flask app
+    :param threads: The number of threads for blocking work and for the flask app, each
+    :return: The ASGI application
+    """
+    return AsgiApp(flask_app, threads=threads)
@@ -0,0 +1,124 @@
+import os, struct, tempfile
+import numpy as np
+from system.startup import startup
+
+# whisper and vosk models expect mono audio sampled at 16 kHz
+SAMPLE_RATE = 16000
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def load_audio(audio_data, filename=None, sample_rate=SAMPLE_RATE):
+    """
+    Decode an uploaded audio file into a float32 mono numpy array at the given sample rate.
+    WAV files are decoded directly from memory, all other formats are decoded with ffmpeg.
+
+    :param audio_data: The bytes of the uploaded audio file
+    :param filename: The name of the uploaded file, used to give ffmpeg a hint about the format
+    :param sample_rate: The sample rate of the returned audio
+    :return: A float32 numpy array with samples in the range -1.0 to 1.0
+    """
+    audio = decode_wav(audio_data, sample_rate)
+    if audio is not None:
+        return audio
+
+    # compressed formats are decoded by ffmpeg from a temporary file
+    suffix = os.path.splitext(filename)[1] if filename else ""
+    with tempfile.NamedTemporaryFile(suffix=suffix or ".wav", delete=True) as temp_audio_file:
+        temp_audio_file.write(audio_data)
+        temp_audio_file.flush()
+        return startup.import_module('whisper').load_audio(temp_audio_file.name, sr=sample_rate)
+
+def decode_wav(audio_data, sample_rate=SAMPLE_RATE):
+    """
+    Decode a PCM or float WAV file from memory without copying the sample data before conversion.
+
+    :param audio_data: The bytes of the audio file
+    :param sample_rate: The sample rate of the returned audio
+    :return: A float32 mono numpy array or None if the data is not a WAV file which can be decoded here
+    """
+    header = parse_wav_header(audio_data)
+    if header is None:
+        return None
+    audio_format, channels, rate, bits, data_offset, data_size = header
+    width = bits // 8
+    frames = data_size // (width * channels)
+    if frames == 0:
+        return np.zeros(0, dtype=np.float32)
+    count = frames * channels
+    buffer = memoryview(audio_data)
+
+    if audio_format == WAVE_FORMAT_IEEE_FLOAT and bits == 32:
+        samples = np.frombuffer(buffer, dtype='<f4', count=count, offset=data_offset).astype(np.float32)
+    elif audio_format == WAVE_FORMAT_IEEE_FLOAT and bits == 64:
+        samples = np.frombuffer(buffer, dtype='<f8', count=count, offset=data_offset).astype(np.float32)
+    elif audio_format == WAVE_FORMAT_PCM and bits == 8:
+        # 8 bit wav samples are unsigned
+        samples = (np.frombuffer(buffer, dtype=np.uint8, count=count, offset=data_offset).astype(np.float32) - 128.0) / 128.0
+    elif audio_format == WAVE_FORMAT_PCM and bits == 16:
+        samples = np.frombuffer(buffer, dtype='<i2', count=count, offset=data_offset).astype(np.float32) / 32768.0
+    elif audio_format == WAVE_FORMAT_PCM and bits == 24:
+        raw = np.frombuffer(buffer, dtype=np.uint8, count=count * 3, offset=data_offset).reshape(-1, 3)
+        ints = (raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) | (raw[:, 2].astype(np.int32) << 16))
+        ints = np.where(ints >= 1 << 23, ints - (1 << 24), ints)
+        samples = ints.astype(np.float32) / 8388608.0
+    elif audio_format == WAVE_FORMAT_PCM and bits == 32:
+        samples = np.frombuffer(buffer, dtype='<i4', count=count, offset=data_offset).astype(np.float32) / 2147483648.0
+    else:
+        return None
+
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    return resample(samples, rate, sample_rate)
+
+def parse_wav_header(audio_data):
+    """
+    Find the format and the data chunk of a RIFF/WAVE file.
+
+    :param audio_data: The bytes of the audio file
+    :return: A tuple (format, channels, sample rate, bits per sample, data offset, data size) or None
+    """
+    if len(audio_data) < 12 or audio_data[0:4] != b'RIFF' or audio_data[8:12] != b'WAVE':
+        return None
+    fmt = None
+    position = 12
+    while position + 8 <= len(audio_data):
+        chunk_id = audio_data[position:position + 4]
+        chunk_size = struct.unpack_from('<I', audio_data, position + 4)[0]
+        body = position + 8
+        if chunk_id == b'fmt ' and chunk_size >= 16:
+            audio_format, channels, rate, _, _, bits = struct.unpack_from('<HHIIHH', audio_data, body)
+            if audio_format == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                # the sub format GUID starts with the actual format code
+                audio_format = struct.unpack_from('<H', audio_data, body + 24)[0]
+            fmt = (audio_format, channels, rate, bits)
+        elif chunk_id == b'data':
+            if fmt is None or fmt[1] == 0 or fmt[2] == 0 or fmt[3] == 0 or fmt[3] % 8 != 0:
+                return None
+            # streamed wav files may have a wrong data size, so limit it to the available bytes
+            data_size = min(chunk_size, len(audio_data) - body)
+            return fmt + (body, data_size)
+        # chunks are padded to an even size
+        position = body + chunk_size + (chunk_size & 1)
+    return None
+
+def resample(samples, rate, target_rate=SAMPLE_RATE):
+    """
+    Resample audio to the target rate. Integer down-sampling ratios average each block of samples,
+    all other ratios use linear interpolation.
+
+    :param samples: A float32 mono numpy array
+    :param rate: The sample rate of the samples
+    :param target_rate: The wanted sample rate
+    :return: A float32 numpy array sampled at the target rate
+    """
+    if rate == target_rate or len(samples) == 0:
+        return samples
+    if rate > target_rate and rate % target_rate == 0:
+        factor = rate // target_rate
+        usable = len(samples) - len(samples) % factor
+        return samples[:usable].reshape(-1, factor).mean(axis=1, dtype=np.float32)
+    target_length = int(round(len(samples) * target_rate / rate))
+    positions = np.arange(target_length, dtype=np.float64) * (rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
@@ -1,10 +1,16 @@
-import io, requests, tempfile
-import wave
-from flask import jsonify, request, current_app
+import io, json
+from flask import jsonify, request, current_app, Response, stream_with_context
 from flask_restx import Namespace, Resource
 from requests_toolbelt.multipart.encoder import MultipartEncoder
-import whisper
-from vosk import Model, KaldiRecognizer, SetLogLevel
+from upstream.upstream_client import openai_client, UpstreamError
+from audio.model_registry import registry, WHISPER_MODELS, VOSK_MODELS
+from audio.transcription_scheduler import scheduler
+from audio.streaming import recognizer_pool, sessions, CHUNK_FRAMES, MIN_SAMPLE_RATE, MAX_SAMPLE_RATE
+from audio.transcriber import transcribe, AudioFormatError
+from audio.transcription_cache import transcription_cache
+from audio.transcription_pool import transcription_pool, PoolSaturated
+from system.instrumentation import stage
+from system.cluster import cluster
 
 api = Namespace('api/audio', description='audio operations')
 v1api = Namespace('v1/audio', description='audio operations - OpenAI Clone')
@@ -15,92 +21,269 @@ class VoiceTranscription(Resource):
 
     # call i.e.:
     # curl -X POST http://localhost:8080/api/audio/voice/transcriptions -H "Content-Type: multipart/form-data" -F file="@test.wav" -F model="whisper-1"
+    # offline models can skip silence with voice activity detection, the response then contains
+    # a 'vad' object with the number of speech segments and the seconds of audio which were skipped:
+    # curl -X POST http://localhost:8080/api/audio/transcriptions -H "Content-Type: multipart/form-data" -F file="@test.wav" -F model="tiny" -F vad="true"
     @api.doc('voice_transcriptions')
     def post(self):
-
-        # check if openai api key is present
-        openai_api_key = request.headers.get('Authorization')
-        if openai_api_key:
-            openai_api_key = openai_api_key.replace('Bearer ', '')
-        else:
-            openai_api_key = current_app.config['OPENAI_API_KEY']
-
-        # in case that openai_api_key is not present,
-        # we fail over to a local whisper model.
-        model_name = request.form.get('model', 'tiny')
-        if not openai_api_key:
-            model_name = 'tiny'
-
         # check if file is present
         if not request.files:
             return jsonify({'error': 'No file provided'})
         audio_file = request.files['file']
-        audio_data = audio_file.read()
-        audio_name = audio_file.filename
-
-        # check if model is present and valid
-        result = {}
-
-        if openai_api_key and model_name == 'whisper-1':
-            # make an online transcription
-            headers = {'Authorization': f'Bearer {openai_api_key}'}
-            payload = MultipartEncoder(
-                fields={
-                    "file": (audio_name, io.BytesIO(audio_data), "audio/x-wav"),
-                    "model": model_name
-                }
-            )
-            headers["Content-Type"] = payload.content_type
-            response = requests.post("https://api.openai.com/v1/audio/transcriptions", headers=headers, data=payload)
-            result = response.json()
-        else:
-            # make an offline transcription
-
-            # patch model name in case no api key is present
-            if model_name == 'whisper-1': model_name = 'tiny'
-
-            # check the required technology (whisper or vosk)
-            if model_name == 'tiny' or model_name == 'base' or model_name == 'small' or model_name == 'medium' or model_name == 'large': 
-
-                # Load the offline model (it is loaded directly from the internet)
-                model = whisper.load_model(model_name)
-
-                # Save the received audio file temporarily to disk
-                with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as temp_audio_file:
-                    temp_audio_file.write(audio_data)
-                    temp_audio_file.flush()
-
-                    # Transcribe using the offline model
-                    result = model.transcribe(temp_audio_file.name)
-
-                result = {'text': result['text']}
-
-            if model_name == 'en-us' or model_name == 'de': 
-                # use vosk transcriptions
-
-                wf = wave.open(io.BytesIO(audio_data), "rb")
-                if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getcomptype() != "NONE":
-                    return jsonify({'error': 'Audio file must be WAV format mono PCM.'})
-
-                model = Model('en-us')
-                rec = KaldiRecognizer(model, wf.getframerate())
-                rec.SetWords(True)
-                rec.SetPartialWords(True)
-                
-                transcript = ""
+        with stage('read_upload'):
+            audio_data = audio_file.read()
+
+        plan = plan_transcription(request.headers.get('Authorization'), current_app.config['OPENAI_API_KEY'],
+                                  request.form.get('model'), request.form.get('vad'), audio_file.filename, audio_data,
+                                  request.headers)
+        if plan.result is not None:
+            return plan.result
+        if plan.forwarded is not None:
+            return cluster.response(plan.forwarded)
+
+        try:
+            if plan.upstream is not None:
+                # make an online transcription, the payload is sent as bytes so that it can be retried
+                headers, payload = plan.upstream
+                with stage('upstream'):
+                    result = upstream_result(openai_client.post("/v1/audio/transcriptions", headers=headers, data=payload))
+            else:
+                result = transcribe_offline(plan)
+        except TRANSCRIPTION_ERRORS as e:
+            return json_response(*transcription_error(e))
+        plan.done(result)
+        return result
+
+"""
+A transcription request is decided by plan_transcription, for the flask resource above and for
+the handler of the ASGI server alike: the model is chosen and the request is answered from the
+cache, forwarded to a peer, sent to OpenAI (plan.upstream) or transcribed offline with
+transcribe_offline. The servers only read the upload, make the upstream call and send the answer.
+"""
+class TranscriptionPlan:
+
+    def __init__(self, model_name, vad, audio_name, audio_data):
+        self.model_name = model_name
+        self.vad = vad
+        self.audio_name = audio_name
+        self.audio_data = audio_data
+        self.cache_key = None
+        # at most one of the following is set, otherwise the transcription is made offline
+        self.result = None # a cached result
+        self.forwarded = None # the response of a peer, see system.cluster
+        self.upstream = None # the headers and the body of an OpenAI transcription request
+
+    def done(self, result):
+        if self.cache_key and result and 'error' not in result:
+            transcription_cache.put(self.cache_key, result)
+
+def plan_transcription(authorization, openai_api_key, model_name, vad, audio_name, audio_data, request_headers):
+    """
+    Decide how a transcription request is answered. This may block to hash the audio and read the cache.
+
+    :param authorization: The Authorization header of the request, it may contain an OpenAI API key
+    :param openai_api_key: The configured OpenAI API key
+    :param model_name: The requested model or None
+    :param vad: The vad form field or None
+    :param request_headers: The headers of the request, a request forwarded by a peer is not forwarded again
+    :return: A TranscriptionPlan
+    """
+    # check if openai api key is present
+    if authorization:
+        openai_api_key = authorization.replace('Bearer ', '')
+
+    # in case that openai_api_key is not present,
+    # we fail over to a local whisper model.
+    model_name = model_name or 'tiny'
+    if not openai_api_key and model_name not in WHISPER_MODELS + VOSK_MODELS:
+        model_name = 'tiny'
+
+    # patch model name in case no api key is present
+    online = bool(openai_api_key) and model_name == 'whisper-1'
+    if not online and model_name == 'whisper-1': model_name = 'tiny'
+
+    # use voice activity detection to skip silence if requested
+    vad = not online and (vad or 'false').lower() in ('true', '1', 'yes')
+    plan = TranscriptionPlan(model_name, vad, audio_name, audio_data)
+
+    # identical clips are answered from the cache
+    if transcription_cache.enabled:
+        with stage('cache_lookup'):
+            plan.cache_key = transcription_cache.key(audio_data, model=model_name, vad=vad)
+            plan.result = transcription_cache.get(plan.cache_key)
+        if plan.result is not None:
+            return plan
+
+    if online:
+        plan.upstream = upstream_transcription(openai_api_key, audio_name, audio_data, model_name)
+        return plan
+
+    # a busy node hands the transcription to the least loaded peer which has the model resident
+    with stage('forward'):
+        plan.forwarded = cluster.forward('transcription', model_name, model_name in resident_models(), request_headers,
+                                         '/api/audio/transcriptions', files={'file': (audio_name, audio_data)},
+                                         data={'model': model_name, 'vad': str(vad).lower()})
+    return plan
+
+def transcribe_offline(plan):
+    """
+    Make an offline transcription with whisper or vosk, depending on the model name.
+
+    :raises AudioFormatError: if the audio cannot be decoded
+    :raises PoolSaturated: if all worker processes and queue slots are busy
+    :return: A dictionary with the transcribed 'text'
+    """
+    with stage('transcribe'):
+        if transcription_pool.enabled:
+            # decode in a worker process, reject the request if all workers and queue slots are busy
+            return transcription_pool.transcribe(plan.model_name, plan.audio_data, plan.audio_name, vad=plan.vad)
+        return transcribe(plan.model_name, plan.audio_data, plan.audio_name, vad=plan.vad)
+
+def upstream_result(response):
+    """
+    :param response: The response of an OpenAI transcription request, of requests or httpx
+    :return: The decoded result
+    """
+    try:
+        return response.json()
+    except ValueError:
+        raise UpstreamError('Invalid response from upstream', 502)
+
+# the errors of a transcription which are answered with transcription_error
+TRANSCRIPTION_ERRORS = (AudioFormatError, PoolSaturated, UpstreamError)
+
+def transcription_error(e):
+    """
+    :param e: One of TRANSCRIPTION_ERRORS
+    :return: The json body, the status code and the headers of the answer
+    """
+    if isinstance(e, AudioFormatError):
+        return {'error': str(e)}, 200, {}
+    if isinstance(e, PoolSaturated):
+        return {'error': str(e)}, 503, {'Retry-After': str(e.retry_after)}
+    return {'error': str(e)}, e.status_code, {}
 
+def resident_models():
+    """
+    :return: The names of the offline models which are loaded, in the worker processes if they are used
+    """
+    return transcription_pool.resident_models() if transcription_pool.enabled else registry.loaded_models()
+
+def upstream_transcription(openai_api_key, audio_name, audio_data, model_name):
+    """
+    :return: The headers and the multipart body of an OpenAI transcription request
+    """
+    payload = MultipartEncoder(
+        fields={
+            "file": (audio_name, io.BytesIO(audio_data), "audio/x-wav"),
+            "model": model_name
+        }
+    )
+    return {'Authorization': f'Bearer {openai_api_key}', 'Content-Type': payload.content_type}, payload.to_string()
+
+@api.route('/status.json', methods=['GET'])
+class AudioStatus(Resource):
+
+    # call i.e.:
+    # curl http://localhost:8080/api/audio/status.json
+    @api.doc('audio_status')
+    def get(self):
+        return jsonify({'models': registry.stats(), 'scheduler': scheduler.stats(),
+                        'recognizers': recognizer_pool.stats(), 'streams': sessions.stats(),
+                        'cache': transcription_cache.stats(), 'pool': transcription_pool.stats()})
+
+"""
+Streaming transcription endpoints:
+
+A client opens a session, pushes audio while it is recorded and gets the finished phrases
+('results') and the current 'partial' hypothesis back after every push. Closing the session
+returns the final transcript. Streaming uses the vosk models ('en-us', 'de'); the pushed audio
+must be raw 16 bit mono PCM with the sample rate given at session start, the first push may
+also start with a wav header.
+
+1. Open a session:
+   curl -X POST http://localhost:8080/api/audio/streams -F model="en-us" -F sample_rate=16000
+
+2. Push audio, this can be repeated as often as required:
+   curl -X POST http://localhost:8080/api/audio/streams/<id> -H "Content-Type: application/octet-stream" --data-binary @chunk.pcm
+
+   With "Accept: application/x-ndjson" the request body is consumed incrementally (i.e. when it is sent
+   with chunked transfer encoding) and one json line is returned for every processed block of audio.
+
+3. Close the session and get the final transcript:
+   curl -X DELETE http://localhost:8080/api/audio/streams/<id>
+"""
+@api.route('/streams', methods=['POST'])
+class TranscriptionStreams(Resource):
+
+    @api.doc('open_transcription_stream')
+    def post(self):
+        params = request.form if request.form else (request.get_json(silent=True) or {})
+        model_name = params.get('model', 'en-us')
+        if model_name not in VOSK_MODELS:
+            return error_response(f'Streaming is only available for the models {", ".join(VOSK_MODELS)}', 400)
+        try:
+            sample_rate = int(params.get('sample_rate', 16000))
+        except (TypeError, ValueError):
+            return error_response('Invalid sample rate', 400)
+        if not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+            return error_response(f'Invalid sample rate, use {MIN_SAMPLE_RATE} to {MAX_SAMPLE_RATE} Hz', 400)
+
+        session = sessions.create(model_name, sample_rate)
+        if session is None:
+            return error_response('Too many open streaming sessions', 503)
+        return jsonify(session.state([]))
+
+@api.route('/streams/<string:session_id>', methods=['GET', 'POST', 'DELETE'])
+class TranscriptionStream(Resource):
+
+    @api.doc('get_transcription_stream')
+    def get(self, session_id):
+        session = sessions.get(session_id)
+        if session is None:
+            return error_response('Unknown streaming session', 404)
+        return jsonify(session.state([]))
+
+    @api.doc('push_transcription_stream')
+    def post(self, session_id):
+        session = sessions.get(session_id)
+        if session is None:
+            return error_response('Unknown streaming session', 404)
+
+        stream = request.stream
+        block_size = CHUNK_FRAMES * 2
+        if request.accept_mimetypes.best == 'application/x-ndjson':
+            def generate():
                 while True:
-                    data = wf.readframes(4000)
-                    if len(data) == 0:
+                    data = stream.read(block_size)
+                    if not data:
                         break
-                    if rec.AcceptWaveform(data):
-                        result = rec.Result()
-                        transcript += result["text"]
-                    else:
-                        partial_result = rec.PartialResult()
-                        if partial_result:
-                            transcript += partial_result["partial"]
-
-                result = {'text': transcript}
-                    
-        return result
\ No newline at end of file
+                    yield json.dumps(session.push(data)) + '\n'
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        results = []
+        state = session.state([])
+        while True:
+            data = stream.read(block_size)
+            if not data:
+                break
+            state = session.push(data)
+            results.extend(state['results'])
+        state['results'] = results
+        return jsonify(state)
+
+    @api.doc('close_transcription_stream')
+    def delete(self, session_id):
+        session = sessions.remove(session_id)
+        if session is None:
+            return error_response('Unknown streaming session', 404)
+        return jsonify(session.close())
+
+def error_response(message, status_code):
+    return json_response({'error': message}, status_code)
+
+def json_response(body, status_code=200, headers=None):
+    response = jsonify(body)
+    response.status_code = status_code
+    response.headers.extend(headers or {})
+    return response
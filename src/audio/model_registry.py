@@ -0,0 +1,165 @@
+import os, time, logging, threading
+from collections import OrderedDict
+import psutil
+from system.startup import startup
+
+logger = logging.getLogger(__name__)
+
+# names of the offline models which can be loaded by the registry
+WHISPER_MODELS = ('tiny', 'base', 'small', 'medium', 'large')
+VOSK_MODELS = ('en-us', 'de')
+
+"""
+The ModelRegistry keeps offline speech models resident in the process so that
+a transcription request does not pay for loading the model weights again.
+
+- every model is loaded only once, concurrent requests for the same model wait for the first load
+- the least recently used model is evicted when more than `max_models` models are loaded
+  or when the estimated memory of all loaded models exceeds `max_memory_mb` (0 means no limit)
+- hits, misses, loads, evictions and load times are counted and can be read with stats()
+- functions given to on_evict are called with the name of every evicted model, i.e. to drop
+  the objects which were made from it and would otherwise keep its memory
+"""
+class ModelRegistry:
+
+    def __init__(self, max_models=2, max_memory_mb=0, model_path=None):
+        self.max_models = max_models
+        self.max_memory_mb = max_memory_mb
+        self.model_path = model_path
+        self._models = OrderedDict() # model name -> (model, size in bytes, load time in seconds)
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._evict_listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def configure(self, max_models=None, max_memory_mb=None, model_path=None):
+        with self._lock:
+            if max_models is not None: self.max_models = max(1, max_models)
+            if max_memory_mb is not None: self.max_memory_mb = max(0, max_memory_mb)
+            if model_path is not None: self.model_path = model_path
+            evicted = self._evict()
+        self._evicted(evicted)
+
+    def on_evict(self, listener):
+        """
+        :param listener: A function which is called with the name of every evicted model
+        """
+        self._evict_listeners.append(listener)
+
+    def get(self, model_name):
+        with self._lock:
+            entry = self._models.get(model_name)
+            if entry:
+                self._models.move_to_end(model_name)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            load_lock = self._load_locks.setdefault(model_name, threading.Lock())
+
+        with load_lock:
+            # another request may have loaded the model while we were waiting
+            with self._lock:
+                entry = self._models.get(model_name)
+                if entry:
+                    self._models.move_to_end(model_name)
+                    return entry[0]
+
+            start = time.time()
+            model, size = self._load(model_name)
+            load_time = time.time() - start
+            logger.info("Loaded model %s in %.2f s (%.1f MB)", model_name, load_time, size / 1048576.0)
+
+            with self._lock:
+                self._models[model_name] = (model, size, load_time)
+                self.loads += 1
+                self.load_seconds += load_time
+                evicted = self._evict(keep=model_name)
+            self._evicted(evicted)
+            return model
+
+    def _load(self, model_name):
+        rss = psutil.Process().memory_info().rss
+        if model_name in WHISPER_MODELS:
+            # whisper and torch are only imported when a whisper model is used
+            whisper = startup.import_module('whisper')
+            # the model is loaded directly from the internet on first use and then cached on disk
+            model = whisper.load_model(model_name)
+            size = sum(p.numel() * p.element_size() for p in model.parameters())
+            return model, size
+        if model_name in VOSK_MODELS:
+            # prefer a model which was placed in the model path, otherwise vosk downloads one for the language
+            local_path = os.path.join(self.model_path, model_name) if self.model_path else None
+            Model = startup.import_module('vosk').Model
+            if local_path and os.path.isdir(local_path):
+                model = Model(model_path=local_path)
+            else:
+                model = Model(lang=model_name)
+            size = max(0, psutil.Process().memory_info().rss - rss)
+            return model, size
+        raise ValueError(f"Unknown model {model_name}")
+
+    def _evict(self, keep=None):
+        # must be called with self._lock held, the listeners are called with _evicted after it is released
+        budget = self.max_memory_mb * 1048576
+        evicted = []
+        while len(self._models) > 1:
+            total = sum(entry[1] for entry in self._models.values())
+            if len(self._models) <= self.max_models and (budget == 0 or total <= budget):
+                break
+            victim = next((name for name in self._models if name != keep), None)
+            if victim is None:
+                break
+            del self._models[victim]
+            evicted.append(victim)
+            self.evictions += 1
+            logger.info("Evicted model %s", victim)
+        return evicted
+
+    def _evicted(self, model_names):
+        for model_name in model_names:
+            for listener in self._evict_listeners:
+                listener(model_name)
+
+    def loaded_models(self):
+        with self._lock:
+            return list(self._models)
+
+    def is_loaded(self, model_name):
+        with self._lock:
+            return model_name in self._models
+
+    def warmup(self, model_names):
+        failed = []
+        for model_name in model_names:
+            try:
+                self.get(model_name)
+            except Exception as e:
+                logger.error(f"Failed to warm up model {model_name}: {e}")
+                failed.append(model_name)
+        return failed
+
+    def stats(self):
+        with self._lock:
+            models = [{
+                "name": name,
+                "size_mb": round(size / 1048576.0, 1),
+                "load_seconds": round(load_time, 3)
+            } for name, (model, size, load_time) in self._models.items()]
+            return {
+                "models": models,
+                "memory_mb": round(sum(model["size_mb"] for model in models), 1),
+                "max_models": self.max_models,
+                "max_memory_mb": self.max_memory_mb,
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "load_seconds": round(self.load_seconds, 3)
+            }
+
+# the process-wide registry, configured in main.py
+registry = ModelRegistry()
@@ -0,0 +1,203 @@
+import json, time, uuid, logging, threading
+from system.startup import startup
+from audio.model_registry import registry
+from audio.audio_decode import parse_wav_header
+
+logger = logging.getLogger(__name__)
+
+# number of audio frames fed into a recognizer at once
+CHUNK_FRAMES = 4000
+# the sample rates which are accepted for streaming sessions
+MIN_SAMPLE_RATE, MAX_SAMPLE_RATE = 8000, 48000
+
+"""
+The RecognizerPool keeps idle vosk recognizers for each model and sample rate,
+so that a transcription or a streaming session does not create a new recognizer.
+The models are taken from the model registry and therefore loaded only once. When the registry
+evicts a model, its idle recognizers are dropped and the recognizers in use are not pooled again,
+so that they do not keep the evicted model in memory.
+"""
+class RecognizerPool:
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self._idle = {} # (model name, sample rate) -> list of recognizers
+        self._generations = {} # model name -> number of evictions of the model
+        self._in_use = {} # id of a recognizer in use -> generation of its model when it was acquired
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, model_name, sample_rate):
+        with self._lock:
+            idle = self._idle.get((model_name, sample_rate))
+            if idle:
+                self.reused += 1
+                rec = idle.pop()
+                self._in_use[id(rec)] = self._generations.get(model_name, 0)
+                return rec
+            self.created += 1
+            generation = self._generations.get(model_name, 0)
+        rec = startup.import_module('vosk').KaldiRecognizer(registry.get(model_name), sample_rate)
+        rec.SetWords(True)
+        rec.SetPartialWords(True)
+        with self._lock:
+            self._in_use[id(rec)] = generation
+        return rec
+
+    def release(self, model_name, sample_rate, rec):
+        rec.Reset()
+        with self._lock:
+            # a recognizer of an evicted model is dropped
+            if self._in_use.pop(id(rec), None) != self._generations.get(model_name, 0):
+                return
+            idle = self._idle.setdefault((model_name, sample_rate), [])
+            if len(idle) < self.max_idle:
+                idle.append(rec)
+
+    def evict(self, model_name):
+        """
+        Drop the idle recognizers of a model which was evicted from the registry.
+        """
+        with self._lock:
+            self._generations[model_name] = self._generations.get(model_name, 0) + 1
+            for key in [key for key in self._idle if key[0] == model_name]:
+                del self._idle[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "idle": sum(len(idle) for idle in self._idle.values()),
+                "created": self.created,
+                "reused": self.reused
+            }
+
+recognizer_pool = RecognizerPool()
+registry.on_evict(recognizer_pool.evict)
+
+"""
+A StreamSession is one incremental transcription: the client pushes raw 16 bit mono PCM audio
+(optionally starting with a wav header) as it is recorded and gets the finished phrases and the
+current partial hypothesis back after every push.
+"""
+class StreamSession:
+
+    def __init__(self, model_name, sample_rate):
+        self.id = uuid.uuid4().hex
+        self.model_name = model_name
+        self.sample_rate = sample_rate
+        self.rec = recognizer_pool.acquire(model_name, sample_rate)
+        self.texts = []
+        self.partial = ""
+        self.pending = b""
+        self.started = False
+        self.closed = False
+        self.last_access = time.time()
+        self.lock = threading.Lock()
+
+    def push(self, data):
+        with self.lock:
+            self.last_access = time.time()
+            if self.closed:
+                return self.state([])
+            if not self.started:
+                self.started = True
+                header = parse_wav_header(data)
+                if header:
+                    data = data[header[4]:]
+            data = self.pending + data
+            # keep an incomplete sample for the next push
+            usable = len(data) - len(data) % 2
+            self.pending = data[usable:]
+            results = []
+            step = CHUNK_FRAMES * 2
+            for offset in range(0, usable, step):
+                if self.rec.AcceptWaveform(data[offset:min(offset + step, usable)]):
+                    text = json.loads(self.rec.Result())["text"]
+                    self.partial = ""
+                    if text:
+                        results.append(text)
+                else:
+                    self.partial = json.loads(self.rec.PartialResult())["partial"]
+            self.texts.extend(results)
+            return self.state(results)
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                text = json.loads(self.rec.FinalResult())["text"]
+                if text:
+                    self.texts.append(text)
+                self.partial = ""
+                recognizer_pool.release(self.model_name, self.sample_rate, self.rec)
+            return self.state([])
+
+    def state(self, results):
+        return {
+            'id': self.id,
+            'model': self.model_name,
+            'results': results,
+            'partial': self.partial,
+            'text': ' '.join(self.texts),
+            'final': self.closed
+        }
+
+"""
+The SessionStore holds the open streaming sessions. Sessions which were not accessed
+for `timeout` seconds are closed, at most `max_sessions` can be open at the same time.
+"""
+class SessionStore:
+
+    def __init__(self, timeout=60, max_sessions=64):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self._sessions = {}
+        self._creating = 0 # sessions which are being made, they count towards max_sessions
+        self._lock = threading.Lock()
+
+    def configure(self, timeout=None, max_sessions=None):
+        if timeout is not None: self.timeout = timeout
+        if max_sessions is not None: self.max_sessions = max_sessions
+
+    def create(self, model_name, sample_rate):
+        self._expire()
+        with self._lock:
+            # the limit is checked and a slot is taken at once, so concurrent requests cannot exceed it;
+            # the session is made outside of the lock because its model may have to be loaded first
+            if len(self._sessions) + self._creating >= self.max_sessions:
+                return None
+            self._creating += 1
+        try:
+            session = StreamSession(model_name, sample_rate)
+            with self._lock:
+                self._sessions[session.id] = session
+        finally:
+            with self._lock:
+                self._creating -= 1
+        return session
+
+    def get(self, session_id):
+        self._expire()
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def remove(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [session for session in self._sessions.values() if now - session.last_access > self.timeout]
+            for session in expired:
+                del self._sessions[session.id]
+        for session in expired:
+            logger.debug("Closing idle streaming session %s", session.id)
+            session.close()
+
+    def stats(self):
+        with self._lock:
+            return {"open": len(self._sessions), "max_sessions": self.max_sessions, "timeout": self.timeout}
+
+sessions = SessionStore()
@@ -0,0 +1,101 @@
+import io, os, json, wave
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from audio.model_registry import registry, WHISPER_MODELS, VOSK_MODELS
+from audio.transcription_scheduler import scheduler
+from audio.audio_decode import load_audio, decode_wav, SAMPLE_RATE
+from audio.streaming import recognizer_pool, CHUNK_FRAMES
+from audio.vad import detect_speech
+from system.instrumentation import stage
+
+class AudioFormatError(ValueError):
+    pass
+
+# vosk recognizers release the GIL while decoding, so speech segments can be decoded in parallel threads
+segment_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='vad-segment')
+
+def transcribe(model_name, audio_data, audio_name=None, vad=False):
+    """
+    Make an offline transcription with a resident whisper or vosk model.
+
+    :param model_name: The name of a whisper model (i.e. 'tiny') or a vosk model (i.e. 'en-us')
+    :param audio_data: The bytes of the uploaded audio file
+    :param audio_name: The name of the uploaded audio file
+    :param vad: If True, silence is removed and only the detected speech segments are decoded
+    :return: A dictionary with the transcribed 'text' and, with vad, a 'vad' dictionary with metadata
+    """
+    if model_name in WHISPER_MODELS:
+        # decode the received audio in memory, only compressed formats go through ffmpeg
+        with stage('audio_decode'):
+            audio = load_audio(audio_data, audio_name)
+        if not vad:
+            return {'text': transcribe_whisper(model_name, audio)}
+        with stage('vad'):
+            segments = detect_speech(audio)
+        texts = transcribe_whisper_segments(model_name, [audio[start:end] for start, end in segments])
+        return {'text': ' '.join(text for text in texts if text), 'vad': vad_metadata(audio, segments)}
+
+    if model_name in VOSK_MODELS:
+        wf = wave.open(io.BytesIO(audio_data), "rb")
+        if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getcomptype() != "NONE":
+            raise AudioFormatError('Audio file must be WAV format mono PCM.')
+        if not vad:
+            with stage('inference'):
+                return {'text': transcribe_vosk(model_name, wf.readframes(wf.getnframes()), wf.getframerate())}
+        with stage('audio_decode'):
+            audio = decode_wav(audio_data)
+        with stage('vad'):
+            segments = detect_speech(audio)
+        pcm = (np.clip(audio, -1.0, 1.0) * 32767.0).astype('<i2')
+        with stage('inference'):
+            futures = [segment_executor.submit(transcribe_vosk, model_name, pcm[start:end].tobytes(), SAMPLE_RATE) for start, end in segments]
+            texts = [future.result() for future in futures]
+        return {'text': ' '.join(text for text in texts if text), 'vad': vad_metadata(audio, segments)}
+
+    return {}
+
+def transcribe_whisper(model_name, audio):
+    if scheduler.enabled:
+        # transcribe together with concurrent requests in one batched decode, including the wait for the batch
+        with stage('inference'):
+            return scheduler.transcribe(model_name, audio)['text']
+    # transcribe using the offline model, it is loaded only once and then kept resident
+    with stage('model_load'):
+        model = registry.get(model_name)
+    with stage('inference'):
+        return model.transcribe(audio)['text']
+
+def transcribe_whisper_segments(model_name, segments):
+    if scheduler.enabled:
+        # the segments are decoded as entries of the same batch
+        futures = [scheduler.submit(model_name, segment) for segment in segments]
+        return [future.result()['text'] for future in futures]
+    # a whisper model must not decode concurrently, torch uses all cores for each segment
+    with stage('model_load'):
+        model = registry.get(model_name)
+    with stage('inference'):
+        return [model.transcribe(segment)['text'].strip() for segment in segments]
+
+def transcribe_vosk(model_name, pcm, sample_rate):
+    # transcribe with a pooled recognizer of the resident model
+    rec = recognizer_pool.acquire(model_name, sample_rate)
+    try:
+        texts = []
+        step = CHUNK_FRAMES * 2
+        for offset in range(0, len(pcm), step):
+            if rec.AcceptWaveform(pcm[offset:offset + step]):
+                texts.append(json.loads(rec.Result())["text"])
+        texts.append(json.loads(rec.FinalResult())["text"])
+    finally:
+        recognizer_pool.release(model_name, sample_rate, rec)
+    return ' '.join(text for text in texts if text)
+
+def vad_metadata(audio, segments):
+    duration = len(audio) / SAMPLE_RATE
+    speech = sum(end - start for start, end in segments) / SAMPLE_RATE
+    return {
+        'segments': len(segments),
+        'duration_seconds': round(duration, 3),
+        'speech_seconds': round(speech, 3),
+        'skipped_seconds': round(duration - speech, 3)
+    }
@@ -0,0 +1,140 @@
+import os, json, time, hashlib, logging, threading
+from cache.lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+"""
+The TranscriptionCache stores transcription results under a hash of the audio bytes and the
+transcription parameters (model name, vad), so that a clip which is sent again is answered
+without decoding it or calling the OpenAI API again.
+
+There are two tiers:
+- an in-memory LRU cache with `max_entries` entries
+- an optional on-disk cache with json files in `path`, limited to `max_disk_mb` megabytes
+Entries of both tiers expire after `ttl` seconds (0 means no expiry).
+"""
+class TranscriptionCache:
+
+    def __init__(self, max_entries=256, ttl=86400, path=None, max_disk_mb=0):
+        self.memory = LRUCache(max_entries, ttl)
+        self.path = path
+        self.max_disk_mb = max_disk_mb
+        self._disk_bytes = None # computed on first use
+        self._disk_lock = threading.Lock()
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.disk_evictions = 0
+
+    def configure(self, max_entries=None, ttl=None, path=None, max_disk_mb=None):
+        self.memory.configure(max_entries=max_entries, ttl=ttl)
+        if path is not None: self.path = path
+        if max_disk_mb is not None: self.max_disk_mb = max(0, max_disk_mb)
+
+    @property
+    def enabled(self):
+        return self.memory.enabled or self.disk_enabled
+
+    @property
+    def disk_enabled(self):
+        return self.path is not None and self.max_disk_mb > 0
+
+    def key(self, audio_data, **params):
+        digest = hashlib.sha256(audio_data)
+        for name in sorted(params):
+            digest.update(f"\0{name}={params[name]}".encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        result = self.memory.get(key)
+        if result is not None or not self.disk_enabled:
+            return result
+
+        file_path = self._file_path(key)
+        try:
+            with open(file_path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.disk_misses += 1
+            return None
+        if self.memory.ttl and entry['created'] + self.memory.ttl < time.time():
+            self._remove_file(file_path)
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        self.memory.put(key, entry['result'])
+        return entry['result']
+
+    def put(self, key, result):
+        self.memory.put(key, result)
+        if not self.disk_enabled:
+            return
+        file_path = self._file_path(key)
+        # every writer has its own temporary file, concurrent requests for the same clip write the same entry
+        temp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            data = json.dumps({'created': time.time(), 'result': result})
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            os.replace(temp_path, file_path)
+        except OSError as e:
+            logger.error(f"Failed to write transcription cache entry {key}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self._disk_lock:
+            self._disk_bytes = self._scan_size() if self._disk_bytes is None else self._disk_bytes + len(data)
+            if self._disk_bytes > self.max_disk_mb * 1048576:
+                self._shrink()
+
+    def _file_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def _files(self):
+        for directory, _, files in os.walk(self.path):
+            for file in files:
+                if file.endswith('.json'):
+                    yield os.path.join(directory, file)
+
+    def _scan_size(self):
+        return sum(os.path.getsize(file) for file in self._files())
+
+    def _remove_file(self, file_path):
+        try:
+            size = os.path.getsize(file_path)
+            os.remove(file_path)
+        except OSError:
+            return
+        with self._disk_lock:
+            if self._disk_bytes is not None: self._disk_bytes -= size
+
+    def _shrink(self):
+        # must be called with self._disk_lock held; remove the oldest files until 90% of the limit is reached
+        files = sorted(((os.path.getmtime(file), os.path.getsize(file), file) for file in self._files()))
+        total = sum(size for _, size, _ in files)
+        limit = self.max_disk_mb * 1048576 * 0.9
+        for _, size, file in files:
+            if total <= limit:
+                break
+            try:
+                os.remove(file)
+                total -= size
+                self.disk_evictions += 1
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats.update({
+            "disk_enabled": self.disk_enabled,
+            "disk_mb": round((self._disk_bytes or 0) / 1048576.0, 3),
+            "max_disk_mb": self.max_disk_mb,
+            "disk_hits": self.disk_hits,
+            "disk_misses": self.disk_misses,
+            "disk_evictions": self.disk_evictions
+        })
+        return stats
+
+# the process-wide cache, configured in main.py
+transcription_cache = TranscriptionCache()
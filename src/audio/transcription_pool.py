@@ -0,0 +1,197 @@
+import os, sys, time, logging, threading, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+class PoolSaturated(Exception):
+    def __init__(self, retry_after, message='Transcription queue is full'):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+"""
+The TranscriptionPool runs offline transcriptions in worker processes, so that CPU-bound decoding
+escapes the GIL and does not compete with the waitress threads serving the other endpoints.
+
+- every worker process holds its own model registry with resident models
+- workers are pinned to their own share of the CPU cores
+- at most `workers + max_queue` transcriptions are admitted at once, further requests are
+  rejected with PoolSaturated so that the caller can answer with 503 and Retry-After
+- the workers batch the whisper segments of a transcription like the scheduler of the server
+- if a worker process dies (i.e. out of memory or a crash of a native decoder) the pool is
+  started again; the transcriptions which were in progress fail with PoolSaturated
+"""
+class TranscriptionPool:
+
+    def __init__(self):
+        self.workers = 0
+        self.max_queue = 0
+        self._executor = None
+        self._initargs = None
+        self._slots = None
+        self._started = []
+        self.models = set() # models loaded by the workers at start or used since
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.avg_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self._executor is not None
+
+    def start(self, workers, max_queue, pin_cores=True, max_models=None, max_memory_mb=None, model_path=None, warmup_models=(),
+              max_batch_size=None, max_wait_ms=None):
+        """
+        :param max_batch_size: The batch size of the transcription scheduler in the workers
+        :param max_wait_ms: The batch wait time of the transcription scheduler in the workers
+        """
+        cpu_count = os.cpu_count() or 1
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        cores_per_worker = max(1, cpu_count // self.workers)
+        self._initargs = (cores_per_worker if pin_cores else 0, max_models, max_memory_mb, model_path, list(warmup_models),
+                          max_batch_size, max_wait_ms)
+        self._executor = self._create_executor()
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_queue)
+        self.models = set(warmup_models)
+        logger.info("Started %d transcription worker processes", self.workers)
+
+    def _create_executor(self):
+        context = multiprocessing.get_context('spawn')
+        # the workers count themselves to choose their cores
+        counter = context.Value('i', 0)
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker,
+                                       initargs=(list(sys.path), counter) + self._initargs)
+        # start all workers now so that they load their models before the first request arrives
+        self._started = [executor.submit(_noop) for _ in range(self.workers)]
+        return executor
+
+    def _restart(self, broken):
+        with self._lock:
+            # only the first of the transcriptions which failed with the broken pool starts a new one
+            if self._executor is not broken:
+                return
+            self._executor = self._create_executor()
+            self.restarts += 1
+        logger.error("A transcription worker process died, the worker processes were started again")
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def wait_started(self):
+        """
+        Wait until all worker processes are started and have loaded their warm-up models.
+
+        :return: An empty list, the worker processes log the models which failed to load
+        """
+        for future in self._started:
+            future.result()
+        return []
+
+    def transcribe(self, model_name, audio_data, audio_name=None, vad=False):
+        """
+        Transcribe in a worker process and wait for the result.
+
+        :raises PoolSaturated: if the queue is full or a worker process died
+        :return: A dictionary with the transcribed 'text', see audio.transcriber.transcribe
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PoolSaturated(self.retry_after())
+        with self._lock:
+            self.in_flight += 1
+        start = time.time()
+        executor = self._executor
+        try:
+            result = executor.submit(_transcribe_job, model_name, audio_data, audio_name, vad).result()
+            with self._lock:
+                self.completed += 1
+                self.models.add(model_name)
+                # exponential moving average of the job duration, used for Retry-After
+                duration = time.time() - start
+                self.avg_seconds = duration if self.completed == 1 else 0.9 * self.avg_seconds + 0.1 * duration
+            return result
+        except BrokenProcessPool:
+            with self._lock:
+                self.failed += 1
+            self._restart(executor)
+            raise PoolSaturated(self.retry_after(), 'A transcription worker failed, please retry')
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def resident_models(self):
+        # the workers do not report evictions, a model which was loaded once counts as resident
+        with self._lock:
+            return list(self.models)
+
+    def retry_after(self):
+        with self._lock:
+            # the time until the current queue is drained by all workers
+            return max(1, int(round(self.avg_seconds * self.in_flight / max(1, self.workers))))
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queued": max(0, self.in_flight - self.workers),
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "restarts": self.restarts,
+                "avg_seconds": round(self.avg_seconds, 3)
+            }
+
+# worker process functions, these must be importable by the spawned processes
+
+def _init_worker(path, counter, cores_per_worker, max_models, max_memory_mb, model_path, warmup_models, max_batch_size, max_wait_ms):
+    sys.path[:] = path
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+
+    if cores_per_worker > 0 and hasattr(os, 'sched_setaffinity'):
+        cpu_count = os.cpu_count() or 1
+        first = (index * cores_per_worker) % cpu_count
+        cores = {(first + i) % cpu_count for i in range(cores_per_worker)}
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError as e:
+            logger.warning(f"Could not pin transcription worker {index} to cores {cores}: {e}")
+        try:
+            import torch
+            torch.set_num_threads(cores_per_worker)
+        except ImportError:
+            pass
+
+    from audio.model_registry import registry
+    from audio.transcription_scheduler import scheduler
+    registry.configure(max_models=max_models, max_memory_mb=max_memory_mb, model_path=model_path)
+    scheduler.configure(max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    registry.warmup(warmup_models)
+
+def _noop():
+    return None
+
+def _transcribe_job(model_name, audio_data, audio_name, vad):
+    from audio.transcriber import transcribe
+    return transcribe(model_name, audio_data, audio_name, vad=vad)
+
+# the process-wide pool, started in main.py if worker processes are configured
+transcription_pool = TranscriptionPool()
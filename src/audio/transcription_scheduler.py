@@ -0,0 +1,128 @@
+import time, logging, threading
+from collections import deque
+from concurrent.futures import Future
+from audio.model_registry import registry
+from system.startup import startup
+
+logger = logging.getLogger(__name__)
+
+"""
+The TranscriptionScheduler batches concurrent offline whisper transcriptions.
+
+Requests for the same model are collected in a queue. A worker thread for that model waits
+until `max_batch_size` audio segments are queued or the oldest segment waited `max_wait_ms`,
+computes the log-mel spectrograms of all segments, runs one batched decode and hands the
+texts back to the waiting request handlers.
+Audio longer than the whisper window of 30 seconds is split into 30 second segments which are
+decoded as independent batch entries and joined again afterwards.
+
+With `max_batch_size` 1 the scheduler is disabled and transcriptions run inline.
+"""
+class TranscriptionScheduler:
+
+    def __init__(self, max_batch_size=1, max_wait_ms=50):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queues = {} # model name -> deque of (job, segment index, audio, enqueue time)
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._workers = {}
+        self.max_queue_depth = 0
+        self.batches = 0
+        self.segments = 0
+        self.wait_seconds = 0.0
+        self.batch_sizes = {} # histogram: batch size -> number of batches
+
+    def configure(self, max_batch_size=None, max_wait_ms=None):
+        with self._lock:
+            if max_batch_size is not None: self.max_batch_size = max(1, max_batch_size)
+            if max_wait_ms is not None: self.max_wait_ms = max(0, max_wait_ms)
+
+    @property
+    def enabled(self):
+        return self.max_batch_size > 1
+
+    def transcribe(self, model_name, audio):
+        """
+        Transcribe the audio with the given whisper model, waiting for the batched result.
+
+        :param model_name: The name of the whisper model, i.e. 'tiny'
+        :param audio: A float32 numpy array with mono audio sampled at 16 kHz
+        :return: A dictionary with the transcribed 'text'
+        """
+        return self.submit(model_name, audio).result()
+
+    def submit(self, model_name, audio):
+        whisper = startup.import_module('whisper')
+        segments = [audio[i:i + whisper.audio.N_SAMPLES] for i in range(0, max(len(audio), 1), whisper.audio.N_SAMPLES)]
+        job = {'future': Future(), 'texts': [None] * len(segments), 'remaining': len(segments)}
+        now = time.time()
+        with self._condition:
+            queue = self._queues.setdefault(model_name, deque())
+            for index, segment in enumerate(segments):
+                queue.append((job, index, segment, now))
+            self.max_queue_depth = max(self.max_queue_depth, self._queue_depth())
+            if model_name not in self._workers:
+                worker = threading.Thread(target=self._work, args=(model_name,), daemon=True)
+                self._workers[model_name] = worker
+                worker.start()
+            self._condition.notify_all()
+        return job['future']
+
+    def _queue_depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _work(self, model_name):
+        queue = self._queues[model_name]
+        while True:
+            with self._condition:
+                while not queue:
+                    self._condition.wait()
+                # wait until the batch is full or the oldest entry has waited long enough
+                deadline = queue[0][3] + self.max_wait_ms / 1000.0
+                while len(queue) < self.max_batch_size and time.time() < deadline:
+                    self._condition.wait(deadline - time.time())
+                batch = [queue.popleft() for _ in range(min(len(queue), self.max_batch_size))]
+                now = time.time()
+                self.batches += 1
+                self.segments += len(batch)
+                self.wait_seconds += sum(now - entry[3] for entry in batch)
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+
+            try:
+                texts = self._decode(model_name, [entry[2] for entry in batch])
+            except Exception as e:
+                logger.error(f"Batched transcription with model {model_name} failed: {e}")
+                for job, index, segment, enqueued in batch:
+                    if not job['future'].done(): job['future'].set_exception(e)
+                continue
+
+            for (job, index, segment, enqueued), text in zip(batch, texts):
+                job['texts'][index] = text
+                job['remaining'] -= 1
+                if job['remaining'] == 0 and not job['future'].done():
+                    job['future'].set_result({'text': ' '.join(t.strip() for t in job['texts'] if t.strip())})
+
+    def _decode(self, model_name, segments):
+        model = registry.get(model_name)
+        torch, whisper = startup.import_module('torch'), startup.import_module('whisper')
+        mel = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(segment)) for segment in segments])
+        options = whisper.DecodingOptions(fp16=model.device.type == 'cuda')
+        results = whisper.decode(model, mel.to(model.device), options)
+        return [result.text for result in results]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_ms,
+                "queue_depth": self._queue_depth(),
+                "max_queue_depth": self.max_queue_depth,
+                "batches": self.batches,
+                "segments": self.segments,
+                "avg_wait_ms": round(1000.0 * self.wait_seconds / self.segments, 1) if self.segments else 0.0,
+                "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())}
+            }
+
+# the process-wide scheduler, configured in main.py
+scheduler = TranscriptionScheduler()
@@ -0,0 +1,85 @@
+import numpy as np
+from audio.audio_decode import SAMPLE_RATE
+
+"""
+Energy based voice activity detection.
+
+The audio is cut into frames of `frame_ms` milliseconds and the energy of every frame is
+computed in one vectorized step. Frames louder than an adaptive threshold between the noise
+floor and the loudest part of the recording count as speech. Pauses shorter than
+`min_silence_ms` are bridged, speech shorter than `min_speech_ms` is dropped, every segment is
+padded by `padding_ms` and segments longer than `max_segment_s` are split at their quietest frame.
+"""
+
+def detect_speech(audio, sample_rate=SAMPLE_RATE, frame_ms=30, min_speech_ms=250, min_silence_ms=500,
+                  padding_ms=200, max_segment_s=30):
+    """
+    Find the speech segments in an audio recording.
+
+    :param audio: A float32 mono numpy array
+    :param sample_rate: The sample rate of the audio
+    :return: A list of (start, end) sample positions of the speech segments
+    """
+    frame = sample_rate * frame_ms // 1000
+    count = len(audio) // frame
+    if count == 0:
+        return [(0, len(audio))] if len(audio) > 0 else []
+
+    frames = audio[:count * frame].reshape(count, frame)
+    energy = 10.0 * np.log10(np.mean(np.square(frames, dtype=np.float32), axis=1) + 1e-10)
+    noise_floor = np.percentile(energy, 10)
+    peak = np.percentile(energy, 99)
+    threshold = max(noise_floor + 0.3 * (peak - noise_floor), -60.0)
+    speech = energy > threshold
+    if peak - noise_floor < 6.0:
+        # no contrast between speech and background: either all silence or all speech
+        speech[:] = peak > -50.0
+
+    # bridge short pauses and drop short noises
+    speech = _fill_runs(speech, False, max(1, min_silence_ms // frame_ms))
+    speech = _fill_runs(speech, True, max(1, min_speech_ms // frame_ms))
+
+    padding = padding_ms // frame_ms
+    max_frames = max(1, max_segment_s * 1000 // frame_ms)
+    segments = []
+    for start, end in _runs(speech, True):
+        start = max(0, start - padding)
+        end = min(count, end + padding)
+        if segments and start <= segments[-1][1]:
+            segments[-1] = (segments[-1][0], end)
+        else:
+            segments.append((start, end))
+
+    result = []
+    for start, end in segments:
+        # split long segments at the quietest frame in the second half of the allowed length
+        while end - start > max_frames:
+            window = energy[start + max_frames // 2:start + max_frames]
+            cut = start + max_frames // 2 + int(np.argmin(window))
+            result.append((start, cut))
+            start = cut
+        result.append((start, end))
+
+    # the last frame is extended to the end of the audio
+    return [(int(start) * frame, len(audio) if end == count else int(end) * frame) for start, end in result]
+
+def _runs(mask, value):
+    """
+    Find the runs of the given value in a boolean array.
+
+    :return: A list of (start, end) index pairs, end is exclusive
+    """
+    padded = np.concatenate(([not value], mask, [not value]))
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(changes[0::2], changes[1::2]))
+
+def _fill_runs(mask, value, min_length):
+    """
+    Invert the runs of the given value which are shorter than min_length,
+    runs touching the start or the end of the array are kept.
+    """
+    mask = mask.copy()
+    for start, end in _runs(mask, value):
+        if end - start < min_length and start > 0 and end < len(mask):
+            mask[start:end] = not value
+    return mask
@@ -0,0 +1,83 @@
+import time, threading
+from collections import OrderedDict
+
+"""
+A thread-safe in-memory LRU cache where every entry expires after `ttl` seconds.
+`max_entries` 0 disables the cache, `ttl` 0 keeps entries until they are evicted.
+"""
+class LRUCache:
+
+    def __init__(self, max_entries=256, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (value, expiry time)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def configure(self, max_entries=None, ttl=None):
+        with self._lock:
+            if max_entries is not None: self.max_entries = max(0, max_entries)
+            if ttl is not None: self.ttl = max(0, ttl)
+            self._evict()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries == 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl if self.ttl else 0)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        # must be called with self._lock held
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
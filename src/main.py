@@ -1,15 +1,77 @@
 import sys
 sys.path.insert(0, './src')
 
+# the startup report measures the imports from here on
+from system.startup import startup, READY
+
 import os, argparse, logging
 from flask import Flask
 from waitress import serve
 from flask_cors import CORS
 from flask_restx import Api
-from text.text_service import api as text_ns
-from audio.audio_service import api as audio_ns, v1api as v1audio_ns
-from share.share_service import api as share_ns
-from system.system_service import api as system_ns
+from system.system_service import api as system_ns, addStatusProvider, getStatusJson
+from system.instrumentation import request_metrics
+from system.metrics_sampler import metrics_sampler
+
+# the namespaces of the services which can be enabled with --services; the modules of a
+# service, and the machine learning libraries they use, are only imported if it is enabled
+SERVICES = {
+    'share': ('share.share_service', ('api',)),
+    'text': ('text.text_service', ('api',)),
+    'audio': ('audio.audio_service', ('api', 'v1api'))
+}
+
+parser = argparse.ArgumentParser(description="Load a model and save it as prepared model for finetuning")
+parser.add_argument("--port", default="8080", type=str, help="server port, default 8080")
+parser.add_argument("--host", default="0.0.0.0", type=str, help="bind address, default 0.0.0.0")
+parser.add_argument("--susi_api_key", default=os.environ.get('SUSI_API_KEY', default=''), type=str, help="SUSI API key")
+parser.add_argument("--openai_api_key", default=os.environ.get('OPENAI_API_KEY', default=''), type=str, help="OpenAI API key")
+parser.add_argument("--model_cache_size", default=2, type=int, help="number of offline speech models kept in memory, default 2")
+parser.add_argument("--model_memory_mb", default=0, type=int, help="memory budget for offline speech models in MB, default 0 (no limit)")
+parser.add_argument("--warmup_models", default="", type=str, help="comma-separated list of speech and chat models loaded at startup, i.e. tiny,en-us")
+parser.add_argument("--whisper_batch_size", default=1, type=int, help="maximum number of audio segments decoded together by whisper, default 1 (no batching)")
+parser.add_argument("--whisper_batch_wait_ms", default=50, type=int, help="maximum time a transcription waits for a batch to fill in ms, default 50")
+parser.add_argument("--stream_timeout", default=60, type=int, help="seconds after which an idle streaming transcription is closed, default 60")
+parser.add_argument("--max_streams", default=64, type=int, help="maximum number of open streaming transcriptions, default 64")
+parser.add_argument("--transcription_cache_size", default=256, type=int, help="number of transcription results cached in memory, default 256 (0 disables the memory cache)")
+parser.add_argument("--transcription_cache_ttl", default=86400, type=int, help="seconds a cached transcription is valid, default 86400 (0 means forever)")
+parser.add_argument("--transcription_cache_disk_mb", default=0, type=int, help="size of the on-disk transcription cache in MB, default 0 (disabled)")
+parser.add_argument("--server", default="waitress", choices=("waitress", "asgi"), help="waitress (a thread per request) or asgi (uvicorn, asynchronous chats, transcriptions and downloads), default waitress")
+parser.add_argument("--threads", default=8, type=int, help="number of waitress worker threads; with --server asgi the number of threads for blocking work and for the other endpoints; default 8")
+parser.add_argument("--transcription_workers", default=0, type=int, help="number of worker processes for offline transcriptions, default 0 (transcribe in the request thread)")
+parser.add_argument("--transcription_queue", default=4, type=int, help="number of transcriptions which may wait for a worker process before requests are rejected with 503, default 4")
+parser.add_argument("--no_pin_cores", action="store_true", help="do not pin transcription worker processes to cpu cores")
+parser.add_argument("--openai_api_base", default=os.environ.get('OPENAI_API_BASE', default='https://api.openai.com'), type=str, help="base URL of the OpenAI API, default https://api.openai.com")
+parser.add_argument("--upstream_connect_timeout", default=5.0, type=float, help="connect timeout for upstream API calls in seconds, default 5")
+parser.add_argument("--upstream_read_timeout", default=120.0, type=float, help="read timeout for upstream API calls in seconds, default 120")
+parser.add_argument("--upstream_retries", default=2, type=int, help="number of retries for failed upstream API calls, default 2")
+parser.add_argument("--upstream_max_concurrency", default=16, type=int, help="maximum number of concurrent calls to an upstream API, default 16")
+parser.add_argument("--chat_models", default="", type=str, help="comma-separated list of local chat models as name=path or path of a transformers model, relative to data/protected/model")
+parser.add_argument("--chat_batch_size", default=4, type=int, help="maximum number of chats decoded together by a local chat model, default 4")
+parser.add_argument("--embedding_model", default="", type=str, help="path of a transformers sentence embedding model for semantic search reranking, relative to data/protected/model; default none (lexical search only)")
+parser.add_argument("--chat_prefix_cache_size", default=8, type=int, help="number of prompt key/value caches kept per local chat model to reuse shared prompt prefixes, default 8 (0 disables)")
+parser.add_argument("--chat_cache_size", default=256, type=int, help="number of chat completions of temperature 0 requests cached in memory, default 256 (0 disables)")
+parser.add_argument("--chat_cache_ttl", default=3600, type=int, help="seconds a cached chat completion is valid, default 3600 (0 means forever)")
+parser.add_argument("--metrics_interval", default=5.0, type=float, help="seconds between two samples of the system metrics in status.json, default 5 (0 samples on every request)")
+parser.add_argument("--peers", default=os.environ.get('SUSI_PEERS', default=''), type=str, help="comma-separated list of the base URLs of peer nodes which take over transcriptions and chats when this node is busy, i.e. http://localhost:8082; default none (no cluster mode)")
+parser.add_argument("--cluster_interval", default=5.0, type=float, help="seconds between two polls of the status of a peer, default 5")
+parser.add_argument("--cluster_busy", default=0.8, type=float, help="load (used share of the cpu cores or requests per core) from which on requests are forwarded to less loaded peers, default 0.8")
+parser.add_argument("--services", default=os.environ.get('SUSI_SERVICES', default='all'), type=str, help="comma-separated list of the enabled services share, text and audio, default all; the system service is always enabled")
+
+def parse_services(value):
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    if names == ['all']:
+        return list(SERVICES)
+    unknown = [name for name in names if name not in SERVICES and name != 'system']
+    if unknown:
+        parser.error(f"unknown services: {', '.join(unknown)}")
+    return [name for name in SERVICES if name in names]
+
+# the namespaces are added when this module is imported, so the arguments are parsed here;
+# when the module is imported by another program, i.e. the benchmark, the defaults are used
+args = parser.parse_args() if __name__ == '__main__' else parser.parse_args([])
+services = parse_services(args.services)
+startup.mark('imports')
 
 openai_api_key = ""
 app = Flask(__name__)
@@ -41,11 +103,18 @@ app.config['SCRIPT_PATH'] = script_path
 app.config['WORK_PATH']   = work_path
 
 api = Api(app, version='1.0', title='susi_api', doc='/api/docs/')
-api.add_namespace(share_ns)
-api.add_namespace(text_ns)
-api.add_namespace(audio_ns)
-api.add_namespace(v1audio_ns)
+for service in services:
+    module_name, namespaces = SERVICES[service]
+    module = startup.import_module(module_name)
+    for namespace in namespaces:
+        api.add_namespace(getattr(module, namespace))
+    startup.set_state(service, READY)
 api.add_namespace(system_ns)
+startup.set_state('system', READY)
+addStatusProvider('startup', startup.stats)
+
+# latency, status codes and stages of all requests, exported on /metrics in the Prometheus format
+request_metrics.init_app(app, status=getStatusJson)
 
 def check_route_conflicts(app):
     # Getting all routes and their endpoints
@@ -69,16 +138,110 @@ def check_route_conflicts(app):
 
 # Run the conflict check
 check_route_conflicts(app)
+startup.mark('services')
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Load a model and save it as prepared model for finetuning")
-    parser.add_argument("--port", default="8080", type=str, help="server port, default 8080")
-    parser.add_argument("--host", default="0.0.0.0", type=str, help="bind address, default 0.0.0.0")
-    parser.add_argument("--susi_api_key", default=os.environ.get('SUSI_API_KEY', default=''), type=str, help="SUSI API key")
-    parser.add_argument("--openai_api_key", default=os.environ.get('OPENAI_API_KEY', default=''), type=str, help="OpenAI API key")
-    args = parser.parse_args()
-
     app.config['SUSI_API_KEY'] = args.susi_api_key
     app.config['OPENAI_API_KEY'] = args.openai_api_key
+    model_path = os.path.join(data_path, "protected", "model")
+    warmup_models = [name.strip() for name in args.warmup_models.split(",") if name.strip()]
+
+    if 'text' in services or 'audio' in services:
+        from upstream.upstream_client import openai_client, async_openai_client
+        from system.cluster import cluster
+
+        # pooled keep-alive connections to the OpenAI API with timeouts, retries and a concurrency limit
+        openai_client.configure(base_url=args.openai_api_base, connect_timeout=args.upstream_connect_timeout,
+                                read_timeout=args.upstream_read_timeout, retries=args.upstream_retries,
+                                pool_size=args.upstream_max_concurrency, max_concurrency=args.upstream_max_concurrency)
+        addStatusProvider('upstream', openai_client.stats)
+        if args.server == 'asgi':
+            async_openai_client.configure(base_url=args.openai_api_base, connect_timeout=args.upstream_connect_timeout,
+                                          read_timeout=args.upstream_read_timeout, retries=args.upstream_retries,
+                                          pool_size=args.upstream_max_concurrency, max_concurrency=args.upstream_max_concurrency)
+            addStatusProvider('upstream_async', async_openai_client.stats)
+
+        # every node publishes its load and resident models, with peers a busy node forwards requests to them
+        addStatusProvider('cluster', cluster.stats)
+        peers = [url.strip() for url in args.peers.split(",") if url.strip()]
+        if peers:
+            cluster.configure(peers=peers, interval=args.cluster_interval, busy=args.cluster_busy,
+                              read_timeout=args.upstream_read_timeout)
+            cluster.start()
+
+    if 'text' in services:
+        from text.chat_backends import local_models
+        from text.chat_cache import chat_cache
+
+        # local chat models are loaded once and kept resident
+        local_models.configure(args.chat_models, model_path=model_path, max_batch_size=args.chat_batch_size,
+                               prefix_cache_size=args.chat_prefix_cache_size)
+        warmup_chat_models = [name for name in warmup_models if name in local_models.paths]
+        warmup_models = [name for name in warmup_models if name not in local_models.paths]
+        if warmup_chat_models:
+            startup.warm_up('chat_models', local_models.warmup, warmup_chat_models)
+
+        # answer repeated deterministic chats from the chat cache
+        chat_cache.configure(max_entries=args.chat_cache_size, ttl=args.chat_cache_ttl)
+        addStatusProvider('chat_cache', chat_cache.stats)
+        addStatusProvider('chat_models', local_models.stats)
+        cluster.add_models('chat', local_models.loaded_models)
+
+    if 'audio' in services:
+        from audio.model_registry import registry as model_registry
+        from audio.transcription_scheduler import scheduler as transcription_scheduler
+        from audio.streaming import sessions as stream_sessions
+        from audio.transcription_cache import transcription_cache
+        from audio.transcription_pool import transcription_pool
+        from audio.audio_service import resident_models
+
+        # keep offline speech models resident and load the requested ones in the background
+        model_registry.configure(max_models=args.model_cache_size, max_memory_mb=args.model_memory_mb, model_path=model_path)
+        if args.transcription_workers > 0:
+            # offline transcriptions run in worker processes which hold their own resident models;
+            # keep workers + queue below the number of threads so that other endpoints stay responsive
+            transcription_pool.start(args.transcription_workers, args.transcription_queue, pin_cores=not args.no_pin_cores,
+                                     max_models=args.model_cache_size, max_memory_mb=args.model_memory_mb,
+                                     model_path=model_path, warmup_models=warmup_models,
+                                     max_batch_size=args.whisper_batch_size, max_wait_ms=args.whisper_batch_wait_ms)
+            startup.warm_up('transcription_workers', transcription_pool.wait_started)
+        elif warmup_models:
+            startup.warm_up('speech_models', model_registry.warmup, warmup_models)
+
+        # batch concurrent whisper transcriptions of the same model
+        transcription_scheduler.configure(max_batch_size=args.whisper_batch_size, max_wait_ms=args.whisper_batch_wait_ms)
+        stream_sessions.configure(timeout=args.stream_timeout, max_sessions=args.max_streams)
+
+        # answer repeated clips from the transcription cache
+        transcription_cache.configure(max_entries=args.transcription_cache_size, ttl=args.transcription_cache_ttl,
+                                      path=os.path.join(data_path, "protected", "cache", "transcriptions"),
+                                      max_disk_mb=args.transcription_cache_disk_mb)
+        addStatusProvider('transcription_cache', transcription_cache.stats)
+        cluster.add_models('transcription', resident_models)
+
+    if 'share' in services:
+        from share.search_index import search_indexes
+        from share.search_embeddings import document_embeddings
+
+        addStatusProvider('search_index', search_indexes.stats)
+        # rerank search results semantically if an embedding model is given
+        if args.embedding_model:
+            document_embeddings.configure(model_path=os.path.join(model_path, args.embedding_model))
+            addStatusProvider('search_embeddings', document_embeddings.stats)
+
+    # sample the system metrics in the background, status.json serves the latest sample
+    metrics_sampler.configure(interval=args.metrics_interval)
+    metrics_sampler.start()
 
-    serve(app, host=args.host, port=args.port, threads=8)
+    if args.server == 'asgi':
+        # the asynchronous server keeps slow upstream calls and downloads off the threads
+        import uvicorn
+        from asgi_app import create_asgi_app
+        asgi_app = create_asgi_app(app, threads=args.threads)
+        startup.mark('configure')
+        startup.served()
+        uvicorn.run(asgi_app, host=args.host, port=int(args.port), log_level="info")
+    else:
+        startup.mark('configure')
+        startup.served()
+        serve(app, host=args.host, port=args.port, threads=args.threads)
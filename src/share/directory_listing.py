@@ -0,0 +1,160 @@
+import os, json, time, base64, bisect
+from cache.lru_cache import LRUCache
+
+SORT_KEYS = ('name', 'size', 'mtime', 'atime')
+MAX_RECURSIVE_ENTRIES = 100000
+
+"""
+Cached directory listings.
+
+A directory is read with os.scandir and the stat result of every entry is taken from its
+directory entry. The listing is cached together with the mtime of the directory; every request
+revalidates it with a single stat call, and uploads and deletes through the data endpoints
+invalidate it explicitly. Sorted orders are cached with the listing.
+
+Listings are paginated with a cursor: a page ends with the opaque `next_cursor`, which is the
+sort key of its last entry, and the next page starts after that key. Entries which are added or
+removed between two requests therefore neither shift nor repeat the following pages.
+A recursive listing combines the cached listings of all subdirectories; the names are then paths
+relative to the listed directory.
+"""
+
+class Listing:
+
+    def __init__(self, mtime_ns, entries):
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self.sorted = {} # sort key -> (entries sorted ascending, their sort keys)
+
+    def sorted_by(self, sort):
+        result = self.sorted.get(sort)
+        if result is None:
+            result = _sort(self.entries, sort)
+            self.sorted[sort] = result
+        return result
+
+class DirectoryListings:
+
+    def __init__(self, max_directories=1024):
+        self.cache = LRUCache(max_directories)
+
+    def listing(self, path):
+        """
+        :param path: The absolute path of a directory
+        :return: The current Listing of the directory
+        """
+        mtime_ns = os.stat(path).st_mtime_ns
+        listing = self.cache.get(path)
+        if listing is not None and listing.mtime_ns == mtime_ns:
+            return listing
+        entries = []
+        with os.scandir(path) as scanner:
+            for entry in scanner:
+                try:
+                    stats = entry.stat()
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue # i.e. a broken symbolic link or a file deleted while scanning
+                entries.append({
+                    "name": entry.name, # file name
+                    "type": "dir" if is_dir else "file",
+                    "size": stats.st_size, # file size in bytes
+                    "atime": int(stats.st_atime * 1000), # access time in millisonde since epoch
+                    "mtime": int(stats.st_mtime * 1000), # modified time in millisonde since epoch
+                    "last_accessed": time.ctime(stats.st_atime),
+                    "last_modified": time.ctime(stats.st_mtime)
+                })
+        listing = Listing(mtime_ns, entries)
+        self.cache.put(path, listing)
+        return listing
+
+    def list(self, path, sort='name', descending=False, limit=None, cursor=None, recursive=False):
+        """
+        List a page of a directory.
+
+        :param path: The absolute path of a directory
+        :param sort: One of SORT_KEYS
+        :param descending: True to sort in descending order
+        :param limit: The maximum number of entries or None for all entries
+        :param cursor: The next_cursor of the previous page or None for the first page
+        :param recursive: True to list all subdirectories as well
+        :return: A dictionary with the entries in 'dir', the number of all entries in 'total' and
+                 'next_cursor' if there are more entries
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Invalid sort key, use one of {', '.join(SORT_KEYS)}")
+        if recursive:
+            entries, keys = _sort(self._walk(path), sort)
+        else:
+            entries, keys = self.listing(path).sorted_by(sort)
+
+        # the entries after the cursor, in ascending order they follow it, in descending order they precede it
+        if cursor is not None:
+            key = _decode_cursor(cursor, sort)
+            end = bisect.bisect_left(keys, key) if descending else len(entries)
+            start = 0 if descending else bisect.bisect_right(keys, key)
+        else:
+            start, end = 0, len(entries)
+        if limit is None:
+            limit = end - start
+        page = entries[max(start, end - limit):end][::-1] if descending else entries[start:start + limit]
+        result = {'dir': page, 'total': len(entries)}
+        remaining = (end - start) - len(page)
+        if page and remaining > 0:
+            result['next_cursor'] = _encode_cursor(_key(page[-1], sort))
+        return result
+
+    def invalidate(self, path, data_path=None):
+        """
+        Drop the cached listings of a directory and its parents up to the data path.
+        """
+        while True:
+            self.cache.remove(path)
+            parent = os.path.dirname(path)
+            if not data_path or parent == path or not parent.startswith(data_path):
+                break
+            path = parent
+
+    def _walk(self, path):
+        entries, directories = [], [('', path)]
+        while directories and len(entries) < MAX_RECURSIVE_ENTRIES:
+            prefix, directory = directories.pop()
+            try:
+                listing = self.listing(directory)
+            except OSError:
+                continue
+            for entry in listing.entries:
+                name = prefix + entry['name']
+                entries.append(dict(entry, name=name))
+                if entry['type'] == 'dir' and not os.path.islink(os.path.join(directory, entry['name'])):
+                    directories.append((name + '/', os.path.join(directory, entry['name'])))
+        return entries[:MAX_RECURSIVE_ENTRIES]
+
+def _key(entry, sort):
+    # the name makes the key unique
+    return (entry['name'],) if sort == 'name' else (entry[sort], entry['name'])
+
+def _sort(entries, sort):
+    entries = sorted(entries, key=lambda entry: _key(entry, sort))
+    return entries, [_key(entry, sort) for entry in entries]
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor, sort):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    # the key must be comparable with the keys of the sort order, see _key
+    if sort == 'name':
+        valid = isinstance(key, list) and len(key) == 1 and isinstance(key[0], str)
+    else:
+        valid = (isinstance(key, list) and len(key) == 2 and isinstance(key[0], int)
+                 and not isinstance(key[0], bool) and isinstance(key[1], str))
+    if not valid:
+        raise ValueError("Invalid cursor")
+    return tuple(key)
+
+# the listings of all directories under the data path
+directory_listings = DirectoryListings()
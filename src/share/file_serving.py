@@ -0,0 +1,247 @@
+import os, uuid, hashlib, mimetypes
+from flask import Response
+from werkzeug.http import http_date, parse_date, parse_etags, parse_accept_header, quote_etag
+from werkzeug.wsgi import wrap_file
+from cache.lru_cache import LRUCache
+
+HASH_LIMIT = 64 * 1024 * 1024 # larger files get an ETag from their inode, size and mtime instead of a content hash
+BLOCK_SIZE = 64 * 1024
+MAX_RANGES = 16
+ENCODINGS = (('br', '.br'), ('gzip', '.gz')) # precompressed siblings, in the order of preference
+
+"""
+File downloads with HTTP caching, range requests and precompressed files.
+
+- every response has a strong ETag (a hash of the content, or of inode, size and mtime for large
+  files) and a Last-Modified date; the metadata is cached and revalidated with one stat call
+- If-None-Match and If-Modified-Since are answered with 304 Not Modified
+- Range requests get 206 Partial Content, several ranges as multipart/byteranges; If-Range is
+  honored and unsatisfiable ranges get 416
+- if the client accepts it, a newer `<file>.br` or `<file>.gz` next to the file is sent instead
+  with the matching Content-Encoding
+- complete files are handed to the file wrapper of the WSGI server, which can send them with
+  sendfile without copying them through Python
+"""
+
+class FileMetadata:
+
+    def __init__(self, path, stat, etag):
+        self.path = path
+        self.size = stat.st_size
+        self.inode = stat.st_ino
+        self.mtime_ns = stat.st_mtime_ns
+        self.mtime = int(stat.st_mtime)
+        self.etag = etag
+
+    def matches(self, stat):
+        return stat.st_ino == self.inode and stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+# path -> FileMetadata
+metadata_cache = LRUCache(4096)
+
+def file_metadata(path, stat=None):
+    """
+    :return: The cached FileMetadata of a file, revalidated with its current stat
+    """
+    stat = stat or os.stat(path)
+    metadata = metadata_cache.get(path)
+    if metadata is not None and metadata.matches(stat):
+        return metadata
+    if stat.st_size > HASH_LIMIT:
+        etag = f'{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}'
+    else:
+        content_hash = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE * 16), b''):
+                content_hash.update(block)
+        etag = content_hash.hexdigest()
+    metadata = FileMetadata(path, stat, etag)
+    metadata_cache.put(path, metadata)
+    return metadata
+
+class FileResponsePlan:
+    """
+    The status, headers and body of a file download, independent of the server: the body is
+    described by segments(), a sequence of bytes and (start, end) ranges of the served file.
+    """
+
+    def __init__(self, status, headers, path=None, mimetype=None, ranges=None, size=0, content_type=None):
+        self.status = status
+        self.headers = headers
+        self.path = path # the served file, the file itself or a precompressed sibling
+        self.mimetype = mimetype
+        self.ranges = ranges
+        self.content_type = content_type
+        self.parts = []
+        self.closing = b''
+        if ranges and len(ranges) > 1:
+            # several ranges are sent as parts of a multipart/byteranges body
+            boundary = uuid.uuid4().hex
+            self.parts = [(f'--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{end - 1}/{size}\r\n\r\n'.encode('ascii'), start, end)
+                          for start, end in ranges]
+            self.closing = f'--{boundary}--\r\n'.encode('ascii')
+            self.content_type = f'multipart/byteranges; boundary={boundary}'
+            headers['Content-Length'] = str(sum(len(head) + end - start + 2 for head, start, end in self.parts) + len(self.closing))
+
+    @property
+    def has_body(self):
+        return self.path is not None
+
+    def segments(self):
+        if not self.parts:
+            yield self.ranges[0] if self.ranges else (0, int(self.headers['Content-Length']))
+            return
+        for head, start, end in self.parts:
+            yield head
+            yield (start, end)
+            yield b'\r\n'
+        yield self.closing
+
+def plan_file_response(path, request_headers):
+    """
+    Decide the response for a file download.
+
+    :param path: The absolute path of an existing file
+    :param request_headers: The request headers, a mapping with case-insensitive keys
+    :return: A FileResponsePlan
+    """
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    encoding, served_path, has_variants = _select_encoding(path, request_headers.get('Accept-Encoding'))
+    metadata = file_metadata(served_path)
+    headers = {
+        'ETag': quote_etag(metadata.etag + (f'-{encoding}' if encoding else '')),
+        'Last-Modified': http_date(metadata.mtime),
+        'Accept-Ranges': 'bytes'
+    }
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    if has_variants:
+        headers['Vary'] = 'Accept-Encoding'
+    etag = headers['ETag'].strip('"')
+
+    if _not_modified(request_headers, etag, metadata.mtime):
+        return FileResponsePlan(304, headers)
+
+    ranges = _parse_ranges(request_headers.get('Range'), metadata.size) if _if_range(request_headers, etag, metadata.mtime) else None
+    if ranges == []:
+        headers['Content-Range'] = f'bytes */{metadata.size}'
+        return FileResponsePlan(416, headers)
+    if not ranges:
+        headers['Content-Length'] = str(metadata.size)
+        return FileResponsePlan(200, headers, served_path, mimetype)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{metadata.size}'
+        headers['Content-Length'] = str(end - start)
+    return FileResponsePlan(206, headers, served_path, mimetype, ranges, metadata.size)
+
+def send_file(path, request):
+    """
+    Make the response for a file download.
+
+    :param path: The absolute path of an existing file
+    :param request: The flask request
+    :return: A flask Response
+    """
+    plan = plan_file_response(path, request.headers)
+    if not plan.has_body:
+        return Response(status=plan.status, headers=plan.headers)
+    f = open(plan.path, 'rb')
+    if plan.status == 200:
+        # the file wrapper of the WSGI server can send the file with sendfile
+        return Response(wrap_file(request.environ, f, BLOCK_SIZE), status=200, headers=plan.headers,
+                        mimetype=plan.mimetype, direct_passthrough=True)
+    def generate():
+        try:
+            for segment in plan.segments():
+                if isinstance(segment, bytes):
+                    yield segment
+                else:
+                    yield from _read_range(f, *segment)
+        finally:
+            f.close()
+    return Response(generate(), status=206, headers=plan.headers, mimetype=None if plan.content_type else plan.mimetype,
+                    content_type=plan.content_type, direct_passthrough=True)
+
+def _select_encoding(path, accept_encoding):
+    # use a precompressed sibling if the client accepts its encoding and it is not older than the file
+    accepted = parse_accept_header(accept_encoding) if accept_encoding else None
+    has_variants, stat = False, None
+    for encoding, suffix in ENCODINGS:
+        try:
+            variant_stat = os.stat(path + suffix)
+        except OSError:
+            continue
+        has_variants = True
+        stat = stat or os.stat(path)
+        if accepted and accepted.quality(encoding) > 0 and variant_stat.st_mtime_ns >= stat.st_mtime_ns:
+            return encoding, path + suffix, True
+    return None, path, has_variants
+
+def _not_modified(request_headers, etag, mtime):
+    if_none_match = request_headers.get('If-None-Match')
+    if if_none_match:
+        # If-None-Match uses the weak comparison and takes precedence over If-Modified-Since
+        return parse_etags(if_none_match).contains_weak(etag)
+    if_modified_since = parse_date(request_headers.get('If-Modified-Since'))
+    return if_modified_since is not None and mtime <= if_modified_since.timestamp()
+
+def _if_range(request_headers, etag, mtime):
+    # a Range is only applied if the file is still the version named by If-Range
+    if_range = request_headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == quote_etag(etag)
+    date = parse_date(if_range)
+    return date is not None and int(date.timestamp()) == mtime
+
+def _parse_ranges(header, size):
+    """
+    Parse a Range header.
+
+    :return: None if there is no valid byte range header, an empty list if no range can be
+             satisfied, otherwise a list of (start, end) pairs with an exclusive end
+    """
+    if not header or not header.strip().lower().startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header.strip()[6:].split(','):
+        first, dash, last = spec.strip().partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or not (first.isdigit() or first == '') or not (last.isdigit() or last == '') or first == last == '':
+            return None
+        if first == '':
+            # a suffix range: the last bytes of the file
+            start, end = max(0, size - int(last)), size
+            if int(last) == 0:
+                continue
+        else:
+            start, end = int(first), size if last == '' else int(last) + 1
+            if last != '' and end <= start:
+                return None
+            end = min(end, size)
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        # too many ranges are answered with the whole file
+        return None
+    # overlapping and adjacent ranges are merged
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _read_range(f, start, end):
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = f.read(min(BLOCK_SIZE, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        yield block
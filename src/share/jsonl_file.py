@@ -0,0 +1,110 @@
+import os, json, mmap, threading
+import numpy as np
+from array import array
+
+SCAN_CHUNK = 16 * 1024 * 1024
+
+"""
+A memory-mapped jsonl file.
+
+Records are decoded only when they are accessed, so reading a few records of a large file needs
+memory for these records only; the pages of the file are cached by the operating system and shared
+between all readers. Every non-empty line is a record. Records can be streamed in file order,
+read at a byte offset or read by their record number; the byte offsets of all records are kept
+in a compact array of uint64 values which is built on the first access by record number.
+
+The file is mapped when the JsonlFile is created, so replace a file with a rename instead of
+rewriting it in place while it is read: a mapped file which is truncated can not be read anymore.
+"""
+class JsonlFile:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            # an empty file can not be mapped
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.stat.st_size > 0 else b''
+        self._offsets = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return len(self._map)
+
+    def lines(self, start=0):
+        """
+        Stream the raw records of the file.
+
+        :param start: The byte offset where to start, the start of a line
+        :return: A generator of (byte offset, line bytes) pairs for all non-empty lines
+        """
+        data, size, position = self._map, len(self._map), start
+        while position < size:
+            end = data.find(b'\n', position)
+            end = size if end < 0 else end + 1
+            line = data[position:end]
+            if line.strip():
+                yield position, line
+            position = end
+
+    def __iter__(self):
+        for _, line in self.lines():
+            yield json.loads(line)
+
+    def line_at(self, offset):
+        """
+        :return: The bytes of the line which starts at the byte offset
+        """
+        if offset < 0 or offset >= len(self._map):
+            raise IndexError(f'offset {offset} is outside of {self.path}')
+        end = self._map.find(b'\n', offset)
+        return self._map[offset:len(self._map) if end < 0 else end + 1]
+
+    def record_at(self, offset):
+        """
+        :return: The decoded record which starts at the byte offset
+        """
+        return json.loads(self.line_at(offset))
+
+    def offsets(self):
+        """
+        :return: An array('Q') with the byte offset of every record
+        """
+        with self._lock:
+            if self._offsets is None:
+                self._offsets = self._scan()
+            return self._offsets
+
+    def _scan(self):
+        # find the line breaks chunk by chunk on a view of the mapped file, without copying it
+        size = len(self._map)
+        if size == 0:
+            return array('Q')
+        data = np.frombuffer(self._map, dtype=np.uint8)
+        newlines = [np.flatnonzero(data[start:start + SCAN_CHUNK] == 10) + start for start in range(0, size, SCAN_CHUNK)]
+        ends = np.concatenate(newlines + [np.array([size - 1])]) + 1
+        ends = ends[:np.searchsorted(ends, size) + 1]
+        starts = np.concatenate([[0], ends[:-1]])
+        # only lines which start with whitespace can be empty
+        keep = np.ones(len(starts), dtype=bool)
+        blank = np.flatnonzero(np.isin(data[starts], (9, 10, 13, 32)))
+        keep[blank] = [bool(self._map[starts[i]:ends[i]].strip()) for i in blank.tolist()]
+        return array('Q', starts[keep].astype(np.uint64).tobytes())
+
+    def __len__(self):
+        return len(self.offsets())
+
+    def record(self, record_id):
+        """
+        :param record_id: The number of the record, starting with 0
+        :return: The decoded record
+        """
+        return self.record_at(self.offsets()[record_id])
+
+    def records(self, record_ids):
+        """
+        :return: A generator of the decoded records with the given numbers
+        """
+        offsets = self.offsets()
+        for record_id in record_ids:
+            yield self.record_at(offsets[record_id])
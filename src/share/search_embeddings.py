@@ -0,0 +1,336 @@
+import os, sys, json, heapq, hashlib, logging, threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from share.search_index import document_text
+from system.startup import startup
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_SUFFIX = '.emb'
+EMBEDDING_MAGIC = b'SUSIEMB\n'
+EMBEDDING_VERSION = 1
+SEMANTIC_WEIGHT = 200.0
+MAX_SCORE = 300.0
+SYNC_DOCUMENTS = 256 # files with up to this number of documents are embedded while the query waits
+IVF_DOCUMENTS = 20000 # files with at least this number of documents get an approximate nearest neighbour index
+IVF_PROBES = 8
+RERANK_FACTOR = 4 # the number of lexical candidates reranked per requested result
+READ_CHUNK = 1024
+
+"""
+Semantic search with a local sentence embedding model.
+
+The embedding model is a transformers encoder (i.e. a MiniLM sentence transformer) which runs on
+the CPU; a text is embedded as the normalized mean of its token vectors. The model is only loaded
+if it is configured with --embedding_model and then stays resident.
+
+The vectors of all documents of a jsonl file are stored next to it as `<file>.emb`:
+- the magic bytes 'SUSIEMB\\n' and the length of the JSON header as a 4 byte little-endian integer
+- the JSON header with the model, the vector dimension and the size and mtime of the jsonl file
+- aligned to 8 bytes: a uint64 hash of the text of every document, then the float16 vectors
+The file is memory-mapped, so only the rows of the reranked documents are read. When the jsonl
+file changes the vectors of documents with an unchanged text hash are copied from the old file,
+only new and changed documents are embedded. Large files are embedded in the background, their
+queries are answered lexically until the vectors are ready.
+
+For purely semantic queries over large files an IVF index (k-means clusters of the vectors) is
+built in memory; a query only compares the vectors of the IVF_PROBES closest clusters.
+"""
+
+class EmbeddingModel:
+
+    def __init__(self, path, batch_size=32, max_length=256):
+        # torch and transformers are only imported when an embedding model is used
+        torch = startup.import_module('torch')
+        transformers = startup.import_module('transformers')
+        self.torch = torch
+        self.path = path
+        self.name = os.path.basename(path.rstrip('/'))
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(path)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token or self.tokenizer.unk_token
+        self.model = transformers.AutoModel.from_pretrained(path)
+        self.model.eval()
+        self.dim = self.model.config.hidden_size
+        self._lock = threading.Lock()
+
+    def embed(self, texts):
+        """
+        :param texts: A list of strings
+        :return: A float32 numpy array with one normalized vector per text
+        """
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = self.tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True,
+                                   max_length=self.max_length, return_tensors='pt')
+            with self._lock, self.torch.inference_mode():
+                hidden = self.model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask']).last_hidden_state
+            mask = batch['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+            mean = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            vectors.append(self.torch.nn.functional.normalize(mean.float(), dim=-1).numpy())
+        return np.concatenate(vectors) if vectors else np.zeros((0, self.dim), dtype=np.float32)
+
+class EmbeddingMatrix:
+
+    def __init__(self, path, header, hashes, vectors):
+        self.path = path
+        self.model = header['model']
+        self.size = header['source_size']
+        self.mtime_ns = header['source_mtime_ns']
+        self.hashes = hashes
+        self.vectors = vectors
+        self.ivf = None
+
+    def is_current(self, index, model):
+        return index.size == self.size and index.mtime_ns == self.mtime_ns and model == self.model
+
+    def similarities(self, doc_ids, query_vector):
+        """
+        :return: The cosine similarities of the documents with the query, one matrix-vector product
+        """
+        return self.vectors[np.asarray(doc_ids, dtype=np.int64)].astype(np.float32) @ query_vector
+
+    def nearest(self, query_vector, limit):
+        """
+        Find the documents which are most similar to the query.
+
+        :return: A list of (document number, cosine similarity) pairs, best first
+        """
+        if self.ivf is not None:
+            candidates = self.ivf.candidates(query_vector, IVF_PROBES)
+            if len(candidates) >= limit:
+                return _top(candidates, self.similarities(candidates, query_vector), limit)
+        best = []
+        for start in range(0, len(self.vectors), 65536):
+            chunk = self.vectors[start:start + 65536].astype(np.float32) @ query_vector
+            best += _top(np.arange(start, start + len(chunk)), chunk, limit)
+        return heapq.nsmallest(limit, best, key=lambda pair: (-pair[1], pair[0]))
+
+class IVFIndex:
+    """
+    An inverted file index: the vectors are clustered with spherical k-means and a query is only
+    compared to the vectors of the clusters with the closest centroids.
+    """
+    def __init__(self, vectors, iterations=10, seed=0):
+        count = len(vectors)
+        lists = max(1, int(np.sqrt(count)))
+        random = np.random.default_rng(seed)
+        sample = vectors[np.sort(random.choice(count, min(count, lists * 64), replace=False))].astype(np.float32)
+        centroids = sample[random.choice(len(sample), lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        assignment = np.concatenate([np.argmax(vectors[start:start + 65536].astype(np.float32) @ centroids.T, axis=1)
+                                     for start in range(0, count, 65536)])
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(lists + 1))
+        self.centroids = centroids
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(lists)]
+
+    def candidates(self, query_vector, probes):
+        closest = np.argsort(-(self.centroids @ query_vector))[:probes]
+        return np.sort(np.concatenate([self.lists[i] for i in closest]))
+
+"""
+The DocumentEmbeddings keep the embedding model and the memory-mapped vectors of all searched
+jsonl files.
+"""
+class DocumentEmbeddings:
+
+    def __init__(self):
+        self.model_path = None
+        self._model = None
+        self._matrices = {}
+        self._building = set()
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embeddings')
+        self.embedded_documents = 0
+        self.reused_documents = 0
+
+    def configure(self, model_path=None):
+        if model_path: self.model_path = model_path
+
+    @property
+    def enabled(self):
+        return self.model_path is not None
+
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                self._model = EmbeddingModel(self.model_path)
+                logger.info("Loaded embedding model %s", self.model_path)
+            return self._model
+
+    def embed_query(self, query):
+        return self.model().embed([query])[0]
+
+    def get(self, index):
+        """
+        :param index: The current SearchIndex of a jsonl file
+        :return: The EmbeddingMatrix of the file or None if the vectors are not ready yet
+        """
+        model = self.model()
+        with self._lock:
+            matrix = self._matrices.get(index.path)
+        if matrix is not None and matrix.is_current(index, model.name):
+            return matrix
+        if index.count <= SYNC_DOCUMENTS:
+            return self._build(index)
+        with self._lock:
+            if index.path not in self._building:
+                self._building.add(index.path)
+                self._executor.submit(self._build, index)
+        return None
+
+    def remove(self, path):
+        with self._lock:
+            self._matrices.pop(path, None)
+        try:
+            os.remove(path + EMBEDDING_SUFFIX)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Failed to remove embeddings of {path}: {e}")
+
+    def _build(self, index):
+        try:
+            model = self.model()
+            embedding_path = index.path + EMBEDDING_SUFFIX
+            try:
+                matrix = load_embeddings(index.path, embedding_path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to load embeddings {embedding_path}: {e}")
+                matrix = None
+            if matrix is None or not matrix.is_current(index, model.name):
+                matrix = self._embed(index, model, matrix if matrix is not None and matrix.model == model.name else None)
+            if len(matrix.vectors) >= IVF_DOCUMENTS:
+                matrix.ivf = IVFIndex(matrix.vectors)
+            with self._lock:
+                self._matrices[index.path] = matrix
+            return matrix
+        except Exception as e:
+            logger.error(f"Failed to embed {index.path}: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._building.discard(index.path)
+
+    def _embed(self, index, model, old):
+        # hash the texts to find the documents which are already embedded in the old file
+        hashes = np.zeros(index.count, dtype=np.uint64)
+        for start in range(0, index.count, READ_CHUNK):
+            for offset, document in enumerate(index.read(range(start, min(index.count, start + READ_CHUNK)))):
+                hashes[start + offset] = _text_hash(document_text(document))
+        old_rows = {} if old is None else {int(value): row for row, value in enumerate(old.hashes)}
+
+        header = {'version': EMBEDDING_VERSION, 'byteorder': sys.byteorder, 'model': model.name, 'dim': model.dim,
+                  'documents': index.count, 'source_size': index.size, 'source_mtime_ns': index.mtime_ns}
+        embedding_path = index.path + EMBEDDING_SUFFIX
+        temp_path = f'{embedding_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            hashes_offset = _write_header(temp_path, header, index.count, model.dim)
+            vectors = np.memmap(temp_path, dtype=np.float16, mode='r+', offset=hashes_offset + 8 * index.count,
+                                shape=(index.count, model.dim)) if index.count else np.zeros((0, model.dim), dtype=np.float16)
+            rows = np.array([old_rows.get(value, -1) for value in hashes.tolist()], dtype=np.int64)
+            reused = np.flatnonzero(rows >= 0)
+            for start in range(0, len(reused), 65536):
+                doc_ids = reused[start:start + 65536]
+                vectors[doc_ids] = old.vectors[rows[doc_ids]]
+            missing = np.flatnonzero(rows < 0).tolist()
+            for start in range(0, len(missing), READ_CHUNK):
+                doc_ids = missing[start:start + READ_CHUNK]
+                vectors[doc_ids] = model.embed([document_text(document) for document in index.read(doc_ids)]).astype(np.float16)
+            if index.count:
+                np.memmap(temp_path, dtype=np.uint64, mode='r+', offset=hashes_offset, shape=(index.count,))[:] = hashes
+                vectors.flush()
+            del vectors
+            os.replace(temp_path, embedding_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        with self._lock:
+            self.embedded_documents += len(missing)
+            self.reused_documents += index.count - len(missing)
+        logger.debug("Embedded %d of %d documents of %s", len(missing), index.count, index.path)
+        return load_embeddings(index.path, embedding_path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "model": self.model_path,
+                "loaded": self._model is not None,
+                "files": len(self._matrices),
+                "building": len(self._building),
+                "embedded_documents": self.embedded_documents,
+                "reused_documents": self.reused_documents
+            }
+
+def load_embeddings(path, embedding_path):
+    """
+    Map stored document vectors.
+
+    :return: The EmbeddingMatrix or None if there is no embedding file
+    """
+    try:
+        with open(embedding_path, 'rb') as f:
+            prefix = f.read(len(EMBEDDING_MAGIC) + 4)
+            if prefix[:len(EMBEDDING_MAGIC)] != EMBEDDING_MAGIC:
+                return None
+            header_length = int.from_bytes(prefix[len(EMBEDDING_MAGIC):], 'little')
+            header = json.loads(f.read(header_length))
+    except FileNotFoundError:
+        return None
+    if header.get('version') != EMBEDDING_VERSION or header.get('byteorder') != sys.byteorder:
+        return None
+    count, dim = header['documents'], header['dim']
+    hashes_offset = _align(len(EMBEDDING_MAGIC) + 4 + header_length)
+    if count == 0:
+        return EmbeddingMatrix(path, header, np.zeros(0, dtype=np.uint64), np.zeros((0, dim), dtype=np.float16))
+    hashes = np.memmap(embedding_path, dtype=np.uint64, mode='r', offset=hashes_offset, shape=(count,))
+    vectors = np.memmap(embedding_path, dtype=np.float16, mode='r', offset=hashes_offset + 8 * count, shape=(count, dim))
+    return EmbeddingMatrix(path, header, hashes, vectors)
+
+def semantic_score(lexical_score, similarity):
+    return round(min(MAX_SCORE, lexical_score + SEMANTIC_WEIGHT * min(1.0, max(0.0, float(similarity)))), 2)
+
+def rerank(matrix, query_vector, ranked, limit):
+    """
+    Rerank lexically ranked documents by their similarity with the query.
+
+    :param ranked: A list of (document number, lexical score) pairs
+    :return: A list of at most limit (document number, score) pairs, best first
+    """
+    if not ranked:
+        return []
+    similarities = matrix.similarities([doc_id for doc_id, _ in ranked], query_vector)
+    scored = [(doc_id, semantic_score(score, similarity)) for (doc_id, score), similarity in zip(ranked, similarities.tolist())]
+    return heapq.nsmallest(limit, scored, key=lambda pair: (-pair[1], pair[0]))
+
+def _write_header(path, header, count, dim):
+    data = json.dumps(header).encode('utf-8')
+    hashes_offset = _align(len(EMBEDDING_MAGIC) + 4 + len(data))
+    with open(path, 'wb') as f:
+        f.write(EMBEDDING_MAGIC + len(data).to_bytes(4, 'little') + data)
+        f.truncate(hashes_offset + 8 * count + 2 * count * dim)
+    return hashes_offset
+
+def _text_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def _top(doc_ids, similarities, limit):
+    if len(similarities) > limit:
+        best = np.argpartition(-similarities, limit)[:limit]
+        doc_ids, similarities = np.asarray(doc_ids)[best], similarities[best]
+    return heapq.nsmallest(limit, zip(np.asarray(doc_ids).tolist(), similarities.tolist()), key=lambda pair: (-pair[1], pair[0]))
+
+def _align(length):
+    return (length + 7) & ~7
+
+# the document vectors of all jsonl files under the data path, configured in main.py
+document_embeddings = DocumentEmbeddings()
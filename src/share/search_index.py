@@ -0,0 +1,307 @@
+import os, re, sys, json, math, mmap, bisect, logging, threading
+from array import array
+from collections import Counter
+from share.jsonl_file import JsonlFile
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'SUSIIDX\n'
+INDEX_VERSION = 2
+MAX_FREQUENCY = 0xFFFF
+
+"""
+A persistent inverted index for a jsonl file.
+
+Every non-empty line of the jsonl file is a document; documents are numbered in file order.
+The indexed text of a document are its text fields, the fields with the suffix `_t` (i.e. `text_t`).
+The index maps every token to the sorted list of documents containing it (the postings list)
+and keeps the byte offset of every document, so that a query is answered by intersecting the
+postings lists of its tokens and only the matching lines of the memory-mapped file are decoded. For BM25 ranking
+the index also keeps the frequency of the token in every posting, the number of tokens of every
+document and the inverse document frequency of every token.
+
+The index is stored next to the jsonl file as `<file>.idx`:
+- the magic bytes 'SUSIIDX\\n' and the length of the JSON header as a 4 byte little-endian integer
+- the JSON header with the version, the size and mtime of the indexed file and the sections
+- the sections, each aligned to 8 bytes:
+  'offsets' (uint64, one per document plus the end of the file),
+  'vocabulary' (the sorted tokens, utf-8, separated by newlines),
+  'postings_offsets' (uint64, the start of the postings list of every token plus the end),
+  'postings' (uint32 document numbers), 'frequencies' (uint16, parallel to the postings),
+  'lengths' (uint32, one per document), 'idf' (float32, one per token)
+The sections are memory-mapped when the index is loaded, only the vocabulary is decoded.
+An index is rebuilt when the size or mtime of the jsonl file changes.
+"""
+
+def tokenize(text):
+    # words without punctuation, so that 'bee.' is found with 'bee'
+    return re.findall(r'\w+', text.lower())
+
+def document_text(document):
+    """
+    :return: The text of all text fields of a document
+    """
+    if not isinstance(document, dict):
+        return ''
+    return ' '.join(value if isinstance(value, str) else str(value)
+                    for key, value in document.items() if key.endswith('_t') and value is not None)
+
+class SearchIndex:
+
+    def __init__(self, source, offsets, vocabulary, postings_offsets, postings, frequencies, lengths, idf, average_length):
+        self.source = source # the JsonlFile
+        self.path = source.path
+        self.size = source.stat.st_size
+        self.mtime_ns = source.stat.st_mtime_ns
+        self.offsets = offsets
+        self.vocabulary = vocabulary
+        self.terms = {term: index for index, term in enumerate(vocabulary)}
+        self.postings_offsets = postings_offsets
+        self.postings = postings
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.idf = idf
+        self.average_length = average_length
+        self.fuzzy = None # the trigram index of the vocabulary, built on the first fuzzy search
+
+    @property
+    def count(self):
+        return len(self.offsets) - 1
+
+    def is_current(self, stat):
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+    def postings_list(self, token):
+        """
+        :return: The sorted document numbers of all documents which contain the token
+        """
+        term = self.terms.get(token)
+        if term is None:
+            return []
+        return self.postings[self.postings_offsets[term]:self.postings_offsets[term + 1]]
+
+    def term_postings(self, term):
+        """
+        :param term: The number of a token in the vocabulary
+        :return: The document numbers and the token frequencies of the postings list of the token
+        """
+        start, end = self.postings_offsets[term], self.postings_offsets[term + 1]
+        return self.postings[start:end], self.frequencies[start:end]
+
+    def match_all(self, tokens):
+        """
+        Find the documents which contain all tokens.
+
+        :param tokens: A collection of query tokens
+        :return: A sorted sequence of document numbers
+        """
+        postings = [self.postings_list(token) for token in set(tokens)]
+        if not postings:
+            return range(self.count)
+        # intersect the shortest lists first, the intermediate result can only get shorter
+        postings.sort(key=len)
+        result = postings[0]
+        for other in postings[1:]:
+            if not result:
+                break
+            result = _intersect(result, other)
+        return result
+
+    def read(self, doc_ids):
+        """
+        Read and decode documents from the jsonl file.
+
+        :param doc_ids: Document numbers
+        :return: A list of the documents as dictionaries
+        """
+        return [self.source.record_at(self.offsets[doc_id]) for doc_id in doc_ids]
+
+def build_index(source):
+    """
+    Tokenize all documents of a jsonl file.
+
+    :param source: The JsonlFile
+    :return: A SearchIndex backed by in-memory arrays
+    """
+    offsets = array('Q')
+    lengths = array('I')
+    postings = {}
+    for start, line in source.lines():
+        try:
+            document = json.loads(line)
+        except ValueError:
+            logger.warning(f"Skipping invalid line at byte {start} of {source.path}")
+            continue
+        doc_id = len(offsets)
+        offsets.append(start)
+        tokens = tokenize(document_text(document))
+        lengths.append(len(tokens))
+        for token, frequency in Counter(tokens).items():
+            entry = postings.get(token)
+            if entry is None:
+                postings[token] = entry = (array('I'), array('H'))
+            entry[0].append(doc_id)
+            entry[1].append(min(frequency, MAX_FREQUENCY))
+    offsets.append(source.size)
+
+    vocabulary = sorted(postings)
+    postings_offsets = array('Q', [0])
+    all_postings, frequencies, idf = array('I'), array('H'), array('f')
+    count = len(lengths)
+    for token in vocabulary:
+        doc_ids, token_frequencies = postings[token]
+        all_postings.extend(doc_ids)
+        frequencies.extend(token_frequencies)
+        postings_offsets.append(len(all_postings))
+        idf.append(math.log(1.0 + (count - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5)))
+    average_length = sum(lengths) / count if count else 0.0
+    return SearchIndex(source, offsets, vocabulary, postings_offsets, all_postings, frequencies, lengths, idf, average_length)
+
+def write_index(index, index_path):
+    sections = [('offsets', index.offsets.tobytes()), ('vocabulary', '\n'.join(index.vocabulary).encode('utf-8')),
+                ('postings_offsets', index.postings_offsets.tobytes()), ('postings', index.postings.tobytes()),
+                ('frequencies', index.frequencies.tobytes()), ('lengths', index.lengths.tobytes()), ('idf', index.idf.tobytes())]
+    layout, position = {}, 0
+    for name, data in sections:
+        layout[name] = [position, len(data)]
+        position += _align(len(data))
+    header = json.dumps({'version': INDEX_VERSION, 'byteorder': sys.byteorder, 'source_size': index.size,
+                         'source_mtime_ns': index.mtime_ns, 'documents': index.count, 'terms': len(index.vocabulary),
+                         'average_length': index.average_length, 'sections': layout}).encode('utf-8')
+    # write to a temporary file and rename it, so that readers never see a partial index
+    temp_path = f'{index_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(INDEX_MAGIC + len(header).to_bytes(4, 'little') + header)
+            f.write(b'\0' * (_align(f.tell()) - f.tell()))
+            for name, data in sections:
+                f.write(data + b'\0' * (_align(len(data)) - len(data)))
+        os.replace(temp_path, index_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def load_index(source, index_path):
+    """
+    Map a stored index.
+
+    :param source: The JsonlFile
+
+    :return: The SearchIndex or None if there is no current index for the jsonl file
+    """
+    try:
+        with open(index_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    if buffer[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        return None
+    header_end = len(INDEX_MAGIC) + 4 + int.from_bytes(buffer[len(INDEX_MAGIC):len(INDEX_MAGIC) + 4], 'little')
+    header = json.loads(buffer[len(INDEX_MAGIC) + 4:header_end])
+    if header.get('version') != INDEX_VERSION or header.get('byteorder') != sys.byteorder or \
+            header.get('source_size') != source.stat.st_size or header.get('source_mtime_ns') != source.stat.st_mtime_ns:
+        return None
+    data_start = _align(header_end)
+    view = memoryview(buffer)
+    def section(name, typecode=None):
+        start, length = header['sections'][name]
+        data = view[data_start + start:data_start + start + length]
+        return data.cast(typecode) if typecode else data
+    vocabulary = bytes(section('vocabulary')).decode('utf-8')
+    return SearchIndex(source, section('offsets', 'Q'), vocabulary.split('\n') if vocabulary else [],
+                       section('postings_offsets', 'Q'), section('postings', 'I'), section('frequencies', 'H'),
+                       section('lengths', 'I'), section('idf', 'f'), header['average_length'])
+
+"""
+The SearchIndexStore keeps the indexes of all searched jsonl files. An index is loaded from its
+`.idx` file or built on first use and checked against the size and mtime of the jsonl file on
+every query; uploads and deletes of a file invalidate its index explicitly.
+"""
+class SearchIndexStore:
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self.builds = 0
+        self.loads = 0
+
+    def get(self, path):
+        """
+        :param path: The absolute path of a jsonl file
+        :return: A current SearchIndex for the file
+        """
+        stat = os.stat(path)
+        with self._lock:
+            index = self._indexes.get(path)
+            if index is not None and index.is_current(stat):
+                return index
+            build_lock = self._build_locks.setdefault(path, threading.Lock())
+        with build_lock:
+            # the index belongs to the version of the file which is mapped now
+            source = JsonlFile(path)
+            with self._lock:
+                index = self._indexes.get(path)
+            if index is not None and index.is_current(source.stat):
+                return index
+            index_path = path + INDEX_SUFFIX
+            try:
+                index = load_index(source, index_path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to load search index {index_path}: {e}")
+                index = None
+            if index is not None:
+                with self._lock:
+                    self.loads += 1
+            else:
+                index = build_index(source)
+                try:
+                    write_index(index, index_path)
+                except OSError as e:
+                    # the index still works from memory
+                    logger.error(f"Failed to store search index {index_path}: {e}")
+                with self._lock:
+                    self.builds += 1
+                logger.debug("Built search index for %s: %d documents, %d terms", path, index.count, len(index.terms))
+            with self._lock:
+                self._indexes[path] = index
+            return index
+
+    def invalidate(self, path):
+        """
+        Drop the index of a jsonl file, i.e. after the file was replaced or deleted.
+        """
+        with self._lock:
+            self._indexes.pop(path, None)
+        try:
+            os.remove(path + INDEX_SUFFIX)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Failed to remove search index of {path}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"indexes": len(self._indexes), "builds": self.builds, "loads": self.loads}
+
+def _align(length):
+    return (length + 7) & ~7
+
+def _intersect(shorter, longer):
+    if len(longer) > 16 * len(shorter):
+        # look up the few documents of the short list in the long list
+        result, low = [], 0
+        for doc_id in shorter:
+            low = bisect.bisect_left(longer, doc_id, low)
+            if low == len(longer):
+                break
+            if longer[low] == doc_id:
+                result.append(doc_id)
+        return result
+    return sorted(set(shorter).intersection(longer))
+
+# the indexes of all jsonl files under the data path
+search_indexes = SearchIndexStore()
@@ -0,0 +1,173 @@
+import math, heapq, threading
+import numpy as np
+from array import array
+from collections import Counter
+from share.search_index import tokenize
+
+K1 = 1.2
+B = 0.75
+FUZZY_WEIGHT = 0.5 # the weight of a token with one typo, two typos count 0.25
+DEFAULT_LIMIT = 10
+
+"""
+BM25 ranking over a SearchIndex.
+
+A query is answered in two passes:
+- the strict pass ranks the documents which contain all tokens of the query
+- if the strict pass finds fewer documents than requested, the fuzzy pass fills up the result
+  with documents which contain any of the tokens or a vocabulary token within one edit or swap
+  (two edits for tokens of 8 and more characters), found with a trigram index of the vocabulary
+Only the documents of the result are selected with a heap; the candidates are never sorted.
+The lexical score is the BM25 score relative to the best possible score of the query, from 0 to 100.
+"""
+
+def rank(index, query, limit=None):
+    """
+    Rank the documents of an index for a query.
+
+    :param index: A SearchIndex
+    :param query: The query string
+    :param limit: The maximum number of results; if it is not given, all documents matching all
+                  tokens are returned, filled up to DEFAULT_LIMIT with fuzzy matches
+    :return: A list of (document number, score) pairs, best first
+    """
+    tokens = list(dict.fromkeys(tokenize(query)))
+    strict = index.match_all(tokens)
+    if limit is None:
+        limit = max(len(strict), DEFAULT_LIMIT)
+    if limit <= 0:
+        return []
+    if not tokens:
+        return [(doc_id, 0.0) for doc_id in strict[:limit]]
+
+    exact = [(index.terms[token], 1.0) for token in tokens if token in index.terms]
+    best = _best_score(index, tokens)
+    results = _top(index, exact, np.asarray(strict, dtype=np.uint32), limit, best) if len(strict) > 0 else []
+    if len(results) >= limit:
+        return results
+
+    # fill up with documents which match some of the tokens, allowing typos
+    weighted = list(exact)
+    for token in tokens:
+        weighted += [(term, FUZZY_WEIGHT ** distance) for term, distance in fuzzy_terms(index, token)]
+    found = {doc_id for doc_id, _ in results}
+    fuzzy = _top(index, weighted, None, limit, best, exclude=found)
+    return results + fuzzy[:limit - len(results)]
+
+def fuzzy_terms(index, token):
+    """
+    Find the vocabulary tokens which are similar to a token.
+
+    :return: A list of (term number, edit distance) pairs
+    """
+    max_edits = 0 if len(token) < 4 else 1 if len(token) < 8 else 2
+    if max_edits == 0:
+        return []
+    trigrams = _fuzzy_index(index)
+    grams = _trigrams(token)
+    shared = Counter()
+    for gram in grams:
+        shared.update(trigrams.get(gram, ()))
+    # every edit changes at most three trigrams
+    required = max(1, len(grams) - 3 * max_edits)
+    similar = []
+    for term, count in shared.items():
+        if count < required:
+            continue
+        candidate = index.vocabulary[term]
+        if candidate == token or abs(len(candidate) - len(token)) > max_edits:
+            continue
+        distance = _edit_distance(token, candidate, max_edits)
+        if distance <= max_edits:
+            similar.append((term, distance))
+    return similar
+
+def _top(index, weighted, candidates, limit, best, exclude=()):
+    doc_ids, scores = _bm25(index, weighted, candidates)
+    if best > 0:
+        scores = scores * (100.0 / best)
+    if candidates is not None and len(doc_ids) < len(candidates):
+        # documents without any scored token (i.e. an empty query) keep a score of 0
+        missing = np.setdiff1d(candidates, doc_ids)
+        doc_ids, scores = np.concatenate([doc_ids, missing]), np.concatenate([scores, np.zeros(len(missing))])
+    pairs = zip(scores.tolist(), doc_ids.tolist())
+    if exclude:
+        pairs = ((score, doc_id) for score, doc_id in pairs if doc_id not in exclude)
+    # best score first, documents with the same score in file order
+    top = heapq.nsmallest(limit, pairs, key=lambda pair: (-pair[0], pair[1]))
+    return [(doc_id, round(score, 2)) for score, doc_id in top]
+
+def _bm25(index, weighted, candidates=None):
+    """
+    Compute the BM25 scores of all documents containing any of the weighted terms.
+
+    :param weighted: A list of (term number, weight) pairs
+    :param candidates: A sorted array of document numbers to restrict the scoring to, or None
+    :return: The sorted document numbers and their scores as numpy arrays
+    """
+    lengths = _numpy(index.lengths, np.uint32)
+    average_length = index.average_length or 1.0
+    all_doc_ids, all_scores = [], []
+    for term, weight in weighted:
+        doc_ids, frequencies = index.term_postings(term)
+        doc_ids, frequencies = _numpy(doc_ids, np.uint32), _numpy(frequencies, np.uint16)
+        if candidates is not None:
+            positions = np.minimum(np.searchsorted(doc_ids, candidates), max(0, len(doc_ids) - 1))
+            found = doc_ids[positions] == candidates if len(doc_ids) else np.zeros(len(candidates), dtype=bool)
+            doc_ids, frequencies = candidates[found], frequencies[positions[found]]
+        frequencies = frequencies.astype(np.float64)
+        norm = K1 * (1.0 - B + B * lengths[doc_ids] / average_length)
+        all_doc_ids.append(doc_ids)
+        all_scores.append(weight * float(index.idf[term]) * frequencies * (K1 + 1.0) / (frequencies + norm))
+    if not all_doc_ids:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0)
+    doc_ids, inverse = np.unique(np.concatenate(all_doc_ids), return_inverse=True)
+    return doc_ids, np.bincount(inverse, weights=np.concatenate(all_scores), minlength=len(doc_ids))
+
+def _best_score(index, tokens):
+    # the score of a document which contains every token with an infinite frequency;
+    # a token which is not in the vocabulary counts with the idf of a token of no document
+    unknown_idf = math.log(1.0 + (index.count + 0.5) / 0.5)
+    best = 0.0
+    for token in tokens:
+        term = index.terms.get(token)
+        best += float(index.idf[term]) if term is not None else unknown_idf
+    return best * (K1 + 1.0)
+
+_fuzzy_lock = threading.Lock()
+
+def _fuzzy_index(index):
+    with _fuzzy_lock:
+        if index.fuzzy is None:
+            trigrams = {}
+            for term, token in enumerate(index.vocabulary):
+                for gram in _trigrams(token):
+                    terms = trigrams.get(gram)
+                    if terms is None:
+                        trigrams[gram] = terms = array('I')
+                    terms.append(term)
+            index.fuzzy = trigrams
+        return index.fuzzy
+
+def _trigrams(token):
+    padded = f'${token}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _edit_distance(a, b, max_distance):
+    # Levenshtein distance where swapping two neighbouring characters is one edit,
+    # stops as soon as it exceeds max_distance
+    before, previous = None, list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if before is not None and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                distance = min(distance, before[j - 2] + 1)
+            current.append(distance)
+        if min(current) > max_distance:
+            return max_distance + 1
+        before, previous = previous, current
+    return previous[-1]
+
+def _numpy(sequence, dtype):
+    return np.frombuffer(sequence, dtype=dtype) if len(sequence) else np.zeros(0, dtype=dtype)
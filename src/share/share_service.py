@@ -1,9 +1,17 @@
-from flask import request, send_from_directory, Response, jsonify, current_app, make_response
+from flask import request, send_from_directory, Response, jsonify, current_app, make_response, g
 from flask_restx import Namespace, Resource, fields
 from flask_httpauth import HTTPTokenAuth
 from werkzeug.utils import secure_filename
 
-import os, time, logging, random, json
+import os, time, glob, html, heapq, logging, random, json, itertools, threading
+from concurrent.futures import ThreadPoolExecutor
+from share.search_index import search_indexes, INDEX_SUFFIX
+from share.file_serving import send_file
+from share.directory_listing import directory_listings
+from system.instrumentation import stage, request_metrics
+from share.uploads import uploads, UploadError
+from share.search_ranking import rank, DEFAULT_LIMIT
+from share.search_embeddings import document_embeddings, rerank, semantic_score, RERANK_FACTOR, EMBEDDING_SUFFIX
 
 # set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -54,10 +62,20 @@ The FileResource class handles file storage and retrieval. It provides endpoints
 2. Download:
    To download a file, send a GET request to '/<path>' where '<path>' is the path to the file you wish to retrieve.
    The server will respond with the file content if the file exists and the request is authorized.
+   Downloads support Range requests (also several ranges), ETag and Last-Modified validation with
+   If-None-Match/If-Modified-Since and precompressed '<path>.br' or '<path>.gz' files.
 
    Example using curl:
    curl -X GET -H "Authorization: Bearer YOUR_ACCESS_TOKEN" http://<server_address>/api/data/path/to/store/file.txt -o file.txt
 
+   A GET request to '/<path>/index.json' lists the directory as json. The listing is sorted with
+   'sort' (name, size, mtime or atime) and 'order' (asc or desc); with 'limit' it is paginated and
+   the next page is requested with the 'next_cursor' of the previous page. 'recursive=true' lists
+   all subdirectories as well.
+
+   Example using curl:
+   curl "http://<server_address>/api/data/path/to/store/index.json?sort=mtime&order=desc&limit=100"
+
 3. Delete:
    To delete a file, send a DELETE request to '/<path>' where '<path>' is the path to the file you want to remove.
    The server will delete the file if it exists, the request is authorized, and the file is not in use.
@@ -83,35 +101,36 @@ class FileResource(Resource):
         if not is_safe_path(data_path, abs_path):
             return error_response("Invalid path request", 403)
 
-        # Check if path is a file and serve
+        # Check if path is a file and serve it with range and conditional request support
         if os.path.isfile(abs_path):
-            return send_from_directory(data_path, req_path)
+            return send_file(abs_path, request)
 
         # Check if an index.json file is requested
         if req_path.endswith("index.json"):
-            parent_path = os.path.dirname(abs_path.rstrip("index.json"))
-            files = [] if not os.path.exists(parent_path) else os.listdir(parent_path)
-            file_info = []
-            for file in files:
-                file_abs_path = os.path.join(abs_path.rstrip("index.json"), file)
-                stats = os.stat(file_abs_path)
-                file_info.append({
-                    "name": file, # file name
-                    "size": stats.st_size, # file size in bytes
-                    "atime": int(stats.st_atime * 1000), # access time in millisonde since epoch
-                    "mtime": int(stats.st_mtime * 1000), # modified time in millisonde since epoch
-                    "last_accessed": time.ctime(stats.st_atime),
-                    "last_modified": time.ctime(stats.st_mtime)
-                })
-            return jsonify({'path': req_path, 'dir': file_info})
+            parent_path = os.path.dirname(abs_path)
+            if not os.path.isdir(parent_path):
+                return jsonify({'path': req_path, 'dir': [], 'total': 0})
+            try:
+                limit = request.args.get('limit', type=int)
+                if limit is not None and limit < 1:
+                    raise ValueError("The limit must be positive")
+                listing = directory_listings.list(parent_path,
+                    sort=request.args.get('sort', 'name'),
+                    descending=request.args.get('order', 'asc') == 'desc',
+                    limit=limit,
+                    cursor=request.args.get('cursor'),
+                    recursive=request.args.get('recursive', 'false').lower() == 'true')
+            except ValueError as e:
+                return error_response(str(e), 400)
+            return jsonify(dict(listing, path=req_path))
 
         # Check if path is a directory
         if not os.path.exists(abs_path) or not os.path.isdir(abs_path):
             return f"Directory {abs_path} does not exist.", 404
     
         # Show directory contents
-        files = os.listdir(os.path.dirname(abs_path)) if req_path.endswith("index.html") else os.listdir(abs_path)
-        file_links = [f'<li><a href="{os.path.join(req_path, file)}">{file}</a></li>' for file in files]
+        files = [entry['name'] for entry in directory_listings.list(os.path.dirname(abs_path) if req_path.endswith("index.html") else abs_path)['dir']]
+        file_links = [f'<li><a href="{html.escape(os.path.join(req_path, file))}">{html.escape(file)}</a></li>' for file in files]
         return Response(f'<ul>{"".join(file_links)}</ul>', mimetype='text/html')
 
     # authorized access to upload a file to the data path
@@ -137,7 +156,16 @@ class FileResource(Resource):
 
         try:
             os.makedirs(os.path.dirname(full_path), exist_ok=True)
-            file.save(full_path)
+            # replace the file with a rename, memory-mapped readers of the old file keep their version
+            temp_path = f'{full_path}.{os.getpid()}.{threading.get_ident()}.upload'
+            try:
+                file.save(temp_path)
+                os.replace(temp_path, full_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            search_indexes.invalidate(full_path)
+            directory_listings.invalidate(os.path.dirname(full_path), data_path)
             logger.debug("Stored file to: %s", req_path)
             return jsonify(message=f'File {os.path.basename(full_path)} uploaded successfully', status=201)
         except Exception as e:
@@ -155,7 +183,7 @@ class FileResource(Resource):
         abs_path = os.path.join(data_path, req_path)
         
         # Prevent directory traversal
-        if not is_safe_path(data_path, full_path):
+        if not is_safe_path(data_path, abs_path):
             return error_response("Invalid path request", 403)
         
         # Check if path is a file
@@ -164,6 +192,9 @@ class FileResource(Resource):
         
         try:
             os.remove(abs_path)
+            search_indexes.invalidate(abs_path)
+            document_embeddings.remove(abs_path)
+            directory_listings.invalidate(os.path.dirname(abs_path), data_path)
             logger.debug("deleted file from :  %s", req_path)
         
             # Remove any empty directories
@@ -180,6 +211,118 @@ class FileResource(Resource):
             logger.error(f"Failed to delete file {req_path}: {e}")
             return error_response("Failed to delete file due to server error", 500)
 
+"""
+Chunked uploads (/uploads) for large files, i.e. models, which can be resumed after a disconnect.
+
+1. Create an upload for the target path, optionally with the size and a checksum of the file:
+   curl -X POST -H "Authorization: Bearer YOUR_ACCESS_TOKEN" -H "Content-Type: application/json" -d '{"path": "protected/model/big.bin", "size": 1073741824, "checksum": "sha256:<hex digest>"}' http://<server_address>/api/data/uploads
+   The response contains the upload `id` and the `offset` where the next part starts.
+
+2. Send the parts in order, each with the offset where the previous part ended:
+   curl -X PUT -H "Authorization: Bearer YOUR_ACCESS_TOKEN" --data-binary @part1 "http://<server_address>/api/data/uploads/<id>?offset=0"
+   A part with a wrong offset gets status 409 and the current offset. After a disconnect, ask for the offset with:
+   curl -H "Authorization: Bearer YOUR_ACCESS_TOKEN" http://<server_address>/api/data/uploads/<id>
+
+3. Commit the upload; the size and checksum are verified and the file is moved to its path:
+   curl -X POST -H "Authorization: Bearer YOUR_ACCESS_TOKEN" http://<server_address>/api/data/uploads/<id>/commit
+
+An unfinished upload can be cancelled with a DELETE request to /api/data/uploads/<id>.
+"""
+
+upload_input = api.model('UploadInput', {
+    'path': fields.String(required=True, description='The path where the file is stored'),
+    'size': fields.Integer(required=False, description='The size of the file in bytes'),
+    'checksum': fields.String(required=False, description='The checksum of the file as <algorithm>:<hex digest>, i.e. sha256:...')
+})
+
+@api.route('/uploads', methods=['POST'])
+class UploadsResource(Resource):
+
+    @api.doc('create_upload')
+    @api.expect(upload_input)
+    @auth.login_required
+    def post(self):
+        upload_data = request.get_json(silent=True)
+        if not upload_data or not upload_data.get('path'):
+            return error_response("No path provided", 400)
+        data_path = current_app.config['DATA_PATH']
+        req_path = secure_path(upload_data['path'])
+        if not is_safe_path(data_path, os.path.join(data_path, req_path)):
+            return error_response("Invalid path request", 403)
+        try:
+            upload = uploads.create(data_path, req_path, size=upload_data.get('size'), checksum=upload_data.get('checksum'))
+        except UploadError as e:
+            return upload_error_response(e)
+        response = jsonify(upload)
+        response.status_code = 201
+        return response
+
+@api.route('/uploads/<string:upload_id>', methods=['GET', 'PUT', 'DELETE'])
+class UploadResource(Resource):
+
+    @api.doc('get_upload')
+    @auth.login_required
+    def get(self, upload_id):
+        try:
+            return jsonify(uploads.get(current_app.config['DATA_PATH'], upload_id))
+        except UploadError as e:
+            return upload_error_response(e)
+
+    @api.doc('upload_part')
+    @auth.login_required
+    def put(self, upload_id):
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return error_response("No offset provided", 400)
+        try:
+            # the body is streamed to the part file, it is never read into memory as a whole
+            return jsonify(uploads.write(current_app.config['DATA_PATH'], upload_id, offset, request.stream, request.content_length))
+        except UploadError as e:
+            return upload_error_response(e)
+        except OSError as e:
+            logger.error(f"Failed to write upload {upload_id}: {e}")
+            return error_response("Failed to save file due to server error", 500)
+
+    @api.doc('abort_upload')
+    @auth.login_required
+    def delete(self, upload_id):
+        try:
+            uploads.abort(current_app.config['DATA_PATH'], upload_id)
+            return jsonify(message=f'Upload {upload_id} cancelled', status=200)
+        except UploadError as e:
+            return upload_error_response(e)
+
+@api.route('/uploads/<string:upload_id>/commit', methods=['POST'])
+class UploadCommitResource(Resource):
+
+    @api.doc('commit_upload')
+    @auth.login_required
+    def post(self, upload_id):
+        data_path = current_app.config['DATA_PATH']
+        checksum = (request.get_json(silent=True) or {}).get('checksum')
+        try:
+            upload = uploads.get(data_path, upload_id)
+            full_path = os.path.join(data_path, upload['path'])
+            if not is_safe_path(data_path, full_path):
+                return error_response("Invalid path request", 403)
+            upload = uploads.commit(data_path, upload_id, full_path, checksum=checksum)
+        except UploadError as e:
+            return upload_error_response(e)
+        except OSError as e:
+            logger.error(f"Failed to commit upload {upload_id}: {e}")
+            return error_response("Failed to save file due to server error", 500)
+        search_indexes.invalidate(full_path)
+        directory_listings.invalidate(os.path.dirname(full_path), data_path)
+        logger.debug("Stored file to: %s", upload['path'])
+        response = jsonify(upload)
+        response.status_code = 201
+        return response
+
+def upload_error_response(e):
+    response = jsonify({'error': str(e), 'upload': e.upload} if e.upload else {'error': str(e)})
+    response.status_code = e.status_code
+    return response
+
 """
 The Search endpoint (/search) makes a search over a set of documents.
 This requires that there is already a set of documents was stored in a jsonl file before.
@@ -214,75 +357,174 @@ The above command would give the following output:
 ```
 
 The response is computed in the following way:
-- the query is used to make a search over the documents in the file where all words must match
+- the query is used to make a search over the documents in the file where all words must match;
+  the search uses an inverted index of the file which is stored as `<file>.idx` next to it
+  and rebuilt whenever the file changes
 - if the search results has less than `max_rerank` documents, then the search is repeated with a fuzzy search
+  which allows one typo per word (two typos for words with 8 and more characters) and not all words to match
 - the `max_rerank` documents are ranked for similarity with the query and ordered by their score
 - the top `max_rerank` documents are returned
  
 The score has a range from 0 to 300 where 200 and more means that the document is semantically
-similar to the query.
+similar to the query. The lexical similarity, the BM25 score of the document relative to the best
+possible score of the query, makes up 0 to 100 of the score. Documents which match all words are
+always ranked before documents found by the fuzzy search.
+
+If an embedding model is configured with --embedding_model, the lexical candidates (four per
+requested document) are reranked by their semantic similarity: the score is the lexical score plus
+200 times the cosine similarity of the document and the query embeddings, at most 300.
+The document embeddings are stored as `<file>.emb` next to the file. The optional `mode` parameter
+selects "lexical" (no reranking), "hybrid" (the default) or "semantic", which searches the nearest
+documents by embedding only.
+
+A catalog which is split into several jsonl files (shards) is searched at once by giving a list of
+files and/or glob patterns as `file`, i.e. "file": "share/catalog-*.jsonl". The shards are searched
+in worker threads and their results are merged by score, every result names its shard in `file_id`.
+With "debug": true the response is an object with the documents in `results` and the time spent
+per shard in `debug`.
 """
 
 # Define the model for the search input
 search_input = api.model('SearchInput', {
-    'file': fields.String(required=True, description='The filename to search in'),
+    'file': fields.Raw(required=True, description='The filename to search in, a glob pattern or a list of them'),
     'query': fields.String(required=True, description='The query to search for'),
-    'max_rerank': fields.Integer(required=False, description='Maximum number of documents to rerank')
+    'max_rerank': fields.Integer(required=False, description='Maximum number of documents to rerank'),
+    'mode': fields.String(required=False, description='lexical, hybrid (default) or semantic'),
+    'debug': fields.Boolean(required=False, description='Add the search time per file to the response')
 })
 
+# the shards of a search are searched in worker threads; this overlaps loading the indexes and reading
+# the documents and the numpy parts of the BM25 scoring, but the fuzzy pass is pure Python and is not
+# spread over the cores. Worker processes would each hold their own indexes and embedding model.
+MAX_SHARDS = 256
+search_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='search')
+
 @api.route('/search', methods=['POST'])
 class SearchResource(Resource):
     @api.expect(search_input)
     def post(self):
         # Extract the search parameters from the request
         search_data = request.get_json()
-        if not search_data:
+        if not search_data or not isinstance(search_data, dict):
             return error_response("Invalid JSON input", 400)
 
-        query = search_data['query']
-        file = search_data['file']
+        query = search_data.get('query')
+        file = search_data.get('file')
         max_rerank = search_data.get('max_rerank')  # Get max_rerank from input, if provided
-
-        # Load the JSON lines file
+        mode = search_data.get('mode', 'hybrid')
+        if not isinstance(query, str):
+            return error_response("Invalid query, a string is expected", 400)
+        names = file if isinstance(file, list) else [file]
+        if not names or not all(isinstance(name, str) for name in names):
+            return error_response("Invalid file, a file name or a list of file names is expected", 400)
+        if max_rerank is not None and (not isinstance(max_rerank, int) or isinstance(max_rerank, bool) or max_rerank < 0):
+            return error_response("Invalid max_rerank, a non-negative integer is expected", 400)
+        if mode not in ('lexical', 'hybrid', 'semantic'):
+            return error_response("Invalid mode, use lexical, hybrid or semantic", 400)
+        if mode == 'semantic' and not document_embeddings.enabled:
+            return error_response("No embedding model configured", 400)
+
+        # Find the JSON lines files, a file name can be a glob pattern
         data_path = current_app.config['DATA_PATH']
-        file_path = os.path.join(data_path, file)
-        if not os.path.isfile(file_path):
+        files = []
+        for name in names:
+            file_path = os.path.join(data_path, name)
+            if not is_safe_path(data_path, file_path):
+                return error_response("Invalid path request", 403)
+            if glob.has_magic(name):
+                files += [(os.path.relpath(path, data_path), path) for path in sorted(glob.glob(file_path))
+                          if is_safe_path(data_path, path) and os.path.isfile(path) and not path.endswith((INDEX_SUFFIX, EMBEDDING_SUFFIX))]
+            elif not os.path.isfile(file_path) or file_path.endswith((INDEX_SUFFIX, EMBEDDING_SUFFIX)):
+                return error_response("File not found", 404)
+            else:
+                files.append((name, file_path))
+        files = list(dict.fromkeys(files))
+        if not files:
             return error_response("File not found", 404)
+        if len(files) > MAX_SHARDS:
+            return error_response(f"Too many files, at most {MAX_SHARDS} can be searched at once", 400)
 
-        # Read the file
-        documents = []
-        with open(file_path, 'r') as f:
-            documents = [json.loads(line) for line in f]
-
-        # Tokenize the search query
-        search_tokens = set(query.lower().split())
-
-        # Use the simple_search function with max_rerank
-        matched_documents = simple_search(search_tokens, documents, max_rerank)
+        # Search all shards in the worker threads, every shard returns its best documents
+        start = time.time()
+        try:
+            if len(files) == 1:
+                shards = [search_file(files[0][0], files[0][1], query, max_rerank, mode)]
+            else:
+                shards = list(search_executor.map(lambda shard: search_file(shard[0], shard[1], query, max_rerank, mode), files))
+        except (OSError, ValueError) as e:
+            # the index of a file could not be built or read
+            logger.error(f"Failed to search {file}: {e}")
+            return error_response("Failed to index file", 500)
+
+        # the shards are searched in worker threads, their stages are added to the route of this request
+        route = g.get('metrics_route', 'background')
+        for _, debug in shards:
+            for name in ('index', 'embed', 'rank', 'read'):
+                request_metrics.observe_stage(route, name, debug[name + '_ms'] / 1000)
+
+        # Merge the sorted results of the shards
+        with stage('merge'):
+            merged = heapq.merge(*[documents for documents, _ in shards], key=lambda document: -document['score'])
+            matched_documents = list(merged if max_rerank is None else itertools.islice(merged, max_rerank))
 
         # Return the matched documents
+        if search_data.get('debug', False):
+            return jsonify({'results': matched_documents,
+                            'debug': {'total_ms': round((time.time() - start) * 1000, 2), 'shards': [debug for _, debug in shards]}})
         return jsonify(matched_documents)
 
-
-def simple_search(search_tokens, documents, max_rerank=None):
+def search_file(file, file_path, query, max_rerank=None, mode='hybrid'):
     """
-    Perform a simple search for documents containing all the search tokens,
-    returning up to max_rerank documents.
-    
-    :param search_tokens: A set of tokens to search for
-    :param documents: A list of documents to search through
+    Search one jsonl file.
+
+    :param file: The file name relative to the data path, it is returned as file_id
+    :param file_path: The absolute path of the file
+    :param query: The query string
     :param max_rerank: The maximum number of documents to return
-    :return: A list of documents that match the search tokens
+    :param mode: 'lexical', 'hybrid' or 'semantic'
+    :return: The matched documents, best first, and the timing of the search
     """
-    matched_documents = []
-    for doc in documents:
-        # Stop if we have reached the max_rerank number of documents
-        if max_rerank is not None and len(matched_documents) >= max_rerank:
-            break
-        
-        doc_tokens = set(doc['text_t'].lower().split())
-        if search_tokens.issubset(doc_tokens):
-            matched_documents.append(doc)
-    
-    return matched_documents
+    start = time.time()
+    index = search_indexes.get(file_path)
+    indexed = time.time()
 
+    # Embed the query if the document embeddings are ready
+    matrix, query_vector = None, None
+    if document_embeddings.enabled and mode != 'lexical':
+        try:
+            matrix = document_embeddings.get(index)
+            if matrix is not None:
+                query_vector = document_embeddings.embed_query(query)
+        except Exception as e:
+            logger.error(f"Failed to embed the search in {file}: {e}")
+            matrix = None
+    embedded = time.time()
+
+    # Rank the documents and read the top max_rerank documents
+    if matrix is not None and mode == 'semantic':
+        ranked = [(doc_id, semantic_score(0.0, similarity))
+                  for doc_id, similarity in matrix.nearest(query_vector, max_rerank or DEFAULT_LIMIT)]
+    elif matrix is not None:
+        candidates = rank(index, query, None if max_rerank is None else max_rerank * RERANK_FACTOR)
+        ranked = rerank(matrix, query_vector, candidates, len(candidates) if max_rerank is None else max_rerank)
+    else:
+        ranked = rank(index, query, max_rerank)
+    ranked_time = time.time()
+    matched_documents = []
+    for document, (doc_id, score) in zip(index.read([doc_id for doc_id, _ in ranked]), ranked):
+        document['file_id'] = file
+        document['score'] = score
+        matched_documents.append(document)
+    end = time.time()
+
+    return matched_documents, {
+        'file_id': file,
+        'documents': index.count,
+        'hits': len(matched_documents),
+        'semantic': matrix is not None,
+        'index_ms': round((indexed - start) * 1000, 2),
+        'embed_ms': round((embedded - indexed) * 1000, 2),
+        'rank_ms': round((ranked_time - embedded) * 1000, 2),
+        'read_ms': round((end - ranked_time) * 1000, 2),
+        'total_ms': round((end - start) * 1000, 2)
+    }
@@ -0,0 +1,215 @@
+import os, re, json, time, uuid, hashlib, logging, threading
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+MAX_AGE = 24 * 3600 # unfinished uploads are removed after one day without progress
+# the guaranteed algorithms with a fixed digest length, the shake algorithms need a length for hexdigest
+CHECKSUM_ALGORITHMS = tuple(sorted(name for name in hashlib.algorithms_guaranteed if not name.startswith('shake_')))
+
+class UploadError(Exception):
+    def __init__(self, message, status_code=400, upload=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.upload = upload # the state of the upload, i.e. the offset to resume from
+
+"""
+Resumable chunked uploads.
+
+An upload is created for a target path, then its parts are written in order, each at the offset
+where the previous part ended, and finally the upload is committed. The parts are streamed from
+the request body to `protected/uploads/<id>.part` in the data path in blocks of BLOCK_SIZE bytes,
+so an upload of any size needs only constant memory. The state of an upload is stored next to the
+part file as `<id>.json`; after a disconnect or a restart the client asks for the offset and
+continues from there. On commit the size and an optional checksum (i.e. 'sha256:<hex>') are
+verified and the file is moved to its target with an atomic rename, so the target never contains
+a partial file. The checksum is computed while the parts arrive and only recomputed from the file
+if the upload was resumed after a restart.
+"""
+class UploadStore:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._hashes = {} # upload id -> (offset, hash object) of the checksum of the received bytes
+
+    def create(self, data_path, target, size=None, checksum=None):
+        """
+        :param data_path: The data path
+        :param target: The target path of the file, relative to the data path
+        :param size: The expected size in bytes or None
+        :param checksum: The expected checksum as '<algorithm>:<hex digest>' or None
+        :return: The state of the new upload
+        """
+        if size is not None and (not isinstance(size, int) or isinstance(size, bool) or size < 0):
+            raise UploadError('Invalid size', 400)
+        if checksum is not None:
+            _parse_checksum(checksum)
+        directory = self._directory(data_path)
+        os.makedirs(directory, exist_ok=True)
+        self._expire(directory)
+        upload = {'id': uuid.uuid4().hex, 'path': target, 'size': size, 'checksum': checksum, 'created': int(time.time())}
+        open(os.path.join(directory, upload['id'] + '.part'), 'wb').close()
+        _write_json(os.path.join(directory, upload['id'] + '.json'), upload)
+        return self._state(directory, upload)
+
+    def get(self, data_path, upload_id):
+        directory = self._directory(data_path)
+        return self._state(directory, self._load(directory, upload_id))
+
+    def write(self, data_path, upload_id, offset, stream, length=None):
+        """
+        Write a part of an upload.
+
+        :param offset: The offset of the part, it must be the current size of the upload
+        :param stream: A file-like object with the part
+        :param length: The length of the part or None to read the stream until its end
+        :return: The state of the upload
+        """
+        directory = self._directory(data_path)
+        with self._upload_lock(upload_id):
+            upload = self._load(directory, upload_id)
+            part_path = os.path.join(directory, upload_id + '.part')
+            current = os.path.getsize(part_path)
+            if offset != current:
+                raise UploadError(f'The upload continues at offset {current}', 409, self._state(directory, upload))
+            if upload['size'] is not None and length is not None and offset + length > upload['size']:
+                raise UploadError('The part exceeds the size of the upload', 413, self._state(directory, upload))
+            with self._lock:
+                hashed = self._hashes.pop(upload_id, None)
+            if hashed is not None and hashed[0] != offset:
+                hashed = None
+            written = 0
+            with open(part_path, 'r+b') as f:
+                f.seek(offset)
+                try:
+                    while length is None or written < length:
+                        block = stream.read(BLOCK_SIZE if length is None else min(BLOCK_SIZE, length - written))
+                        if not block:
+                            break
+                        if upload['size'] is not None and offset + written + len(block) > upload['size']:
+                            raise UploadError('The part exceeds the size of the upload', 413)
+                        f.write(block)
+                        written += len(block)
+                        if hashed is not None:
+                            hashed[1].update(block)
+                finally:
+                    # keep what was received, the client resumes after the last complete block
+                    f.truncate(offset + written)
+                    if hashed is not None:
+                        with self._lock:
+                            self._hashes[upload_id] = (offset + written, hashed[1])
+            return self._state(directory, upload)
+
+    def commit(self, data_path, upload_id, target_path, checksum=None):
+        """
+        Verify an upload and move it to its target.
+
+        :param target_path: The absolute target path
+        :param checksum: A checksum to verify in addition to the one given at the creation
+        :return: The state of the upload
+        """
+        directory = self._directory(data_path)
+        with self._upload_lock(upload_id):
+            upload = self._load(directory, upload_id)
+            part_path = os.path.join(directory, upload_id + '.part')
+            state = self._state(directory, upload)
+            if upload['size'] is not None and state['offset'] != upload['size']:
+                raise UploadError(f"The upload is incomplete, {state['offset']} of {upload['size']} bytes were received", 409, state)
+            for expected in [value for value in (upload['checksum'], checksum) if value]:
+                algorithm, digest = _parse_checksum(expected)
+                if self._digest(upload_id, part_path, algorithm, state['offset']) != digest:
+                    raise UploadError(f'The {algorithm} checksum does not match', 422, state)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            os.replace(part_path, target_path)
+            self._remove(directory, upload_id)
+            state['committed'] = True
+            return state
+
+    def abort(self, data_path, upload_id):
+        directory = self._directory(data_path)
+        with self._upload_lock(upload_id):
+            self._load(directory, upload_id)
+            self._remove(directory, upload_id)
+
+    def _digest(self, upload_id, part_path, algorithm, size):
+        # use the checksum computed while writing if it covers the whole file
+        with self._lock:
+            hashed = self._hashes.get(upload_id)
+        if hashed is not None and hashed[0] == size and hashed[1].name == algorithm:
+            return hashed[1].hexdigest()
+        checksum = hashlib.new(algorithm)
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                checksum.update(block)
+        return checksum.hexdigest()
+
+    def _directory(self, data_path):
+        return os.path.join(data_path, 'protected', 'uploads')
+
+    def _load(self, directory, upload_id):
+        if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+            raise UploadError('Upload not found', 404)
+        try:
+            with open(os.path.join(directory, upload_id + '.json')) as f:
+                upload = json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404)
+        if upload.get('checksum') and os.path.getsize(os.path.join(directory, upload_id + '.part')) == 0:
+            # start the checksum with the first part
+            with self._lock:
+                if upload_id not in self._hashes:
+                    self._hashes[upload_id] = (0, hashlib.new(_parse_checksum(upload['checksum'])[0]))
+        return upload
+
+    def _state(self, directory, upload):
+        state = dict(upload)
+        state['offset'] = os.path.getsize(os.path.join(directory, upload['id'] + '.part'))
+        return state
+
+    def _remove(self, directory, upload_id):
+        with self._lock:
+            self._hashes.pop(upload_id, None)
+            self._locks.pop(upload_id, None)
+        for suffix in ('.part', '.json'):
+            try:
+                os.remove(os.path.join(directory, upload_id + suffix))
+            except FileNotFoundError:
+                pass
+
+    def _upload_lock(self, upload_id):
+        with self._lock:
+            return self._locks.setdefault(upload_id, threading.Lock())
+
+    def _expire(self, directory):
+        now = time.time()
+        for entry in os.scandir(directory):
+            if not entry.name.endswith('.part'):
+                continue
+            try:
+                expired = entry.stat().st_mtime < now - MAX_AGE
+            except FileNotFoundError:
+                # the upload was committed or removed meanwhile
+                continue
+            if expired:
+                upload_id = entry.name[:-len('.part')]
+                with self._upload_lock(upload_id):
+                    self._remove(directory, upload_id)
+                logger.debug("Removed expired upload %s", upload_id)
+
+def _parse_checksum(checksum):
+    if not isinstance(checksum, str):
+        raise UploadError('Invalid checksum, use <algorithm>:<hex digest>, i.e. sha256:...', 400)
+    algorithm, _, digest = checksum.rpartition(':')
+    algorithm = (algorithm or 'sha256').lower()
+    if algorithm not in CHECKSUM_ALGORITHMS or not re.fullmatch(r'[0-9a-fA-F]+', digest):
+        raise UploadError('Invalid checksum, use <algorithm>:<hex digest>, i.e. sha256:...', 400)
+    return algorithm, digest.lower()
+
+def _write_json(path, data):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+uploads = UploadStore()
@@ -0,0 +1,275 @@
+import time, uuid, logging, threading
+import requests
+from requests.adapters import HTTPAdapter
+from flask import Response
+from system.metrics_sampler import metrics_sampler
+from system.instrumentation import request_metrics
+
+logger = logging.getLogger(__name__)
+
+# requests which were forwarded by a peer carry its node id in this header and are never forwarded again
+FORWARDED_HEADER = 'X-Susi-Forwarded'
+# forwarded responses name the peer which made them
+PEER_HEADER = 'X-Susi-Peer'
+# peers with less available memory are not chosen
+MAX_RAM_PERCENT = 95
+
+"""
+The cluster mode lets a busy node hand transcriptions and chat completions to its peers.
+
+Every node publishes its load and its resident models in the 'cluster' section of status.json,
+also without peers, so that any node can be a peer of another. The load is the larger of the
+used share of all cpu cores and the number of requests in progress per core, so 1.0 means that
+the node is fully used. A node with peers polls their status.json every `interval` seconds.
+A peer which cannot be reached or fails a forwarded request is taken out of the rotation and
+polled again after a backoff which doubles with every failure up to `max_backoff` seconds. A peer
+which answers with 503 is only busy, it stays in the rotation and the request is made locally.
+
+A request is forwarded to the least loaded peer which has the requested model resident, if
+- this node does not have the model resident and the peer is not busy, or
+- this node is busy (its load is at least `busy`) and the peer is less loaded.
+The requests which are in progress on a peer are added to the load of its last status, so that
+all requests between two polls do not go to the same peer. If the peer fails, the request is
+executed locally. The peer list may contain the node itself, it is recognized by its node id.
+
+call i.e. on three local instances:
+python3 src/main.py --port 8081 --peers http://localhost:8082,http://localhost:8083
+"""
+
+class Peer:
+
+    def __init__(self, url, pool_size=8):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.node_id = None
+        self.load = None
+        self.cpu_count = 1
+        self.ram_percent = 0
+        self.models = {} # kind -> set of resident model names
+        self.healthy = False
+        self.failures = 0
+        self.next_poll = 0.0
+        self.last_seen = None
+        self.in_flight = 0 # forwarded requests in progress
+        self.forwarded = 0
+        self.errors = 0
+
+    def effective_load(self):
+        return self.load + self.in_flight / max(1, self.cpu_count)
+
+    def stats(self):
+        return {'url': self.url, 'node_id': self.node_id, 'healthy': self.healthy, 'load': self.load,
+                'in_flight': self.in_flight, 'models': {kind: sorted(names) for kind, names in self.models.items()},
+                'failures': self.failures, 'last_seen': self.last_seen, 'forwarded': self.forwarded, 'errors': self.errors}
+
+class Cluster:
+
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self.peers = []
+        self.interval = 5.0
+        self.max_backoff = 60.0
+        self.busy = 0.8
+        self.connect_timeout = 1.0
+        self.read_timeout = 120.0
+        self.model_providers = {} # kind -> function which returns the resident model names
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.forwarded = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self):
+        return len(self.peers) > 0
+
+    def configure(self, peers=None, interval=None, max_backoff=None, busy=None, connect_timeout=None, read_timeout=None):
+        """
+        :param peers: A list of base URLs of the peers, i.e. ['http://localhost:8082']
+        :param interval: Seconds between two polls of the status of a peer
+        :param busy: The load from which on this node forwards requests to less loaded peers
+        :param read_timeout: Seconds to wait for the response of a forwarded request
+        """
+        if peers is not None: self.peers = [Peer(url) for url in peers]
+        if interval is not None: self.interval = max(0.5, interval)
+        if max_backoff is not None: self.max_backoff = max(self.interval, max_backoff)
+        if busy is not None: self.busy = busy
+        if connect_timeout is not None: self.connect_timeout = connect_timeout
+        if read_timeout is not None: self.read_timeout = read_timeout
+
+    def add_models(self, kind, provider):
+        """
+        :param kind: The kind of work, 'transcription' or 'chat'
+        :param provider: A function which returns the names of the models of this kind which are resident
+        """
+        self.model_providers[kind] = provider
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='cluster-poller', daemon=True)
+        self._thread.start()
+        logger.info("Cluster mode with %d peers: %s", len(self.peers), ', '.join(peer.url for peer in self.peers))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.time()
+            for peer in self.peers:
+                if peer.node_id != self.node_id and peer.next_poll <= now:
+                    self.poll(peer)
+            next_poll = min((peer.next_poll for peer in self.peers if peer.node_id != self.node_id), default=now + self.interval)
+            self._stop.wait(max(0.1, next_poll - time.time()))
+
+    def poll(self, peer):
+        try:
+            response = peer.session.get(peer.url + '/api/system/status.json', timeout=(self.connect_timeout, max(2.0, self.interval)))
+            response.raise_for_status()
+            status = response.json().get('cluster') or {}
+        except (requests.RequestException, ValueError) as e:
+            self._failed(peer, f"status poll failed: {e}")
+            return
+        with self._lock:
+            peer.node_id = status.get('node_id')
+            peer.load = status.get('load')
+            peer.cpu_count = status.get('cpu_count') or 1
+            peer.ram_percent = status.get('ram_percent') or 0
+            peer.models = {kind: set(names) for kind, names in (status.get('models') or {}).items()}
+            healthy = peer.load is not None and peer.node_id != self.node_id
+            if healthy and not peer.healthy:
+                logger.info("Peer %s is available", peer.url)
+            peer.healthy = healthy
+            peer.failures = 0
+            peer.last_seen = time.time()
+            peer.next_poll = peer.last_seen + self.interval
+        if peer.node_id == self.node_id:
+            logger.info("Peer %s is this node, it is not used", peer.url)
+
+    def _failed(self, peer, reason):
+        with self._lock:
+            if peer.healthy or peer.failures == 0:
+                logger.warning("Peer %s is unavailable, %s", peer.url, reason)
+            peer.healthy = False
+            peer.failures += 1
+            peer.errors += 1
+            # exponential backoff, the next poll brings the peer back into the rotation
+            peer.next_poll = time.time() + min(self.max_backoff, self.interval * 2 ** (peer.failures - 1))
+
+    def load(self):
+        """
+        :return: The load of this node, the larger of the used share of the cpu cores and the requests in progress per core
+        """
+        snapshot = metrics_sampler.snapshot()
+        cpu_count = snapshot.get('cpu_count') or 1
+        # the request which asks for the load is not counted
+        in_flight = max(0, request_metrics.requests_in_flight() - 1)
+        return round(max(snapshot.get('cpu_usage_percent', 0) / (100.0 * cpu_count), in_flight / cpu_count), 3)
+
+    def select(self, kind, model_name, local_resident):
+        """
+        :param kind: The kind of work, 'transcription' or 'chat'
+        :param local_resident: True if this node has the model resident
+        :return: The peer which should make the request or None if it is made locally
+        """
+        with self._lock:
+            candidates = [peer for peer in self.peers if peer.healthy and model_name in peer.models.get(kind, ())
+                          and peer.ram_percent < MAX_RAM_PERCENT]
+            if not candidates:
+                return None
+            peer = min(candidates, key=Peer.effective_load)
+            peer_load = peer.effective_load()
+        if not local_resident:
+            return peer if peer_load < self.busy else None
+        load = self.load()
+        return peer if load >= self.busy and peer_load < load else None
+
+    def forward(self, kind, model_name, local_resident, request_headers, path, stream=False, **kwargs):
+        """
+        Forward a request to a peer if this node is busy or does not have the model resident.
+
+        :param request_headers: The headers of the incoming request, forwarded requests are not forwarded again
+        :param path: The path of the endpoint on the peer, i.e. '/api/text/chat/completions'
+        :param kwargs: The body of the request as for requests.post, i.e. json=data
+        :return: The response of the peer, which must be handed to response() or chunks(), or None
+                 if the request should be made locally
+        """
+        if not self.enabled or FORWARDED_HEADER in request_headers:
+            return None
+        peer = self.select(kind, model_name, local_resident)
+        if peer is None:
+            return None
+        with self._lock:
+            peer.in_flight += 1
+        try:
+            response = peer.session.post(peer.url + path, headers={FORWARDED_HEADER: self.node_id}, stream=stream,
+                                         timeout=(self.connect_timeout, self.read_timeout), **kwargs)
+        except requests.RequestException as e:
+            response, reason = None, str(e)
+        else:
+            reason = f"status {response.status_code}" if response.status_code >= 500 else None
+        if reason is not None:
+            if response is not None:
+                response.close()
+            self._done(peer)
+            if response is not None and response.status_code == 503:
+                # the peer is busy, i.e. its transcription queue is full, but healthy
+                logger.debug("Peer %s is busy, the request is made locally", peer.url)
+            else:
+                self._failed(peer, f"forwarding failed: {reason}")
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        with self._lock:
+            peer.forwarded += 1
+            self.forwarded += 1
+        response.peer, response.streamed = peer, stream
+        if not stream:
+            self._done(peer)
+        return response
+
+    def _done(self, peer):
+        with self._lock:
+            peer.in_flight -= 1
+
+    def chunks(self, response):
+        """
+        :return: The body of a forwarded response as an iterator of bytes, for streamed responses as they arrive
+        """
+        try:
+            yield from response.iter_content(chunk_size=None)
+        finally:
+            response.close()
+            if response.streamed:
+                self._done(response.peer)
+
+    def response(self, response):
+        """
+        :return: A flask response with the status, content type and body of a forwarded response
+        """
+        headers = {PEER_HEADER: response.peer.url}
+        content_type = response.headers.get('Content-Type')
+        return Response(self.chunks(response), status=response.status_code, headers=headers, content_type=content_type)
+
+    def stats(self):
+        snapshot = metrics_sampler.snapshot()
+        models = {}
+        for kind, provider in self.model_providers.items():
+            try:
+                models[kind] = list(provider())
+            except Exception as e:
+                logger.warning(f"Failed to list the resident {kind} models: {e}")
+        with self._lock:
+            return {'node_id': self.node_id, 'load': self.load(), 'cpu_count': snapshot.get('cpu_count'),
+                    'ram_percent': snapshot.get('ram_percent'), 'models': models, 'busy': self.busy,
+                    'forwarded': self.forwarded, 'fallbacks': self.fallbacks, 'peers': [peer.stats() for peer in self.peers]}
+
+cluster = Cluster()
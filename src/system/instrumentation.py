@@ -0,0 +1,265 @@
+import re, sys, time, math, bisect, logging, threading, contextvars
+from collections import Counter
+from contextlib import contextmanager
+from flask import request, g, has_request_context, Response
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# the route of the current request outside of flask, i.e. in the handlers of the ASGI server
+current_route = contextvars.ContextVar('current_route', default='background')
+
+"""
+Request instrumentation and Prometheus exposition.
+
+Every request is counted per route template (i.e. /api/data/<path:req_path>), method and status
+code, its latency goes into a histogram and the requests in progress are counted per route. The
+latency of a streamed response ends when the response is handed to the server, the stream itself
+is not included. Inside a request, named stages are timed with
+
+    with stage('model_load'):
+        ...
+
+and stages measured elsewhere, i.e. in worker threads, are added with observe_stage. Requests
+which are not handled by flask are recorded with start_request and finish_request. Everything
+is exposed in the Prometheus text format on /metrics, together with the numeric values of
+/api/system/status.json as gauges.
+"""
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class RequestMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter() # (route, method, status) -> number of requests
+        self.latencies = {} # (route, method) -> Histogram
+        self.in_flight = Counter() # route -> number of requests in progress
+        self.stages = {} # (route, stage) -> Histogram
+        self.status = None # a function which returns the status.json dictionary
+
+    def init_app(self, app, status=None):
+        """
+        Instrument all requests of a flask app and add the /metrics endpoint.
+
+        :param status: A function which returns the status dictionary exported as gauges
+        """
+        self.status = status
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_response)
+
+    def observe_stage(self, route, name, seconds):
+        with self._lock:
+            histogram = self.stages.get((route, name))
+            if histogram is None:
+                histogram = self.stages[(route, name)] = Histogram()
+            histogram.observe(seconds)
+
+    def start_request(self, route):
+        with self._lock:
+            self.in_flight[route] += 1
+
+    def finish_request(self, route, method, status, seconds):
+        with self._lock:
+            self.in_flight[route] -= 1
+            self.requests[(route, method, status)] += 1
+            histogram = self.latencies.get((route, method))
+            if histogram is None:
+                histogram = self.latencies[(route, method)] = Histogram()
+            histogram.observe(seconds)
+
+    def requests_in_flight(self):
+        with self._lock:
+            return sum(self.in_flight.values())
+
+    def _before_request(self):
+        g.metrics_route = _route()
+        g.metrics_start = time.perf_counter()
+        self.start_request(g.metrics_route)
+
+    def _after_request(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def _teardown_request(self, exception):
+        if 'metrics_start' not in g:
+            return
+        self.finish_request(g.metrics_route, request.method, g.get('metrics_status', 500), time.perf_counter() - g.metrics_start)
+
+    def metrics_response(self):
+        return Response(self.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            lines += ['# HELP susi_http_requests_total Number of finished requests',
+                      '# TYPE susi_http_requests_total counter']
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'susi_http_requests_total{_labels(route=route, method=method, status=status)} {count}')
+            lines += ['# HELP susi_http_requests_in_flight Number of requests in progress',
+                      '# TYPE susi_http_requests_in_flight gauge']
+            for route, count in sorted(self.in_flight.items()):
+                lines.append(f'susi_http_requests_in_flight{_labels(route=route)} {count}')
+            lines += ['# HELP susi_http_request_duration_seconds Latency of the requests',
+                      '# TYPE susi_http_request_duration_seconds histogram']
+            for (route, method), histogram in sorted(self.latencies.items()):
+                lines += _histogram_lines('susi_http_request_duration_seconds', histogram, route=route, method=method)
+            lines += ['# HELP susi_stage_duration_seconds Time spent in the stages of a request',
+                      '# TYPE susi_stage_duration_seconds histogram']
+            for (route, name), histogram in sorted(self.stages.items()):
+                lines += _histogram_lines('susi_stage_duration_seconds', histogram, route=route, stage=name)
+        if self.status is not None:
+            try:
+                status = self.status()
+            except Exception as e:
+                logger.warning("Failed to read the status for the metrics: %s", e)
+                status = {}
+            for name, value in _numeric_values(status, 'susi_status'):
+                lines += [f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+def _route():
+    # the route template keeps the number of label values bounded
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+def _labels(**labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def _histogram_lines(name, histogram, **labels):
+    lines, cumulative = [], 0
+    for bound, count in zip(BUCKETS + (math.inf,), histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{_labels(**labels, le="+Inf" if bound == math.inf else bound)} {cumulative}')
+    lines.append(f'{name}_sum{_labels(**labels)} {histogram.sum}')
+    lines.append(f'{name}_count{_labels(**labels)} {histogram.count}')
+    return lines
+
+def _numeric_values(value, name):
+    # flatten nested dictionaries to metric names, i.e. status['upstream']['requests'] -> susi_status_upstream_requests
+    if isinstance(value, bool):
+        yield name, int(value)
+    elif isinstance(value, (int, float)):
+        if math.isfinite(value):
+            yield name, value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _numeric_values(item, name + '_' + re.sub(r'[^a-zA-Z0-9_]', '_', str(key)))
+
+request_metrics = RequestMetrics()
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the current request, i.e. with stage('decode'): ...
+    Outside of a flask request the stage is counted for the route in current_route.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        route = g.get('metrics_route', 'background') if has_request_context() else current_route.get()
+        request_metrics.observe_stage(route, name, time.perf_counter() - start)
+
+"""
+A sampling profiler which can be switched on and off at runtime.
+
+While it runs, a thread takes the stacks of all other threads every `interval` seconds and counts
+them in the folded format of flamegraph.pl ('module:function;module:function count' per line),
+which can also be loaded into speedscope. The profiler stops by itself after `duration` seconds
+so that it is not left running by accident.
+"""
+class SamplingProfiler:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = 0.01
+        self.started = None
+        self.stopped = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=0.01, duration=60):
+        """
+        Start profiling, the stacks of an earlier run are discarded.
+
+        :param interval: Seconds between two samples
+        :param duration: Seconds after which the profiler stops
+        :return: False if the profiler is running already
+        """
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.interval = max(0.001, interval)
+            self.started, self.stopped = time.time(), None
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(duration,), name='sampling-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def folded(self):
+        """
+        :return: The sampled stacks in the folded format, most frequent first
+        """
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def stats(self):
+        return {'running': self.running, 'interval': self.interval, 'samples': self.samples,
+                'stacks': len(self.stacks), 'started': self.started, 'stopped': self.stopped}
+
+    def _run(self, duration):
+        own = threading.get_ident()
+        end = time.time() + duration
+        while not self._stop.wait(self.interval) and time.time() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                functions = []
+                while frame is not None:
+                    functions.append(f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                with self._lock:
+                    self.stacks[';'.join(reversed(functions))] += 1
+            self.samples += 1
+        self.stopped = time.time()
+        with self._lock:
+            if self._thread is threading.current_thread():
+                self._thread = None
+
+profiler = SamplingProfiler()
@@ -0,0 +1,221 @@
+import os, json, glob, time, socket, logging, datetime, threading, http.client
+import psutil
+
+logger = logging.getLogger(__name__)
+
+DOCKER_SOCKET = '/var/run/docker.sock'
+DOCKER_TIMEOUT = 1.0
+HOST_REFRESH = 300 # seconds after which the host name and ip are looked up again
+
+"""
+Background sampler for the system metrics of /api/system/status.json.
+
+All values are read without starting a process: cpu, memory and load from psutil, the disk space
+from os.statvfs, the temperature from sysfs, the host ip from the routing of a udp socket and the
+docker counts from the docker socket with a short timeout. A thread samples them every `interval`
+seconds into a snapshot, so the status endpoint only copies a dictionary. With an interval of 0
+the metrics are sampled on every call.
+"""
+
+# tools to extract metrics
+def getHostname():
+    return socket.gethostname()
+
+def getHostip():
+    # connecting a udp socket sends nothing, it only selects the interface of the default route
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(('10.255.255.255', 1))
+            return s.getsockname()[0]
+    except OSError:
+        pass
+    for addresses in psutil.net_if_addrs().values():
+        for address in addresses:
+            if address.family == socket.AF_INET and address.broadcast:
+                return address.address
+    return "127.0.0.1"
+
+def getCPUtemperature():
+    # the first thermal zone is the cpu on the raspberry pi and most other boards
+    for zone in sorted(glob.glob('/sys/class/thermal/thermal_zone*/temp')):
+        try:
+            with open(zone) as f:
+                return int(f.read().strip()) / 1000.0
+        except (OSError, ValueError):
+            continue
+    return 0.0
+
+def getCPUuse():
+    # the sum over all cores since the previous call, like the sum of the %cpu column of ps
+    return round(psutil.cpu_percent(interval=None) * (psutil.cpu_count() or 1), 1)
+
+def getCPUload():
+    return psutil.getloadavg()
+
+def getDiskSpace(path='/'):
+    """
+    :return: total, used and free (available to users) size in GB and the used percentage like df
+    """
+    st = os.statvfs(path)
+    total = st.f_blocks * st.f_frsize
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    free = st.f_bavail * st.f_frsize
+    percent = -(-100 * used // (used + free)) if used + free > 0 else 0 # rounded up like df
+    gb = 1024.0 ** 3
+    return round(total / gb, 3), round(used / gb, 3), round(free / gb, 3), int(percent)
+
+class DockerConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def getDockerCount(resource, socket_path=DOCKER_SOCKET, timeout=DOCKER_TIMEOUT):
+    """
+    :param resource: The docker api path which lists the objects, i.e. /images/json
+    :return: The number of objects as string, "0" if docker is not available
+    """
+    if not os.path.exists(socket_path):
+        return "0"
+    connection = DockerConnection(socket_path, timeout)
+    try:
+        connection.request('GET', resource)
+        response = connection.getresponse()
+        if response.status != 200:
+            return "0"
+        return str(len(json.loads(response.read())))
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        logger.debug("Docker is not available: %s", e)
+        return "0"
+    finally:
+        connection.close()
+
+def getDockerImages():
+    return getDockerCount('/images/json')
+def getRunningDockerContainer():
+    return getDockerCount('/containers/json')
+def getAllDockerContainer():
+    return getDockerCount('/containers/json?all=1')
+
+class MetricsSampler:
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self._snapshot = None
+        self._host = None # (host name, host ip, lookup time)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.samples = 0
+        self.sample_ms = 0.0 # duration of the latest sample
+        psutil.cpu_percent(interval=None) # the first call starts the measurement of the cpu usage
+
+    def configure(self, interval=None):
+        if interval is not None: self.interval = max(0.0, interval)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self.interval <= 0:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='metrics-sampler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def snapshot(self):
+        """
+        :return: A copy of the latest metrics; the first call samples them and starts the sampler thread
+        """
+        snapshot = self._snapshot
+        if snapshot is None or self.interval <= 0:
+            snapshot = self.sample()
+            self.start()
+        return dict(snapshot)
+
+    def sample(self):
+        start = time.time()
+        hostname, hostip = self._host_names()
+        cputemp = getCPUtemperature()
+        cpuload = getCPUload()
+        cpuuse  = getCPUuse()
+        cpuload0 = cpuload[0]
+        cpuload1 = cpuload[1]
+        cpuload2 = cpuload[2]
+        vm = psutil.virtual_memory()
+        RAM_stats = [vm.total / 1024, vm.used / 1024, vm.free / 1024, 0, 0, vm.available / 1024]
+        disk_total, disk_used, disk_free, disk_percent = getDiskSpace()
+        ram_total = float(RAM_stats[0])
+        ram_used = float(RAM_stats[1])
+        ram_available = float(RAM_stats[5])
+        nowsec = int(round(time.time()))
+        nowtime = datetime.datetime.fromtimestamp(nowsec).strftime("%Y-%m-%dT%H:%M:%S") # we are using the "date_hour_minute_second" or "strict_date_hour_minute_second" format of elasticsearch as fornat for the date: yyyy-MM-dd'T'HH:mm:ss.
+
+        # we try to stick to the Elasticsearch ECS field naming
+        # see https://www.elastic.co/guide/en/ecs/master/ecs-field-reference.html
+        self._snapshot = {
+            "@timestamp": nowtime,
+            "timestamp": nowtime,
+            "unixtime": nowsec,
+            "host_name": hostname,
+            "host_ip": hostip,
+            "cpu_count": psutil.cpu_count(),
+            "cpu_temp_celsius" : cputemp,
+            "cpu_load_1": cpuload0,
+            "cpu_load_5": cpuload1,
+            "cpu_load_15": cpuload2,
+            "cpu_usage_percent": cpuuse,
+            "disk_total_gb": disk_total,
+            "disk_free_gb": disk_free,
+            "disk_used_gb": disk_used,
+            "disk_percent": disk_percent,
+            "ram_total_gb": round(ram_total / 1048576.0, 3),
+            "ram_free_gb": round(float(RAM_stats[2]) / 1048576.0, 3),
+            "ram_available_gb": round(ram_available / 1048576.0, 3),
+            "ram_used_gb": round(ram_used / 1048576.0, 3),
+            "ram_percent": int(100.0 * (ram_total - ram_available) / ram_total),
+            "docker_images": getDockerImages(),
+            "docker_all_container": getAllDockerContainer(),
+            "docker_running_container": getRunningDockerContainer(),
+
+            "message": "CPU load " + str(cpuload0) + ", " + str(cpuuse) + "%, " + str(cputemp) + " Celsius",
+            "agent_type": "telemetry",
+            "agent_id": hostip + "/" + hostname
+        }
+        self.samples += 1
+        self.sample_ms = round((time.time() - start) * 1000, 2)
+        return self._snapshot
+
+    def stats(self):
+        return {'interval': self.interval, 'samples': self.samples, 'sample_ms': self.sample_ms,
+                'running': self._thread is not None}
+
+    def _host_names(self):
+        # host name and ip rarely change, they are looked up again every HOST_REFRESH seconds
+        host = self._host
+        if host is None or host[2] < time.time() - HOST_REFRESH:
+            host = (getHostname(), getHostip(), time.time())
+            self._host = host
+        return host[0], host[1]
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.warning("Failed to sample the system metrics: %s", e)
+
+metrics_sampler = MetricsSampler()
+
+def getMetricsJson():
+    return metrics_sampler.snapshot()
@@ -0,0 +1,116 @@
+import sys, time, logging, importlib, threading
+
+logger = logging.getLogger(__name__)
+
+# the states of a subsystem in ready.json
+STARTING, WARMING_UP, READY, FAILED = 'starting', 'warming_up', 'ready', 'failed'
+
+"""
+The startup report and the readiness of the subsystems.
+
+The startup is divided into phases which are ended with mark(name); each phase lasts from the
+previous mark, the first one from the import of this module. Modules which are imported with
+import_module are timed separately, this is used for the namespaces of the services and for the
+heavy machine learning libraries (torch, whisper, vosk, transformers), which are imported when
+they are used first and not at startup.
+
+Each subsystem has a readiness state: 'starting', 'warming_up' while models are loaded in the
+background, 'ready' or 'failed' if the warm-up failed. A failed warm-up does not disable the
+subsystem, its models are loaded again on the first request.
+"""
+class Startup:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._last = time.perf_counter()
+        self._first = self._last
+        self.phases = {} # phase name -> seconds
+        self.imports = {} # module name -> seconds of the first import
+        self.serving = None # seconds from the import of this module until the server was started
+        self.subsystems = {} # subsystem name -> {'state': ..., 'since': ..., 'error': ...}
+
+    def mark(self, phase):
+        """
+        End a startup phase.
+
+        :param phase: The name of the phase which lasted from the previous mark until now
+        """
+        now = time.perf_counter()
+        with self._lock:
+            self.phases[phase] = round(now - self._last, 4)
+            self._last = now
+
+    def import_module(self, name):
+        """
+        Import a module and record the time of the first import.
+
+        :param name: The module name, i.e. 'whisper'
+        :return: The module
+        """
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.imports.setdefault(name, round(seconds, 4))
+        logger.info("Imported %s in %.3f s", name, seconds)
+        return module
+
+    def set_state(self, subsystem, state, error=None):
+        with self._lock:
+            self.subsystems[subsystem] = {'state': state, 'since': time.time(), 'error': error}
+
+    def warm_up(self, subsystem, target, *args):
+        """
+        Warm up a subsystem in a background thread, it is 'warming_up' until the target returns.
+
+        :param target: A function which loads models and returns the names of the models that failed
+        """
+        self.set_state(subsystem, WARMING_UP)
+
+        def run():
+            try:
+                failed = target(*args)
+            except Exception as e:
+                logger.error(f"Warm-up of {subsystem} failed: {e}")
+                self.set_state(subsystem, FAILED, str(e))
+                return
+            if failed:
+                self.set_state(subsystem, FAILED, 'Failed to load ' + ', '.join(failed))
+            else:
+                self.set_state(subsystem, READY)
+
+        threading.Thread(target=run, name=f'warmup-{subsystem}', daemon=True).start()
+
+    def served(self):
+        """
+        Record that the server starts now and log the startup report.
+        """
+        self.serving = round(time.perf_counter() - self._first, 4)
+        report = ', '.join(f'{name} {seconds:.3f} s' for name, seconds in self.phases.items())
+        imports = ', '.join(f'{name} {seconds:.3f} s' for name, seconds in self.imports.items())
+        logger.info("Startup took %.3f s (%s); imports: %s", self.serving, report, imports or 'none')
+
+    def readiness(self):
+        """
+        :return: The readiness of the application, 'ok' if all subsystems are ready, and of each subsystem
+        """
+        with self._lock:
+            subsystems = {name: dict(state) for name, state in self.subsystems.items()}
+        states = {state['state'] for state in subsystems.values()}
+        if STARTING in states or WARMING_UP in states:
+            health = WARMING_UP
+        elif FAILED in states:
+            health = 'degraded'
+        else:
+            health = 'ok'
+        return {'health': health, 'subsystems': subsystems}
+
+    def stats(self):
+        with self._lock:
+            return {'serving_seconds': self.serving, 'phases': dict(self.phases), 'imports': dict(self.imports)}
+
+startup = Startup()
@@ -0,0 +1,276 @@
+import os, json, time, asyncio, logging, threading
+from abc import ABC, abstractmethod
+from upstream.upstream_client import openai_client, async_openai_client, UpstreamError
+from system.startup import startup
+
+logger = logging.getLogger(__name__)
+
+class BackendError(Exception):
+    def __init__(self, body, status_code):
+        super().__init__(json.dumps(body))
+        self.body = body
+        self.status_code = status_code
+
+"""
+Chat completion backends.
+
+A backend receives a normalized chat request, a dictionary with the keys
+'model', 'messages', 'temperature', 'max_tokens', 'top_p' and 'stop', and answers it either
+completely with complete() as an OpenAI 'chat.completion' object or incrementally with stream()
+as an iterator of OpenAI compatible server-sent event data strings, ending with '[DONE]'.
+acomplete() and astream() are the same for the ASGI server; by default they run the blocking
+methods in a worker thread of the event loop.
+"""
+class ChatBackend(ABC):
+
+    @abstractmethod
+    def complete(self, chat):
+        pass
+
+    @abstractmethod
+    def stream(self, chat):
+        pass
+
+    async def acomplete(self, chat):
+        return await asyncio.to_thread(self.complete, chat)
+
+    async def astream(self, chat):
+        """
+        :return: An async iterator of the event data strings; errors before the first event are raised here
+        """
+        events = await asyncio.to_thread(self.stream, chat)
+        return _threaded_events(events)
+
+class OpenAIBackend(ChatBackend):
+
+    def __init__(self, api_key):
+        self.headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        }
+
+    def payload(self, chat, stream=False):
+        data = {key: chat[key] for key in ('messages', 'model', 'temperature', 'max_tokens', 'top_p', 'stop') if chat.get(key) is not None}
+        if stream: data['stream'] = True
+        return data
+
+    def complete(self, chat):
+        response = openai_client.post("/v1/chat/completions", headers=self.headers, json=self.payload(chat))
+        try:
+            body = response.json()
+        except ValueError:
+            raise UpstreamError('Invalid response from upstream', 502)
+        if response.status_code != 200:
+            raise BackendError(body, response.status_code)
+        return body
+
+    def stream(self, chat):
+        # the upstream call is made here, so that errors are raised before the response starts
+        upstream = openai_client.stream('POST', "/v1/chat/completions", headers=self.headers, json=self.payload(chat, stream=True))
+        if upstream.status_code != 200:
+            try:
+                body = upstream.response.json()
+            except ValueError:
+                body = {'error': 'Invalid response from upstream'}
+            finally:
+                upstream.close()
+            raise BackendError(body, upstream.status_code)
+        return self._relay(upstream)
+
+    async def acomplete(self, chat):
+        response = await async_openai_client.post("/v1/chat/completions", headers=self.headers, json=self.payload(chat))
+        try:
+            body = response.json()
+        except ValueError:
+            raise UpstreamError('Invalid response from upstream', 502)
+        if response.status_code != 200:
+            raise BackendError(body, response.status_code)
+        return body
+
+    async def astream(self, chat):
+        upstream = await async_openai_client.stream('POST', "/v1/chat/completions", headers=self.headers, json=self.payload(chat, stream=True))
+        if upstream.status_code != 200:
+            try:
+                body = await upstream.json()
+            except ValueError:
+                body = {'error': 'Invalid response from upstream'}
+            finally:
+                await upstream.aclose()
+            raise BackendError(body, upstream.status_code)
+        return self._arelay(upstream)
+
+    async def _arelay(self, upstream):
+        try:
+            async for line in upstream.aiter_lines():
+                if line.startswith('data:'):
+                    yield line[5:].strip()
+        except UpstreamError as e:
+            yield json.dumps({'error': str(e)})
+        finally:
+            await upstream.aclose()
+
+    def _relay(self, upstream):
+        # relay the server-sent events without buffering the body
+        try:
+            for line in upstream.iter_lines():
+                # the OpenAI stream consists of single-line 'data: ...' events separated by empty lines
+                if line.startswith(b'data:'):
+                    yield line[5:].strip().decode('utf-8')
+        except UpstreamError as e:
+            yield json.dumps({'error': str(e)})
+        finally:
+            upstream.close()
+
+class LocalBackend(ChatBackend):
+
+    def __init__(self, model):
+        self.model = model
+
+    def submit(self, chat):
+        return self.model.submit(chat['messages'], max_tokens=chat['max_tokens'], temperature=chat['temperature'],
+                                 top_p=chat['top_p'] if chat.get('top_p') is not None else 1.0, stop=chat.get('stop'))
+
+    def complete(self, chat):
+        sequence = self.submit(chat)
+        while True:
+            event, value = sequence.events.get()
+            if event == 'done':
+                break
+        if value == 'error':
+            raise BackendError({'error': 'Local model failed'}, 500)
+        return {
+            'id': sequence.id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': self.model.name,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': sequence.text}, 'finish_reason': value}],
+            'usage': {
+                'prompt_tokens': len(sequence.prompt_ids),
+                'completion_tokens': len(sequence.generated),
+                'total_tokens': len(sequence.prompt_ids) + len(sequence.generated)
+            }
+        }
+
+    def stream(self, chat):
+        return self._events(self.submit(chat))
+
+    def _events(self, sequence):
+        created = int(time.time())
+        def chunk(delta, finish_reason=None):
+            return json.dumps({'id': sequence.id, 'object': 'chat.completion.chunk', 'created': created, 'model': self.model.name,
+                               'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]})
+        try:
+            yield chunk({'role': 'assistant'})
+            while True:
+                event, value = sequence.events.get()
+                if event == 'done':
+                    break
+                yield chunk({'content': value})
+            if value == 'error':
+                yield json.dumps({'error': 'Local model failed'})
+            else:
+                yield chunk({}, value)
+            yield '[DONE]'
+        finally:
+            # stop generating if the client went away
+            sequence.cancelled = True
+
+"""
+The LocalModelPool knows the configured local chat models and keeps every model resident
+after it was loaded on first use.
+"""
+class LocalModelPool:
+
+    def __init__(self):
+        self.paths = {} # model name -> path of a transformers model directory
+        self.max_batch_size = 4
+        self.prefix_cache_size = 8
+        self._models = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def configure(self, models, model_path=None, max_batch_size=None, prefix_cache_size=None):
+        """
+        :param models: A comma-separated list of 'name=path' or 'path' entries, relative paths are
+                       resolved against the model path
+        """
+        for spec in [spec.strip() for spec in models.split(',') if spec.strip()]:
+            name, _, path = spec.rpartition('=')
+            path = path if os.path.isabs(path) or not model_path else os.path.join(model_path, path)
+            self.paths[name or os.path.basename(path.rstrip('/'))] = path
+        if max_batch_size is not None: self.max_batch_size = max(1, max_batch_size)
+        if prefix_cache_size is not None: self.prefix_cache_size = max(0, prefix_cache_size)
+
+    def names(self):
+        return list(self.paths)
+
+    def get(self, name):
+        with self._lock:
+            model = self._models.get(name)
+            if model:
+                return model
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            with self._lock:
+                if name in self._models:
+                    return self._models[name]
+            # torch and transformers are only imported when a local model is used
+            LocalChatModel = startup.import_module('text.local_llm').LocalChatModel
+            model = LocalChatModel(name, self.paths[name], max_batch_size=self.max_batch_size,
+                                   prefix_cache_size=self.prefix_cache_size)
+            with self._lock:
+                self._models[name] = model
+            return model
+
+    def warmup(self, names):
+        failed = []
+        for name in names:
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.error(f"Failed to warm up chat model {name}: {e}")
+                failed.append(name)
+        return failed
+
+    def loaded_models(self):
+        with self._lock:
+            return list(self._models)
+
+    def is_loaded(self, name):
+        with self._lock:
+            return name in self._models
+
+    def stats(self):
+        with self._lock:
+            return {"configured": list(self.paths), "loaded": [model.stats() for model in self._models.values()]}
+
+local_models = LocalModelPool()
+
+async def _threaded_events(events):
+    # every event of a blocking iterator is taken in a worker thread, the event loop is never blocked
+    done = object()
+    try:
+        while True:
+            event = await asyncio.to_thread(next, events, done)
+            if event is done:
+                break
+            yield event
+    finally:
+        close = getattr(events, 'close', None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+def select_backend(model_name, openai_api_key):
+    """
+    Select the backend for a requested model: configured local models are served locally,
+    all other models go to OpenAI. Without an OpenAI API key the first local model is used.
+
+    :return: A ChatBackend or None if no backend can serve the request
+    """
+    if model_name in local_models.paths:
+        return LocalBackend(local_models.get(model_name))
+    if openai_api_key:
+        return OpenAIBackend(openai_api_key)
+    if local_models.paths:
+        return LocalBackend(local_models.get(local_models.names()[0]))
+    return None
@@ -0,0 +1,60 @@
+import json, time, hashlib, threading
+from cache.lru_cache import LRUCache
+
+"""
+The ChatCache stores complete chat completions of deterministic requests (temperature 0) under a
+hash of the model, the messages and the generation parameters. A repeated request is answered
+from the cache without calling a backend; the tokens which did not have to be computed or paid
+for are counted as saved tokens.
+"""
+class ChatCache:
+
+    def __init__(self, max_entries=256, ttl=3600):
+        self.memory = LRUCache(max_entries, ttl)
+        self._lock = threading.Lock()
+        self.saved_tokens = 0
+
+    def configure(self, max_entries=None, ttl=None):
+        self.memory.configure(max_entries=max_entries, ttl=ttl)
+
+    def cacheable(self, chat):
+        return self.memory.enabled and chat['temperature'] == 0
+
+    def key(self, chat):
+        params = {key: chat.get(key) for key in ('model', 'messages', 'max_tokens', 'top_p', 'stop')}
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        completion = self.memory.get(key)
+        if completion is not None:
+            with self._lock:
+                self.saved_tokens += completion.get('usage', {}).get('total_tokens', 0)
+        return completion
+
+    def put(self, key, completion):
+        self.memory.put(key, completion)
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats["saved_tokens"] = self.saved_tokens
+        return stats
+
+def completion_events(completion):
+    """
+    Replay a cached chat completion as server-sent event data strings.
+
+    :param completion: An OpenAI 'chat.completion' dictionary
+    :return: A generator of 'chat.completion.chunk' event data strings, ending with '[DONE]'
+    """
+    created = int(time.time())
+    for choice in completion.get('choices', []):
+        for delta, finish_reason in (({'role': 'assistant'}, None),
+                                     ({'content': choice['message']['content']}, None),
+                                     ({}, choice.get('finish_reason'))):
+            yield json.dumps({'id': completion.get('id'), 'object': 'chat.completion.chunk', 'created': created,
+                              'model': completion.get('model'),
+                              'choices': [{'index': choice.get('index', 0), 'delta': delta, 'finish_reason': finish_reason}]})
+    yield '[DONE]'
+
+# the process-wide cache, configured in main.py
+chat_cache = ChatCache()
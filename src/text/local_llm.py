@@ -0,0 +1,308 @@
+import copy, time, uuid, queue, logging, threading
+from collections import OrderedDict
+import torch
+import torch.nn.functional as F
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache
+
+logger = logging.getLogger(__name__)
+
+"""
+A local chat model running on the CPU with the transformers library.
+
+The model is loaded once and kept resident. Requests are served with continuous batching:
+a worker thread keeps one batch of active sequences and runs a single forward pass per decode
+step for all of them. New requests join the batch between two decode steps as soon as there is
+room (`max_batch_size`), finished sequences leave it immediately, so short and long chats share
+the decode steps without waiting for each other.
+
+The key/value caches of the batch are left-padded to the same length; an attention mask hides
+the padding and the position ids are counted per sequence.
+
+Prompts which start with the same tokens as an earlier prompt (i.e. the same system prompt) reuse
+the key/value cache of that prompt from the PrefixCache, only the remaining tokens are encoded.
+"""
+
+class PrefixCache:
+    """
+    The key/value caches of the most recent prompts, a new prompt reuses the longest common
+    token prefix with any of them. The cache is only used by the engine thread.
+    """
+    def __init__(self, max_entries=8, min_tokens=16):
+        self.max_entries = max_entries
+        self.min_tokens = min_tokens
+        self._entries = OrderedDict() # tuple of prompt token ids -> DynamicCache
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def lookup(self, prompt_ids):
+        """
+        :return: The number of reused tokens and a private copy of the cache for them, or (0, None)
+        """
+        if self.max_entries <= 0:
+            return 0, None
+        best, best_length = None, 0
+        for ids in self._entries:
+            length = _common_prefix(ids, prompt_ids)
+            if length > best_length:
+                best, best_length = ids, length
+        # at least the last prompt token must be encoded to get the logits of the first new token
+        best_length = min(best_length, len(prompt_ids) - 1)
+        if best is None or best_length < self.min_tokens:
+            self.misses += 1
+            return 0, None
+        self._entries.move_to_end(best)
+        cache = copy.deepcopy(self._entries[best])
+        if len(best) > best_length:
+            cache.crop(best_length - len(best))
+        self.hits += 1
+        self.saved_tokens += best_length
+        return best_length, cache
+
+    def put(self, prompt_ids, cache):
+        if self.max_entries <= 0 or len(prompt_ids) < self.min_tokens:
+            return
+        ids = tuple(prompt_ids)
+        # an entry which is a prefix of the new prompt is covered by the new entry
+        for old in [old for old in self._entries if len(old) <= len(ids) and ids[:len(old)] == old]:
+            del self._entries[old]
+        self._entries[ids] = copy.deepcopy(cache)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "saved_tokens": self.saved_tokens
+        }
+
+class Sequence:
+    """
+    One chat completion request inside the engine.
+    """
+    def __init__(self, prompt_ids, max_tokens, temperature, top_p, stop):
+        self.id = 'chatcmpl-' + uuid.uuid4().hex
+        self.prompt_ids = prompt_ids
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = stop
+        self.generated = []
+        self.text = ""
+        self.finish_reason = None
+        self.cancelled = False
+        self.events = queue.Queue() # ('text', delta) events and a final ('done', finish_reason) event
+
+class LocalChatModel:
+
+    def __init__(self, name, path, max_batch_size=4, prefix_cache_size=8):
+        self.name = name
+        self.path = path
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = PrefixCache(prefix_cache_size)
+        start = time.time()
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.model = AutoModelForCausalLM.from_pretrained(path)
+        self.model.eval()
+        self.load_seconds = time.time() - start
+        eos = self.model.generation_config.eos_token_id
+        eos = eos if isinstance(eos, list) else [eos]
+        self.eos_ids = {token for token in eos + [self.tokenizer.eos_token_id] if token is not None}
+        self._waiting = queue.Queue()
+        self._active = []
+        self._cache = None
+        self._mask = None
+        self._lock = threading.Lock()
+        self.steps = 0
+        self.batched_tokens = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        threading.Thread(target=self._work, daemon=True, name=f'llm-{name}').start()
+        logger.info("Loaded chat model %s from %s in %.2f s", name, path, self.load_seconds)
+
+    def prompt(self, messages):
+        """
+        Render the chat messages with the chat template of the model.
+
+        :param messages: A list of {'role': ..., 'content': ...} dictionaries
+        :return: A list of token ids
+        """
+        if self.tokenizer.chat_template:
+            text = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+        else:
+            text = ''.join(f"{message['role']}: {message['content']}\n" for message in messages) + "assistant:"
+        return self.tokenizer(text, add_special_tokens=not self.tokenizer.chat_template)['input_ids']
+
+    def submit(self, messages, max_tokens=50, temperature=1.0, top_p=1.0, stop=None):
+        """
+        Queue a chat completion; the sequence is picked up by the engine between two decode steps.
+
+        :return: The Sequence, its events can be read while it is generated
+        """
+        if isinstance(stop, str): stop = [stop]
+        sequence = Sequence(self.prompt(messages), max_tokens, temperature, top_p, stop or [])
+        self._waiting.put(sequence)
+        return sequence
+
+    def _work(self):
+        while True:
+            try:
+                if not self._active:
+                    # sleep until there is work
+                    self._admit(self._waiting.get())
+                while len(self._active) < self.max_batch_size and not self._waiting.empty():
+                    self._admit(self._waiting.get_nowait())
+                if self._active:
+                    self._step()
+            except Exception as e:
+                logger.error(f"Chat model {self.name} failed: {e}")
+                for sequence in self._active:
+                    self._finish(sequence, 'error')
+                self._active, self._cache, self._mask = [], None, None
+
+    @torch.inference_mode()
+    def _admit(self, sequence):
+        if sequence.cancelled:
+            return
+        input_ids = torch.tensor([sequence.prompt_ids], dtype=torch.long)
+        try:
+            cache, logits = self._prefill(sequence, input_ids)
+        except Exception as e:
+            logger.error(f"Chat model {self.name} failed to read the prompt: {e}")
+            self._finish(sequence, 'error')
+            return
+        with self._lock:
+            self.prompt_tokens += len(sequence.prompt_ids)
+        self._append(sequence, self._sample(logits[0], sequence))
+        if sequence.finish_reason:
+            return
+        self._merge(cache, torch.ones((1, input_ids.shape[1]), dtype=torch.long))
+        self._active.append(sequence)
+
+    def _prefill(self, sequence, input_ids):
+        with self._lock:
+            reused, cache = self.prefix_cache.lookup(sequence.prompt_ids)
+        if cache is None:
+            output = self.model(input_ids=input_ids, use_cache=True)
+        else:
+            output = self.model(input_ids=input_ids[:, reused:], past_key_values=cache, use_cache=True)
+        with self._lock:
+            # the cache of the batch is extended in place by the decode steps, the prefix cache keeps a copy
+            self.prefix_cache.put(sequence.prompt_ids, output.past_key_values)
+        return output.past_key_values, output.logits[:, -1, :]
+
+    def _merge(self, cache, mask):
+        if self._cache is None:
+            self._cache, self._mask = cache, mask
+            return
+        # left-pad the shorter of both caches so that all sequences end at the same position
+        length, new_length = self._mask.shape[1], mask.shape[1]
+        merged = DynamicCache()
+        for layer_idx, (old_layer, new_layer) in enumerate(zip(self._cache, cache)):
+            keys = torch.cat([_pad_left(old_layer[0], new_length - length), _pad_left(new_layer[0], length - new_length)], dim=0)
+            values = torch.cat([_pad_left(old_layer[1], new_length - length), _pad_left(new_layer[1], length - new_length)], dim=0)
+            merged.update(keys, values, layer_idx)
+        self._cache = merged
+        self._mask = torch.cat([F.pad(self._mask, (max(0, new_length - length), 0)), F.pad(mask, (max(0, length - new_length), 0))], dim=0)
+
+    @torch.inference_mode()
+    def _step(self):
+        input_ids = torch.tensor([[sequence.generated[-1]] for sequence in self._active], dtype=torch.long)
+        # the position of the next token is the number of real tokens before it
+        position_ids = self._mask.sum(dim=1, keepdim=True)
+        self._mask = torch.cat([self._mask, torch.ones((len(self._active), 1), dtype=torch.long)], dim=1)
+        output = self.model(input_ids=input_ids, attention_mask=self._mask, position_ids=position_ids,
+                            past_key_values=self._cache, use_cache=True)
+        self._cache = output.past_key_values
+        logits = output.logits[:, -1, :]
+        with self._lock:
+            self.steps += 1
+            self.batched_tokens += len(self._active)
+
+        keep = []
+        for index, sequence in enumerate(self._active):
+            if sequence.cancelled:
+                continue
+            self._append(sequence, self._sample(logits[index], sequence))
+            if not sequence.finish_reason:
+                keep.append(index)
+        if len(keep) == 0:
+            self._active, self._cache, self._mask = [], None, None
+        elif len(keep) < len(self._active):
+            indices = torch.tensor(keep, dtype=torch.long)
+            self._cache.batch_select_indices(indices)
+            self._mask = self._mask[indices]
+            self._active = [self._active[index] for index in keep]
+
+    def _sample(self, logits, sequence):
+        if sequence.temperature <= 0:
+            return int(torch.argmax(logits))
+        probs = torch.softmax(logits.float() / sequence.temperature, dim=-1)
+        if sequence.top_p < 1.0:
+            sorted_probs, sorted_ids = torch.sort(probs, descending=True)
+            # keep the smallest set of tokens whose probability exceeds top_p
+            cutoff = torch.cumsum(sorted_probs, dim=-1) - sorted_probs > sequence.top_p
+            sorted_probs[cutoff] = 0.0
+            return int(sorted_ids[torch.multinomial(sorted_probs, 1)])
+        return int(torch.multinomial(probs, 1))
+
+    def _append(self, sequence, token):
+        if token in self.eos_ids:
+            self._finish(sequence, 'stop')
+            return
+        sequence.generated.append(token)
+        with self._lock:
+            self.completion_tokens += 1
+        text = self.tokenizer.decode(sequence.generated, skip_special_tokens=True)
+        for stop in sequence.stop:
+            position = text.find(stop, max(0, len(sequence.text) - len(stop)))
+            if position >= 0:
+                self._emit(sequence, text[:position])
+                self._finish(sequence, 'stop')
+                return
+        # wait with incomplete multi-byte characters until the next token
+        if not text.endswith('\ufffd'):
+            self._emit(sequence, text)
+        if len(sequence.generated) >= sequence.max_tokens:
+            self._finish(sequence, 'length')
+
+    def _emit(self, sequence, text):
+        if len(text) > len(sequence.text):
+            sequence.events.put(('text', text[len(sequence.text):]))
+            sequence.text = text
+
+    def _finish(self, sequence, finish_reason):
+        sequence.finish_reason = finish_reason
+        sequence.events.put(('done', finish_reason))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "load_seconds": round(self.load_seconds, 3),
+                "active": len(self._active),
+                "waiting": self._waiting.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "steps": self.steps,
+                "avg_batch_size": round(self.batched_tokens / self.steps, 2) if self.steps else 0.0,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "prefix_cache": self.prefix_cache.stats()
+            }
+
+def _common_prefix(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+def _pad_left(tensor, padding):
+    # pad the sequence dimension of a [batch, heads, sequence, head dim] cache tensor
+    return F.pad(tensor, (0, 0, padding, 0)) if padding > 0 else tensor
@@ -1,6 +1,11 @@
-import requests
-from flask import jsonify, request, current_app
+import time
+from flask import jsonify, request, current_app, Response, g
 from flask_restx import Namespace, Resource
+from upstream.upstream_client import UpstreamError
+from text.chat_backends import select_backend, local_models, BackendError
+from text.chat_cache import chat_cache, completion_events
+from system.instrumentation import stage, request_metrics
+from system.cluster import cluster
 
 api = Namespace('api/text', description='text operations')
 
@@ -9,30 +14,173 @@ class ChatCompletion(Resource):
 
     # call i.e.:
     # curl http://localhost:8080/api/text/chat/completions -H "Content-Type: application/json" -d '{"model": "gpt-3.5-turbo","messages": [{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": "Hello!"}]}'
+    # the model can also be one of the local models given with --chat_models, add "stream": true to get server-sent events
     @api.doc('chat_completions')
     def post(self):
-        openai_api_key = current_app.config['OPENAI_API_KEY']
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'No data provided'})
-
-        messages = data.get('messages')
-        if not messages:
-            return jsonify({'error': 'No messages provided'})
-
-        if not openai_api_key:
-            return jsonify({'error': 'No OpenAI API key provided'})
-
-        headers = {
-            'Authorization': f'Bearer {openai_api_key}',
-            'Content-Type': 'application/json'
-        }
-        data = {
-            'messages': messages,
-            'model': 'gpt-3.5-turbo',
-            'temperature': 1.0,
-            'max_tokens': 50
-        }
-
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data)
-        return jsonify(response.json())
+        plan = plan_chat(request.get_json(), current_app.config['OPENAI_API_KEY'], request.headers)
+        if plan.error is not None:
+            return json_response(*plan.error)
+        if plan.forwarded is not None:
+            return cluster.response(plan.forwarded)
+        if plan.completion is not None:
+            return sse_response(completion_events(plan.completion)) if plan.stream else jsonify(plan.completion)
+
+        try:
+            if plan.stream:
+                # relay the tokens as server-sent events as soon as they arrive
+                return sse_response(timed_events(plan.backend.stream(plan.chat), g.get('metrics_route', 'background')))
+            with stage('completion'):
+                completion = plan.backend.complete(plan.chat)
+            plan.done(completion)
+            return jsonify(completion)
+        except CHAT_ERRORS as e:
+            return json_response(*chat_error(e))
+
+@api.route('/status.json', methods=['GET'])
+class TextStatus(Resource):
+
+    # call i.e.:
+    # curl http://localhost:8080/api/text/status.json
+    @api.doc('text_status')
+    def get(self):
+        return jsonify({'models': local_models.stats(), 'cache': chat_cache.stats()})
+
+"""
+A chat completion request is decided by plan_chat, for the flask resource above and for the
+handler of the ASGI server alike: the request is checked, answered from the cache, forwarded to
+a peer or given a backend. The servers only send the answer and run the backend of the plan,
+with backend.complete/stream or backend.acomplete/astream, and hand the completion to done().
+"""
+class ChatPlan:
+
+    def __init__(self, data=None, chat=None):
+        self.data = data
+        self.chat = chat
+        self.stream = bool(chat and data.get('stream', False))
+        self.cache_key = None
+        # exactly one of the following is set
+        self.error = None # the json body and status code of an error
+        self.completion = None # a cached completion
+        self.forwarded = None # the response of a peer, see system.cluster
+        self.backend = None # the ChatBackend which makes the completion
+
+    def done(self, completion):
+        if self.cache_key:
+            chat_cache.put(self.cache_key, completion)
+
+def plan_chat(data, openai_api_key, request_headers):
+    """
+    Decide how a chat completion request is answered. This may block to load a local model.
+
+    :param data: The decoded json body
+    :param openai_api_key: The configured OpenAI API key
+    :param request_headers: The headers of the request, a request forwarded by a peer is not forwarded again
+    :return: A ChatPlan
+    """
+    chat, error = chat_request(data)
+    plan = ChatPlan(data, chat)
+    if error:
+        plan.error = ({'error': error}, 200)
+        return plan
+    model_name = chat['model']
+
+    # deterministic requests are answered from the cache if the same chat was completed before
+    plan.cache_key = chat_cache.key(chat) if chat_cache.cacheable(chat) else None
+    if plan.cache_key:
+        with stage('cache_lookup'):
+            plan.completion = chat_cache.get(plan.cache_key)
+        if plan.completion is not None:
+            return plan
+
+    # a busy node hands the chat to the least loaded peer which has the model resident
+    with stage('forward'):
+        plan.forwarded = cluster.forward('chat', model_name, local_models.is_loaded(model_name), request_headers,
+                                         '/api/text/chat/completions', stream=plan.stream, json=data)
+    if plan.forwarded is not None:
+        return plan
+
+    # local models are served on-site, everything else goes to OpenAI
+    try:
+        with stage('backend_select'): # includes loading a local model
+            plan.backend = select_backend(model_name, openai_api_key)
+    except Exception as e:
+        plan.error = ({'error': f'Failed to load model {model_name}: {e}'}, 500)
+        return plan
+    if plan.backend is None:
+        plan.error = ({'error': 'No OpenAI API key provided'}, 200)
+    return plan
+
+# the errors of a backend which are answered with chat_error
+CHAT_ERRORS = (UpstreamError, BackendError)
+
+def chat_error(e):
+    """
+    :param e: One of CHAT_ERRORS
+    :return: The json body and the status code of the answer
+    """
+    if isinstance(e, BackendError):
+        return e.body, e.status_code
+    return {'error': str(e)}, e.status_code
+
+def chat_request(data):
+    """
+    Normalize the body of a chat completion request.
+
+    :param data: The decoded json body
+    :return: The chat dictionary for the backends and None, or None and an error message
+    """
+    if not data:
+        return None, 'No data provided'
+    if not isinstance(data, dict):
+        return None, 'Invalid data, a JSON object is expected'
+    messages = data.get('messages')
+    if not messages:
+        return None, 'No messages provided'
+    if not isinstance(messages, list) or not all(isinstance(message, dict) and isinstance(message.get('role'), str)
+                                                 and isinstance(message.get('content'), str) for message in messages):
+        return None, 'Invalid messages, a list of objects with a role and a content string is expected'
+    temperature = data.get('temperature', 1.0)
+    if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or not 0 <= temperature <= 2:
+        return None, 'Invalid temperature'
+    max_tokens = data.get('max_tokens', 50)
+    if isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1:
+        return None, 'Invalid max_tokens'
+    return {
+        'messages': messages,
+        'model': data.get('model', 'gpt-3.5-turbo'),
+        'temperature': float(temperature),
+        'max_tokens': max_tokens,
+        'top_p': data.get('top_p'),
+        'stop': data.get('stop')
+    }, None
+
+def sse_response(events):
+    """
+    Make a streamed text/event-stream response.
+
+    :param events: An iterator of event data strings
+    :return: A flask Response which sends every event as soon as it is available
+    """
+    def generate():
+        for event in events:
+            yield f'data: {event}\n\n'
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def timed_events(events, route):
+    # a stream runs after the request has returned, its stages are added to the route of the request
+    start = time.perf_counter()
+    first = True
+    for event in events:
+        if first:
+            request_metrics.observe_stage(route, 'stream_first_event', time.perf_counter() - start)
+            first = False
+        yield event
+    request_metrics.observe_stage(route, 'stream', time.perf_counter() - start)
+
+def json_response(body, status_code=200):
+    response = jsonify(body)
+    response.status_code = status_code
+    return response
@@ -0,0 +1,390 @@
+import time, asyncio, logging, threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import MaxRetryError, TimeoutError as Urllib3TimeoutError
+
+logger = logging.getLogger(__name__)
+
+# the statuses with which the upstream rejects a request without processing it, only these are retried;
+# a POST which failed with another 5xx may have been processed already and is not sent again
+RETRY_STATUSES = (429, 503)
+
+class UpstreamError(Exception):
+    """
+    An upstream call failed; status_code is the HTTP status which should be returned to the client:
+    503 if all upstream slots are busy, 504 on a timeout and 502 on any other failure.
+    """
+    def __init__(self, message, status_code=502):
+        super().__init__(message)
+        self.status_code = status_code
+
+"""
+The UpstreamClient is a shared HTTP client for one upstream API (i.e. OpenAI).
+
+- connections are pooled and kept alive, so a call does not pay for a new TCP and TLS handshake
+- every call has a connect and a read timeout, so a stalled upstream cannot block a thread forever
+- failed connections and 429/503 responses are retried with exponential backoff or after Retry-After
+- at most `max_concurrency` calls are in flight at the same time; a call which does not get
+  a slot within `queue_timeout` seconds fails with status 503
+The `base_url` can point to a local stand-in server for testing.
+"""
+class UpstreamClient:
+
+    def __init__(self, base_url, connect_timeout=5.0, read_timeout=120.0, retries=2, backoff=0.5,
+                 pool_size=16, max_concurrency=16, queue_timeout=5.0):
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.session = self._create_session()
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.seconds = 0.0
+
+    def configure(self, base_url=None, connect_timeout=None, read_timeout=None, retries=None, backoff=None,
+                  pool_size=None, max_concurrency=None, queue_timeout=None):
+        if base_url is not None: self.base_url = base_url.rstrip('/')
+        if connect_timeout is not None: self.connect_timeout = connect_timeout
+        if read_timeout is not None: self.read_timeout = read_timeout
+        if retries is not None: self.retries = max(0, retries)
+        if backoff is not None: self.backoff = backoff
+        if pool_size is not None: self.pool_size = max(1, pool_size)
+        if queue_timeout is not None: self.queue_timeout = queue_timeout
+        if max_concurrency is not None:
+            self.max_concurrency = max(1, max_concurrency)
+            self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        old_session = self.session
+        self.session = self._create_session()
+        old_session.close()
+
+    def _create_session(self):
+        # POST requests are retried as well, but only when the upstream did not receive them (connect errors)
+        # or explicitly rejected them (429/503), never after a read timeout or another 5xx
+        retry = Retry(total=self.retries, connect=self.retries, read=0, status=self.retries,
+                      status_forcelist=RETRY_STATUSES, allowed_methods=None,
+                      backoff_factor=self.backoff, respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def post(self, path, **kwargs):
+        """
+        Make a POST request to the upstream.
+
+        :param path: The path of the upstream endpoint, i.e. '/v1/chat/completions'
+        :param kwargs: Arguments for requests.post, i.e. headers, json or data; data must not be a stream
+        :raises UpstreamError: if no slot is free, the call timed out or the connection failed
+        :return: The requests.Response
+        """
+        return self.request('POST', path, **kwargs)
+
+    def request(self, method, path, **kwargs):
+        slots = self._acquire()
+        start = time.time()
+        try:
+            return self.session.request(method, self.base_url + path, timeout=(self.connect_timeout, self.read_timeout), **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise self._error(method, path, e)
+        finally:
+            self._release(slots, time.time() - start)
+
+    def stream(self, method, path, **kwargs):
+        """
+        Make a request to the upstream and return the response before the body is read.
+        The concurrency slot is held until the returned UpstreamStream is closed.
+
+        :raises UpstreamError: if no slot is free, the call timed out or the connection failed
+        :return: An UpstreamStream, which must be closed
+        """
+        slots = self._acquire()
+        start = time.time()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=(self.connect_timeout, self.read_timeout), stream=True, **kwargs)
+        except requests.exceptions.RequestException as e:
+            self._release(slots, time.time() - start)
+            raise self._error(method, path, e)
+        return UpstreamStream(self, method, path, response, slots, start)
+
+    def _error(self, method, path, e):
+        if _is_timeout(e):
+            with self._lock:
+                self.timeouts += 1
+            logger.error(f"Upstream call {method} {path} timed out: {e}")
+            return UpstreamError('Upstream request timed out', 504)
+        with self._lock:
+            self.errors += 1
+        logger.error(f"Upstream call {method} {path} failed: {e}")
+        return UpstreamError('Upstream request failed', 502)
+
+    def _acquire(self):
+        slots = self._slots
+        if not slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise UpstreamError('Too many concurrent upstream requests', 503)
+        with self._lock:
+            self.in_flight += 1
+        return slots
+
+    def _release(self, slots, seconds):
+        with self._lock:
+            self.in_flight -= 1
+            self.calls += 1
+            self.seconds += seconds
+        slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "base_url": self.base_url,
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "calls": self.calls,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "avg_seconds": round(self.seconds / self.calls, 3) if self.calls else 0.0
+            }
+
+"""
+An UpstreamStream is a streamed upstream response; its lines can be read as they arrive.
+"""
+class UpstreamStream:
+
+    def __init__(self, client, method, path, response, slots, start):
+        self.client = client
+        self.method = method
+        self.path = path
+        self.response = response
+        self.status_code = response.status_code
+        self._slots = slots
+        self._start = start
+        self._closed = False
+
+    def iter_lines(self):
+        try:
+            for line in self.response.iter_lines():
+                yield line
+        except requests.exceptions.RequestException as e:
+            raise self.client._error(self.method, self.path, e)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.response.close()
+            self.client._release(self._slots, time.time() - self._start)
+
+def _is_timeout(e):
+    # with retries enabled, urllib3 reports a timeout as the reason of a MaxRetryError
+    if isinstance(e, requests.exceptions.Timeout):
+        return True
+    reason = e.args[0] if e.args else None
+    return isinstance(reason, MaxRetryError) and isinstance(reason.reason, Urllib3TimeoutError)
+
+# the shared client for the OpenAI API, configured in main.py
+openai_client = UpstreamClient('https://api.openai.com')
+
+"""
+The AsyncUpstreamClient is the asyncio counterpart of the UpstreamClient for the ASGI server:
+a call waits for the upstream without holding a thread, so many slow calls can be in flight.
+It has the same timeouts, retries (connection errors and 429/503, with exponential backoff and
+Retry-After) and concurrency limit. httpx is imported when the first call is made, and the
+connection pool belongs to the event loop of that call.
+"""
+class AsyncUpstreamClient:
+
+    def __init__(self, base_url, connect_timeout=5.0, read_timeout=120.0, retries=2, backoff=0.5,
+                 pool_size=16, max_concurrency=16, queue_timeout=5.0):
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._client = None
+        self._slots = None
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.seconds = 0.0
+
+    def configure(self, base_url=None, connect_timeout=None, read_timeout=None, retries=None, backoff=None,
+                  pool_size=None, max_concurrency=None, queue_timeout=None):
+        if base_url is not None: self.base_url = base_url.rstrip('/')
+        if connect_timeout is not None: self.connect_timeout = connect_timeout
+        if read_timeout is not None: self.read_timeout = read_timeout
+        if retries is not None: self.retries = max(0, retries)
+        if backoff is not None: self.backoff = backoff
+        if pool_size is not None: self.pool_size = max(1, pool_size)
+        if max_concurrency is not None: self.max_concurrency = max(1, max_concurrency)
+        if queue_timeout is not None: self.queue_timeout = queue_timeout
+        # the client and the slots are created again in the event loop of the next call
+        self._client = None
+        self._slots = None
+
+    def _get_client(self):
+        if self._client is None:
+            import httpx
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size))
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    async def post(self, path, **kwargs):
+        """
+        Make a POST request to the upstream and read the response.
+
+        :param kwargs: Arguments for httpx, i.e. headers, json or content
+        :raises UpstreamError: if no slot is free, the call timed out or the connection failed
+        :return: The httpx.Response
+        """
+        return await self._send('POST', path, kwargs, stream=False)
+
+    async def stream(self, method, path, **kwargs):
+        """
+        Make a request to the upstream and return the response before the body is read.
+        The concurrency slot is held until the returned AsyncUpstreamStream is closed.
+
+        :return: An AsyncUpstreamStream, which must be closed
+        """
+        start = time.time()
+        await self._acquire()
+        try:
+            response = await self._request(method, path, kwargs, stream=True)
+        except BaseException:
+            self._release(time.time() - start)
+            raise
+        return AsyncUpstreamStream(self, method, path, response, start)
+
+    async def _send(self, method, path, kwargs, stream):
+        start = time.time()
+        await self._acquire()
+        try:
+            return await self._request(method, path, kwargs, stream)
+        finally:
+            self._release(time.time() - start)
+
+    async def _request(self, method, path, kwargs, stream):
+        import httpx
+        client = self._get_client()
+        for attempt in range(self.retries + 1):
+            # like the UpstreamClient, a request is only repeated if the upstream did not receive it or rejected it
+            try:
+                request = client.build_request(method, self.base_url + path, **kwargs)
+                response = await client.send(request, stream=stream)
+            except httpx.ConnectError as e:
+                if attempt < self.retries:
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+                    continue
+                raise self._error(method, path, e, False)
+            except httpx.TimeoutException as e:
+                if isinstance(e, httpx.ConnectTimeout) and attempt < self.retries:
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+                    continue
+                raise self._error(method, path, e, True)
+            except httpx.HTTPError as e:
+                raise self._error(method, path, e, False)
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                await response.aclose()
+                await asyncio.sleep(_retry_after(response.headers.get('Retry-After'), self.backoff * 2 ** attempt))
+                continue
+            return response
+
+    def _error(self, method, path, e, timeout):
+        if timeout:
+            self.timeouts += 1
+            logger.error(f"Upstream call {method} {path} timed out: {e}")
+            return UpstreamError('Upstream request timed out', 504)
+        self.errors += 1
+        logger.error(f"Upstream call {method} {path} failed: {e}")
+        return UpstreamError('Upstream request failed', 502)
+
+    async def _acquire(self):
+        self._get_client()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise UpstreamError('Too many concurrent upstream requests', 503)
+        self.in_flight += 1
+
+    def _release(self, seconds):
+        # all calls run in one event loop, the counters need no lock
+        self.in_flight -= 1
+        self.calls += 1
+        self.seconds += seconds
+        self._slots.release()
+
+    def stats(self):
+        return {
+            "base_url": self.base_url,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "avg_seconds": round(self.seconds / self.calls, 3) if self.calls else 0.0
+        }
+
+class AsyncUpstreamStream:
+
+    def __init__(self, client, method, path, response, start):
+        self.client = client
+        self.method = method
+        self.path = path
+        self.response = response
+        self.status_code = response.status_code
+        self._start = start
+        self._closed = False
+
+    async def aiter_lines(self):
+        import httpx
+        try:
+            async for line in self.response.aiter_lines():
+                yield line
+        except httpx.TimeoutException as e:
+            raise self.client._error(self.method, self.path, e, True)
+        except httpx.HTTPError as e:
+            raise self.client._error(self.method, self.path, e, False)
+
+    async def json(self):
+        await self.response.aread()
+        return self.response.json()
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            await self.response.aclose()
+            self.client._release(time.time() - self._start)
+
+def _retry_after(header, default):
+    try:
+        return min(float(header), 30.0) if header else default
+    except ValueError:
+        return default
+
+# the shared asynchronous client for the OpenAI API, used by the ASGI server and configured in main.py
+async_openai_client = AsyncUpstreamClient('https://api.openai.com')
@@ -0,0 +1,495 @@
+"""
+Benchmark harness for the audio, text, search and share endpoints.
+
+The endpoints are driven either in-process through the flask test client or over HTTP against a
+server which is started for the benchmark (or an already running one with --url). Chats and
+online transcriptions go to a local fake OpenAI server, so that the proxy paths are measured
+without network and without an API key. Search runs on a synthetic jsonl catalog of configurable
+size which is uploaded through the share endpoint, like all other test files. The benchmark repeats
+the same clips and chats, so the transcription and chat caches are switched off unless --cache is given.
+
+For every scenario and concurrency level the throughput, the latency percentiles and the peak
+RSS of the server process are reported and written as json, which can be compared with the
+results of an earlier run.
+
+call i.e.:
+python3 test/bin/benchmark.py --mode inprocess --concurrency 1,4,16 --requests 200 --output bench.json
+python3 test/bin/benchmark.py --mode http --scenarios search,download --catalog_docs 100000 --baseline bench.json
+python3 test/bin/benchmark.py --mode http --scenarios search --catalog_docs 100000 --search_shards 8
+python3 test/bin/benchmark.py --mode http --scenarios voice --voice_model tiny --concurrency 1,2 --requests 16
+"""
+
+import os, sys, io, json, time, glob, random, shutil, socket, argparse, platform, tempfile, threading, subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import psutil
+import requests
+
+test_path = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+app_path = os.path.realpath(os.path.join(test_path, '..'))
+wav_path = os.path.join(test_path, 'wav')
+BENCH_DIR = 'benchmark' # directory in the data path for the uploaded test files
+SCENARIOS = ('chat', 'chat_stream', 'voice_upstream', 'voice', 'search', 'listing', 'download')
+DEFAULT_SCENARIOS = 'chat,chat_stream,voice_upstream,search,listing,download'
+
+"""
+A fake OpenAI server for the chat completions and transcriptions, it answers after a fixed latency.
+"""
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # the default backlog of 5 drops connections of concurrent clients
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    tokens = 16
+    token_latency = 0.0
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately, without this they wait for a delayed ack
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        if self.path == '/v1/chat/completions':
+            chat = json.loads(body)
+            if chat.get('stream'):
+                return self._stream(chat)
+            return self._json({
+                'id': 'chatcmpl-benchmark', 'object': 'chat.completion', 'created': int(time.time()), 'model': chat.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ' '.join(['token'] * self.tokens)}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': self.tokens, 'total_tokens': 10 + self.tokens}
+            })
+        if self.path == '/v1/audio/transcriptions':
+            return self._json({'text': 'This is a benchmark transcription.'})
+        self._json({'error': 'not found'}, 404)
+
+    def _json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, chat):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(self.tokens + 1):
+            time.sleep(self.token_latency)
+            delta = {'content': ' token'} if i < self.tokens else {}
+            chunk = {'id': 'chatcmpl-benchmark', 'object': 'chat.completion.chunk', 'model': chat.get('model'),
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': None if i < self.tokens else 'stop'}]}
+            self._chunk(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        self._chunk(b'data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_openai(latency_ms, tokens, token_latency_ms):
+    FakeOpenAIHandler.latency = latency_ms / 1000
+    FakeOpenAIHandler.tokens = tokens
+    FakeOpenAIHandler.token_latency = token_latency_ms / 1000
+    server = FakeOpenAIServer(('127.0.0.1', 0), FakeOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+"""
+Clients with the same interface for the in-process and the HTTP mode; every worker thread gets its own.
+"""
+class InProcessClient:
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers=None, json_data=None, files=None, data=None):
+        if files:
+            data = dict(data or {}, **{name: (io.BytesIO(content), filename) for name, (filename, content) in files.items()})
+        response = self.client.open(path, method=method, headers=headers, json=json_data, data=data)
+        return response.status_code, len(response.get_data())
+
+class HttpClient:
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, headers=None, json_data=None, files=None, data=None):
+        response = self.session.request(method, self.url + path, headers=headers, json=json_data, files=files, data=data)
+        return response.status_code, len(response.content)
+
+class Target:
+    """
+    The server under test: the flask app of this process or a server over HTTP.
+    """
+
+    def __init__(self, args, upstream_url):
+        self.args = args
+        self.key = args.susi_api_key
+        self.process = None
+        self.pid = None
+        self.data_path = None
+        self._local = threading.local()
+        if args.mode == 'inprocess':
+            self.app = self._load_app(upstream_url)
+            self.pid = os.getpid()
+        elif args.url:
+            self.url = args.url
+            self.pid = args.pid
+        else:
+            self.url = self._launch(upstream_url)
+
+    def client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = InProcessClient(self.app) if self.args.mode == 'inprocess' else HttpClient(self.url)
+            self._local.client = client
+        return client
+
+    def auth(self):
+        return {'Authorization': f'Bearer {self.key}'}
+
+    def _load_app(self, upstream_url):
+        # import the app like the server does, the data path is a temporary directory
+        sys.path.insert(0, os.path.join(app_path, 'src'))
+        argv0, sys.argv[0] = sys.argv[0], os.path.join(app_path, 'src', 'main.py')
+        try:
+            import main
+        finally:
+            sys.argv[0] = argv0
+        import logging
+        logging.getLogger().setLevel(logging.WARNING)
+        from upstream.upstream_client import openai_client
+        openai_client.configure(base_url=upstream_url)
+        self.data_path = tempfile.mkdtemp(prefix='susi-benchmark-')
+        main.app.config['DATA_PATH'] = self.data_path
+        main.app.config['SUSI_API_KEY'] = self.key
+        main.app.config['OPENAI_API_KEY'] = 'benchmark'
+        if not self.args.cache:
+            from audio.transcription_cache import transcription_cache
+            from text.chat_cache import chat_cache
+            transcription_cache.configure(max_entries=0)
+            chat_cache.configure(max_entries=0)
+        return main.app
+
+    def _launch(self, upstream_url):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        command = [sys.executable, os.path.join('src', 'main.py'), '--host', '127.0.0.1', '--port', str(port),
+                   '--susi_api_key', self.key, '--openai_api_key', 'benchmark', '--openai_api_base', upstream_url,
+                   '--threads', str(max(self.args.concurrency) + 4)] + self.args.server_args.split()
+        if not self.args.cache:
+            command += ['--transcription_cache_size', '0', '--chat_cache_size', '0']
+        log = open(os.path.join(tempfile.gettempdir(), 'susi-benchmark-server.log'), 'wb')
+        self.process = subprocess.Popen(command, cwd=app_path, stdout=log, stderr=subprocess.STDOUT)
+        self.pid = self.process.pid
+        url = f'http://127.0.0.1:{port}'
+        deadline = time.time() + self.args.startup_timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'The server stopped at startup, see {log.name}')
+            try:
+                if requests.get(url + '/api/system/ready.json', timeout=1).status_code == 200:
+                    return url
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        self.close()
+        raise RuntimeError(f'The server did not start within {self.args.startup_timeout} seconds, see {log.name}')
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.data_path:
+            shutil.rmtree(self.data_path, ignore_errors=True)
+
+class RssMonitor:
+    """
+    Samples the resident memory of a process (with its children) and keeps the peak.
+    """
+
+    def __init__(self, pid, interval=0.02):
+        self.process = psutil.Process(pid) if pid else None
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.process is not None:
+            self.peak = self._rss()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._rss())
+
+    def _rss(self):
+        try:
+            processes = [self.process] + self.process.children(recursive=True)
+            return sum(process.memory_info().rss for process in processes)
+        except psutil.Error:
+            return self.peak
+
+"""
+Synthetic test data, generated from a seed so that every run uses the same data.
+"""
+def make_vocabulary(rng, size):
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'po', 've', 'da', 'gu', 'fe', 'zo', 'hi', 'bra', 'sto']
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+def make_catalog(path, documents, vocabulary, rng):
+    # word frequencies follow a zipf distribution like in natural language
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    with open(path, 'w') as f:
+        for i in range(documents):
+            title = ' '.join(rng.choices(vocabulary, weights, k=rng.randint(2, 6)))
+            text = ' '.join(rng.choices(vocabulary, weights, k=rng.randint(20, 80)))
+            f.write(json.dumps({'sku': str(i), 'title_t': title, 'text_t': text}) + '\n')
+
+def prepare(target, args):
+    """
+    Upload the test files and return the request functions of the selected scenarios.
+    """
+    rng = random.Random(args.seed)
+    client = target.client()
+    scenarios = {}
+    uploaded = []
+
+    def upload(name, content):
+        path = f'/api/data/{BENCH_DIR}/{name}'
+        status, _ = client.request('POST', path, headers=target.auth(), files={'file': (name, content)})
+        if status >= 400:
+            raise RuntimeError(f'Failed to upload {name}: status {status}')
+        uploaded.append(path)
+
+    chat = {'model': 'gpt-3.5-turbo', 'max_tokens': 50, 'temperature': 1.0,
+            'messages': [{'role': 'system', 'content': 'You are a helpful assistant.'}, {'role': 'user', 'content': 'Hello!'}]}
+    scenarios['chat'] = lambda c, i: c.request('POST', '/api/text/chat/completions', json_data=chat)
+    scenarios['chat_stream'] = lambda c, i: c.request('POST', '/api/text/chat/completions', json_data=dict(chat, stream=True))
+
+    wavs = [(os.path.basename(path), open(path, 'rb').read()) for path in sorted(glob.glob(os.path.join(wav_path, '*.wav')))]
+    if 'voice_upstream' in args.scenarios or 'voice' in args.scenarios:
+        if not wavs:
+            raise RuntimeError(f'No wav files in {wav_path}')
+        # the fake key makes the transcription go to the fake OpenAI server
+        scenarios['voice_upstream'] = lambda c, i: c.request('POST', '/api/audio/transcriptions', headers={'Authorization': 'Bearer benchmark'},
+                                                             files={'file': wavs[i % len(wavs)]}, data={'model': 'whisper-1'})
+        scenarios['voice'] = lambda c, i: c.request('POST', '/api/audio/transcriptions', headers={'Authorization': ''},
+                                                    files={'file': wavs[i % len(wavs)]}, data={'model': args.voice_model})
+
+    if 'search' in args.scenarios:
+        vocabulary = make_vocabulary(rng, args.vocabulary)
+        catalog_path = os.path.join(tempfile.gettempdir(), f'susi-benchmark-catalog-{args.catalog_docs}-{args.seed}.jsonl')
+        if not os.path.exists(catalog_path):
+            make_catalog(catalog_path, args.catalog_docs, vocabulary, rng)
+        with open(catalog_path, 'rb') as f:
+            catalog = f.read()
+        if args.search_shards > 1:
+            # the catalog is split into shards which are searched at once with a glob pattern
+            lines = catalog.splitlines(keepends=True)
+            size = -(-len(lines) // args.search_shards)
+            for shard in range(args.search_shards):
+                upload(f'catalog-{shard:03d}.jsonl', b''.join(lines[shard * size:(shard + 1) * size]))
+            catalog_file = f'{BENCH_DIR}/catalog-*.jsonl'
+        else:
+            upload('catalog.jsonl', catalog)
+            catalog_file = f'{BENCH_DIR}/catalog.jsonl'
+        weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+        queries = [' '.join(random.Random(i).choices(vocabulary, weights, k=1 + i % 3)) for i in range(1024)]
+        scenarios['search'] = lambda c, i: c.request('POST', '/api/data/search', json_data={
+            'file': catalog_file, 'query': queries[i % len(queries)], 'max_rerank': 10, 'mode': 'lexical'})
+
+    if 'listing' in args.scenarios:
+        for n in range(args.listing_files):
+            upload(f'listing/file-{n:05d}.txt', f'{n}\n'.encode('ascii'))
+        scenarios['listing'] = lambda c, i: c.request('GET', f'/api/data/{BENCH_DIR}/listing/index.json?limit=100&sort=mtime&order=desc')
+
+    if 'download' in args.scenarios:
+        upload('blob.bin', rng.randbytes(args.download_kb * 1024))
+        scenarios['download'] = lambda c, i: c.request('GET', f'/api/data/{BENCH_DIR}/blob.bin')
+
+    return {name: scenarios[name] for name in args.scenarios}, uploaded
+
+def cleanup(target, uploaded):
+    client = target.client()
+    for path in uploaded:
+        client.request('DELETE', path, headers=target.auth())
+
+def percentile(values, p):
+    # the nearest-rank percentile of sorted values
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+def run_level(target, name, scenario, concurrency, requests_count, warmup):
+    """
+    Send requests_count requests with `concurrency` parallel clients.
+
+    :return: A dictionary with the measurements
+    """
+    for i in range(warmup):
+        scenario(target.client(), i)
+
+    latencies, errors, sizes = [], [0], [0]
+    lock = threading.Lock()
+    counter = iter(range(requests_count))
+
+    def worker():
+        client = target.client()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                status, size = scenario(client, i)
+            except Exception:
+                status, size = 599, 0
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                sizes[0] += size
+                if status >= 400:
+                    errors[0] += 1
+
+    with RssMonitor(target.pid) as rss:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(worker) for _ in range(concurrency)]:
+                future.result()
+        duration = time.perf_counter() - start
+
+    latencies.sort()
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        'scenario': name,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(latencies) / duration, 2) if duration > 0 else None,
+        'bytes_per_request': round(sizes[0] / len(latencies)) if latencies else 0,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1]) if latencies else None
+        },
+        'peak_rss_mb': round(rss.peak / 1048576, 1) if rss.process is not None else None
+    }
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=app_path, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'mode': args.mode,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'arguments': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')}
+    }
+
+def print_result(result, baseline=None):
+    latency = result['latency_ms']
+    line = (f"{result['scenario']:<15} c={result['concurrency']:<4} {result['throughput_rps'] or 0:>9.1f} req/s  "
+            f"p50 {latency['p50'] or 0:>9.2f}  p95 {latency['p95'] or 0:>9.2f}  p99 {latency['p99'] or 0:>9.2f} ms  "
+            f"errors {result['errors']:<4} rss {result['peak_rss_mb'] or 0:>7.1f} MB")
+    if baseline:
+        change = lambda new, old: f'{100.0 * (new - old) / old:+.1f}%' if new is not None and old else 'n/a'
+        line += (f"  | vs baseline: throughput {change(result['throughput_rps'], baseline['throughput_rps'])}, "
+                 f"p95 {change(latency['p95'], baseline['latency_ms']['p95'])}")
+    print(line, flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the susi_api endpoints")
+    parser.add_argument("--mode", default="inprocess", choices=("inprocess", "http"), help="drive the flask app in this process or a server over HTTP, default inprocess")
+    parser.add_argument("--url", default="", type=str, help="URL of a running server for the http mode, default: start a server for the benchmark")
+    parser.add_argument("--pid", default=None, type=int, help="process id of the server given with --url to measure its memory")
+    parser.add_argument("--server_args", default="", type=str, help="additional arguments for the started server, i.e. '--chat_cache_size 0'")
+    parser.add_argument("--startup_timeout", default=120, type=int, help="seconds to wait for the started server, default 120")
+    parser.add_argument("--susi_api_key", default="benchmark", type=str, help="SUSI API key of the server, default benchmark")
+    parser.add_argument("--scenarios", default=DEFAULT_SCENARIOS, type=str, help=f"comma-separated list of {', '.join(SCENARIOS)}; default {DEFAULT_SCENARIOS}")
+    parser.add_argument("--concurrency", default="1,4,16", type=str, help="comma-separated concurrency levels, default 1,4,16")
+    parser.add_argument("--requests", default=200, type=int, help="number of requests per scenario and concurrency level, default 200")
+    parser.add_argument("--warmup", default=5, type=int, help="number of requests before every measurement, default 5")
+    parser.add_argument("--cache", action="store_true", help="keep the transcription and chat caches on, by default they are switched off because the benchmark repeats the same requests")
+    parser.add_argument("--voice_model", default="tiny", type=str, help="offline model of the voice scenario, default tiny")
+    parser.add_argument("--catalog_docs", default=20000, type=int, help="number of documents in the search catalog, default 20000")
+    parser.add_argument("--search_shards", default=1, type=int, help="number of files the search catalog is split into, default 1")
+    parser.add_argument("--vocabulary", default=5000, type=int, help="number of words in the search catalog, default 5000")
+    parser.add_argument("--listing_files", default=200, type=int, help="number of files in the listed directory, default 200")
+    parser.add_argument("--download_kb", default=1024, type=int, help="size of the downloaded file in KB, default 1024")
+    parser.add_argument("--upstream_latency_ms", default=20, type=float, help="latency of the fake OpenAI server in ms, default 20")
+    parser.add_argument("--upstream_tokens", default=16, type=int, help="tokens of a fake chat completion, default 16")
+    parser.add_argument("--upstream_token_latency_ms", default=0, type=float, help="delay between streamed tokens of the fake OpenAI server in ms, default 0")
+    parser.add_argument("--seed", default=42, type=int, help="seed of the synthetic data, default 42")
+    parser.add_argument("--output", default="", type=str, help="write the results as json to this file")
+    parser.add_argument("--baseline", default="", type=str, help="json results of an earlier run to compare with")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    args.concurrency = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(result['scenario'], result['concurrency']): result for result in json.load(f)['results']}
+
+    upstream, upstream_url = start_fake_openai(args.upstream_latency_ms, args.upstream_tokens, args.upstream_token_latency_ms)
+    target = Target(args, upstream_url)
+    results, uploaded = [], []
+    try:
+        scenarios, uploaded = prepare(target, args)
+        for name, scenario in scenarios.items():
+            for concurrency in args.concurrency:
+                result = run_level(target, name, scenario, concurrency, args.requests, args.warmup)
+                results.append(result)
+                print_result(result, baseline.get((name, concurrency)))
+    finally:
+        try:
+            cleanup(target, uploaded)
+        finally:
+            target.close()
+            upstream.shutdown()
+
+    report = {'meta': metadata(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main()